@@ -25,37 +25,240 @@ Asana's REST API to generate a plaintext and HTML email using Jinja2 templates.
 
 import argparse
 import codecs
+import atexit
+import collections
+import contextlib
 import datetime
+import hashlib
+import itertools
+import json
 import logging
-import smtplib
-
-import asana
-import dateutil.parser
-import dateutil.tz
-import premailer
+import os
+import re
+import shlex
+import socket
+import sys
+import threading
+import time
+import zlib
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from jinja2 import Environment, FileSystemLoader
 
+# asana, dateutil, jinja2, premailer (lxml, cssutils, requests), smtplib and
+# multiprocessing are imported by the functions that use them, as importing
+# them all up front dominates the runtime of small mailers and of --help.
+
+
+log = logging.getLogger('asana_mailer')
+
+SNAPSHOT_VERSION = 1
+# The format of times in snapshots, in UTC, which is much quicker to parse
+# than with dateutil
+SNAPSHOT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+CASSETTE_VERSION = 1
+STORE_VERSION = 1
+PACK_VERSION = 1
+PACK_METADATA = 'pack.json'
+COMMENT_FILTERS = frozenset((
+    'last_comment', 'most_recent_comments', 'comments_within_lookback'))
+TIME_DEPENDENT_NAMES = frozenset(('current_time_utc', 'stats'))
+DEFAULT_WEBHOOK_PORT = 8090
+DEFAULT_SERVE_WORKERS = 4
+DEFAULT_STORY_CACHE_SIZE = 100000
+DEFAULT_SHARED_CACHE_TTL = 900
+SHARED_CACHE_CLAIM_TIMEOUT = 30
+SHARED_CACHE_POLL_INTERVAL = 0.1
+ASANA_BASE_URL = 'https://app.asana.com/'
+ASANA_PAGE_SIZE = 100
+DEFAULT_SEND_RETRIES = 3
+SEND_RETRY_DELAY = 1.0
+SPOOL_RECIPIENTS_HEADER = 'X-Asana-Mailer-Recipients'
+SPOOL_CLAIM_TIMEOUT = 3600
+DEFAULT_RENDER_CACHE_SIZE = 50
+SMTP_TIMEOUT = 300
+MIN_SMTP_TIMEOUT = 10
+DEFAULT_DEADLINE_RESERVE = 30
+DEFAULT_LOG_FILE = 'asana_mailer.log'
+LOG_FORMATS = ('text', 'json')
+
+
+def init_logging(log_file=DEFAULT_LOG_FILE, log_format='text', sample=None):
+    '''Sets up logging to log_file, only the first time it's called.
+
+    This is called by main rather than on import, so that importing the module
+    (e.g. from tests) doesn't create a log file.
+
+    Records are put on a queue and written out by a listener thread, so the
+    threads fetching, rendering and sending never wait on the log file.
+
+    :param log_file: The file to log to, or '-' for standard error
+    :param log_format: One of LOG_FORMATS, 'json' writing a JSON object per
+    line with the fields of spans
+    :param sample: Log every sample'th debug line of each kind (such as the
+    line for each task fetched), or don't log debug lines if None
+    :return: The started listener, whose stop method flushes the queue, or
+    None if logging was already set up
+    '''
+    if log.handlers:
+        return None
+    import Queue
+
+    if log_format == 'json':
+        logging_formatter = JsonFormatter()
+    else:
+        logging_formatter = logging.Formatter(
+            '%(asctime)s %(levelname)s [%(name)s]: %(message)s '
+            '[%(filename)s:%(lineno)d]')
+
+    if log_file == '-':
+        output_handler = logging.StreamHandler(sys.stderr)
+    else:
+        output_handler = logging.FileHandler(log_file, encoding='utf-8')
+    output_handler.setLevel(logging.DEBUG)
+    output_handler.setFormatter(logging_formatter)
+
+    log_queue = Queue.Queue()
+    listener = LogQueueListener(log_queue, output_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    queue_handler = LogQueueHandler(log_queue)
+    if sample:
+        queue_handler.addFilter(SampleFilter(sample))
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.INFO)
+    log.addHandler(queue_handler)
+    return listener
+
+
+class LogQueueHandler(logging.Handler):
+    '''Puts log records on a queue for a LogQueueListener to write out.'''
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        # Format the message (and any traceback) in the logging thread, as
+        # the arguments may change or not be picklable by the time the
+        # listener gets to it
+        record.msg = record.message = self.format(record)
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class LogQueueListener(object):
+    '''Writes the records put on a queue by a LogQueueHandler to handlers,
+    from a daemon thread.
+    '''
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.monitor)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        '''Writes out the records already queued, then stops the thread.'''
+        if self.thread is not None:
+            self.queue.put_nowait(None)
+            self.thread.join()
+            self.thread = None
+
+
+class JsonFormatter(logging.Formatter):
+    '''Formats log records as JSON objects, one per line.
+
+    The fields a record was logged with (as extra={'fields': {...}}, which
+    span does) are added to the object, so phases can be aggregated by log
+    processors without parsing messages.
+    '''
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+            'source': '{0}:{1}'.format(record.filename, record.lineno),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, sort_keys=True)
+
+
+class SampleFilter(logging.Filter):
+    '''Lets through every rate'th debug record logged from each place,
+    along with all records of higher levels.
 
-def init_logging():
-    log = logging.getLogger('asana_mailer')
-    log.setLevel(logging.INFO)
+    Debug lines logged per task would otherwise cost more to write than the
+    rest of a large run's logging put together.
 
-    logging_formatter = logging.Formatter(
-        '%(asctime)s %(levelname)s [%(name)s]: %(message)s '
-        '[%(filename)s:%(lineno)d]')
+    :param rate: The number of debug records of each kind per one logged
+    '''
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
 
-    file_handler = logging.FileHandler('asana_mailer.log', encoding='utf-8')
-    file_handler.setLevel(logging.DEBUG)
-    file_handler.setFormatter(logging_formatter)
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            count = self.counts[key]
+            self.counts[key] += 1
+        return count % self.rate == 0
 
-    log.addHandler(file_handler)
-    return log
 
+@contextlib.contextmanager
+def span(name, **fields):
+    '''Times a phase of a run, logging its duration once it ends.
 
-log = init_logging()
+    The yielded dict of fields can be added to during the phase (e.g. with the
+    number of tasks it fetched), and is logged with the duration as the fields
+    of the record.
+
+    :param name: The name of the phase
+    '''
+    fields = dict(fields, span=name)
+    start = time.time()
+    try:
+        yield fields
+    except Exception:
+        fields['failed'] = True
+        raise
+    finally:
+        fields['duration_ms'] = round((time.time() - start) * 1000, 1)
+        log.info(
+            'Finished {0} in {1} ms'.format(name, fields['duration_ms']),
+            extra={'fields': fields})
 
 
 class Project(object):
@@ -67,18 +270,24 @@ class Project(object):
     sections.
     '''
 
-    def __init__(self, id, name, description, sections=None):
+    def __init__(
+            self, id, name, description, sections=None,
+            partial_comments=False):
         self.id = id
         self.name = name
         self.description = description
         self.sections = sections
         if self.sections is None:
             self.sections = []
+        self.partial_comments = partial_comments
 
     @staticmethod
     def create_project(
             asana_client, project_id, current_time_utc, task_filters=None,
-            section_filters=None, completed_lookback_hours=None):
+            section_filters=None, completed_lookback_hours=None,
+            story_cache=None, fetch_workers=1, pool=None, shard_size=None,
+            limits=None, subtask_depth=0, subtask_cache=None, tracer=None,
+            comment_window=None, deadline=None, with_comments=True):
         '''Creates a Project utilizing data from Asana.
 
         Using filters, a project attempts to optimize the calls it makes to
@@ -92,58 +301,198 @@ class Project(object):
         :param section_filters: A list of sections to filter out tasks
         :param completed_lookback_hours: An amount in hours to look back for
         completed tasks
+        :param story_cache: An optional StoryCache used to reuse the comments
+        of tasks that haven't been modified since they were last fetched
+        :param fetch_workers: The number of tasks to fetch comments for
+        concurrently
+        :param pool: An optional multiprocessing Pool to build sections in
+        :param shard_size: The number of tasks to build in each pool job
+        :param limits: Optional DigestLimits to enforce while creating sections
+        :param subtask_depth: The number of levels of subtasks to fetch
+        :param subtask_cache: An optional StoryCache used to reuse the
+        subtasks of tasks that haven't been modified since they were fetched
+        :param tracer: An optional MemoryTracer to record each phase with
+        :param comment_window: An optional CommentWindow to select the
+        comments of each task to keep with
+        :param deadline: An optional Deadline, past whose fetch time no more
+        comments or subtasks are fetched, the project's partial_comments
+        being set if any comments weren't
+        :param with_comments: Whether to fetch the comments of tasks, which
+        can be skipped when nothing shows them
         :return: The newly created Project instance
         '''
         log.info('Creating project object from Asana Project {0}'.format(
             project_id))
 
-        project_json = asana_client.projects.find_by_id(project_id)
-
-        tasks_params = {}
-        if completed_lookback_hours:
-            completed_since = (current_time_utc - datetime.timedelta(
-                hours=completed_lookback_hours)).replace(
-                    microsecond=0).isoformat()
-            log.info(
-                'Retaining tasks completed since {0}'.format(completed_since))
-        else:
-            completed_since = 'now'
-        tasks_params['completed_since'] = completed_since
-        project_tasks_json = list(asana_client.projects.tasks(
-            project_id, params=tasks_params, expand='.'))
+        # The tasks of each page are selected, and their comments fetched,
+        # while the next page downloads
+        project_json, project_tasks_json = fetch_project(
+            asana_client, project_id, current_time_utc,
+            completed_lookback_hours, prefetch_pages=True)
+        filtered_tasks_json = []
+        tasks_to_fetch = iter_select_tasks(
+            project_tasks_json, filtered_tasks_json, task_filters,
+            section_filters,
+            limits.max_tasks_per_section if limits is not None else None)
         task_comments = {}
+        if with_comments:
+            task_comments = fetch_comments(
+                asana_client, tasks_to_fetch, story_cache, fetch_workers,
+                comment_window, deadline)
+        else:
+            for _ in tasks_to_fetch:
+                pass
+        if tracer is not None:
+            tracer.phase('fetch')
 
-        current_section = None
-        log.info('Starting API Calls for Task Comments')
-        for task in project_tasks_json:
-            if task[u'name'].endswith(':'):
-                current_section = task[u'name']
-            # Optimize calls to API
-            if section_filters and current_section not in section_filters:
-                continue
-            tag_names = frozenset((tag[u'name'] for tag in task[u'tags']))
-            if task_filters and not tag_names >= task_filters:
-                continue
-            task_id = unicode(task[u'id'])
-            log.info('Getting task comments for task: {0}'.format(task_id))
-            task_stories = asana_client.tasks.stories(task_id)
-            current_task_comments = [
-                story for story in task_stories if
-                story[u'type'] == u'comment']
-            if current_task_comments:
-                task_comments[task_id] = current_task_comments
+        project = Project(
+            project_id, project_json[u'name'], project_json[u'notes'],
+            partial_comments=deadline is not None and deadline.missed > 0)
+        project.build(
+            asana_client, filtered_tasks_json, task_comments, current_time_utc,
+            task_filters=task_filters, section_filters=section_filters,
+            fetch_workers=fetch_workers, pool=pool, shard_size=shard_size,
+            limits=limits, subtask_depth=subtask_depth,
+            subtask_cache=subtask_cache, tracer=tracer, deadline=deadline)
+        return project
+
+    @staticmethod
+    def create_rollup(
+            asana_client, project_ids, current_time_utc, name=None,
+            task_filters=None, section_filters=None,
+            completed_lookback_hours=None, story_cache=None, fetch_workers=1,
+            pool=None, shard_size=None, limits=None, subtask_depth=0,
+            subtask_cache=None, tracer=None, comment_window=None,
+            deadline=None, with_comments=True):
+        '''Creates a single Project rolling up several Asana Projects.
+
+        The projects are fetched concurrently, and each of their sections
+        becomes a section of the rollup named after the project (tasks outside
+        of any section go in a section named after just the project). A task
+        in more than one of the projects is only included (and its comments
+        only fetched) once, in the first project it's in. The rollup has the
+        id of the first project.
+
+        :param project_ids: The Asana Project IDs, in the order to show them
+        :param name: The name of the rollup, by default the projects' names
+        The other parameters are as for create_project.
+        :return: The newly created Project instance
+        '''
+        log.info('Creating rollup of Asana Projects {0}'.format(
+            ', '.join(project_ids)))
+
+        fetched = map_concurrently(
+            lambda project_id: fetch_project(
+                asana_client, project_id, current_time_utc,
+                completed_lookback_hours),
+            project_ids, fetch_workers)
+        max_tasks = (
+            limits.max_tasks_per_section if limits is not None else None)
+        rollup_tasks_json = []
+        tasks_to_fetch = []
+        seen = set()
+        # The tasks beyond the limit of their rollup section, which is only
+        # known once tasks already in the rollup are left out
+        omitted = set()
+        for project_id, (project_json, project_tasks_json) in zip(
+                project_ids, fetched):
+            filtered_tasks_json, project_tasks_to_fetch = select_tasks(
+                project_tasks_json, task_filters, section_filters)
+            tasks_to_fetch.extend(
+                task for task in project_tasks_to_fetch if task[0] not in seen)
+            project_name = project_json[u'name']
+            if not filtered_tasks_json or not (
+                    filtered_tasks_json[0][u'name'].endswith(':')):
+                rollup_tasks_json.append({
+                    u'id': project_id, u'name': u'{0}:'.format(project_name),
+                    u'tags': [], u'project_id': project_id})
+            section_tasks = 0
+            for task in filtered_tasks_json:
+                task_id = unicode(task[u'id'])
+                if task[u'name'].endswith(':'):
+                    task = dict(task, name=u'{0}: {1}'.format(
+                        project_name, task[u'name']), project_id=project_id)
+                    section_tasks = 0
+                elif task_id in seen:
+                    log.debug('Task %s already in the rollup', task_id)
+                    continue
+                else:
+                    section_tasks += 1
+                    if max_tasks is not None and section_tasks > max_tasks:
+                        omitted.add(task_id)
+                seen.add(task_id)
+                rollup_tasks_json.append(task)
+        tasks_to_fetch = [
+            to_fetch for to_fetch in tasks_to_fetch
+            if to_fetch[0] not in omitted]
+        task_comments = {}
+        if with_comments:
+            task_comments = fetch_comments(
+                asana_client, tasks_to_fetch, story_cache, fetch_workers,
+                comment_window, deadline)
+        if tracer is not None:
+            tracer.phase('fetch')
 
+        if name is None:
+            name = u', '.join(
+                project_json[u'name'] for project_json, _ in fetched)
         project = Project(
-            project_id, project_json[u'name'], project_json[u'notes'])
+            project_ids[0], name, u'',
+            partial_comments=deadline is not None and deadline.missed > 0)
+        # Sections were filtered on their names before they were prefixed
+        project.build(
+            asana_client, rollup_tasks_json, task_comments, current_time_utc,
+            task_filters=task_filters, fetch_workers=fetch_workers, pool=pool,
+            shard_size=shard_size, limits=limits, subtask_depth=subtask_depth,
+            subtask_cache=subtask_cache, tracer=tracer, deadline=deadline)
+        return project
+
+    def build(
+            self, asana_client, project_tasks_json, task_comments,
+            current_time_utc, task_filters=None, section_filters=None,
+            fetch_workers=1, pool=None, shard_size=None, limits=None,
+            subtask_depth=0, subtask_cache=None, tracer=None, deadline=None):
+        '''Adds the sections of fetched tasks to the project, and their
+        subtasks if a subtask depth is given.
+
+        :param project_tasks_json: The JSON of the tasks (and section headers)
+        to create, from select_tasks
+        :param task_comments: A dict of task id to the task's comments
+        The other parameters are as for create_project.
+        '''
         log.info('Separating Tasks into Sections')
-        project.add_sections(
-            Section.create_sections(project_tasks_json, task_comments))
+        self.add_sections(
+            Section.create_sections(
+                project_tasks_json, task_comments, pool=pool,
+                shard_size=shard_size, limits=limits))
+        if tracer is not None:
+            tracer.phase('create_sections')
         log.info('Starting task filtering')
-        project.filter_tasks(
+        self.filter_tasks(
             current_time_utc, section_filters=section_filters,
             task_filters=task_filters)
+        if tracer is not None:
+            tracer.phase('filter_tasks')
 
-        return project
+        if subtask_depth and deadline is not None and (
+                not deadline.can_fetch()):
+            log.warning('Not fetching subtasks, the deadline is too close')
+        elif subtask_depth:
+            log.info('Starting API Calls for Subtasks')
+            modified_times = dict(
+                (unicode(task[u'id']), task.get(u'modified_at'))
+                for task in project_tasks_json)
+            tasks = [
+                task for section in self.sections for task in section.tasks]
+            subtasks_json = fetch_subtasks(
+                asana_client, [(task.id, modified_times.get(task.id))
+                               for task in tasks],
+                subtask_depth, fetch_workers, subtask_cache, deadline)
+            for task in tasks:
+                task.subtasks = Task.create_subtasks(
+                    task.id, subtasks_json, subtask_depth)
+            if tracer is not None:
+                tracer.phase('subtasks')
 
     def add_section(self, section):
         '''Add a section to the project.
@@ -161,6 +510,33 @@ class Project(object):
         self.sections.extend(
             (section for section in sections if isinstance(section, Section)))
 
+    def to_dict(self):
+        '''Converts the Project, its Sections and Tasks into plain data.
+
+        :return: A dict that can be serialized as JSON
+        '''
+        return {
+            u'id': self.id,
+            u'name': self.name,
+            u'description': self.description,
+            u'sections': [section.to_dict() for section in self.sections],
+            u'partial_comments': self.partial_comments
+        }
+
+    @staticmethod
+    def from_dict(project_dict):
+        '''Creates a Project from the output of Project.to_dict.
+
+        :param project_dict: The dict representation of a Project
+        :return: The newly created Project instance
+        '''
+        return Project(
+            project_dict[u'id'], project_dict[u'name'],
+            project_dict[u'description'], [
+                Section.from_dict(section)
+                for section in project_dict[u'sections']],
+            project_dict.get(u'partial_comments', False))
+
     def filter_tasks(
             self, current_time_utc, section_filters=None, task_filters=None):
         '''Filter out tasks based on filters based on filter criteria.
@@ -185,61 +561,133 @@ class Project(object):
                     if task.tags_in(task_filters)]
         # Remove Empty Sections
         log.info('Removing empty sections')
+        self.sections[:] = [
+            s for s in self.sections if s.tasks or s.omitted_tasks]
+
+    def select_comments(self, comment_window):
+        '''Keeps only the comments of each task within a comment window.
+
+        :param comment_window: The CommentWindow to select comments with
+        '''
+        for section in self.sections:
+            for task in section.tasks:
+                task.comments = comment_window.select(task.comments)
+
+    def fingerprints(self):
+        '''Fingerprints every task in the project.
+
+        :return: A dict of task id to the task's fingerprint
+        '''
+        return dict(
+            (task.id, task.fingerprint())
+            for section in self.sections for task in section.tasks)
+
+    def filter_changes(self, previous_fingerprints, unknown_ids=()):
+        '''Filter out tasks that haven't changed since a previous run.
+
+        Each remaining task's change attribute is set to describe why it was
+        kept: 'new', 'completed', 'commented' or 'changed'.
+
+        :param previous_fingerprints: The fingerprints (from
+        Project.fingerprints) of the tasks rendered in the previous run
+        :param unknown_ids: The ids of tasks whose comments weren't fetched,
+        which can't be compared, so are only kept if they're new
+        '''
+        log.info('Filtering out tasks unchanged since the last run')
+        for section in self.sections:
+            changed_tasks = []
+            for task in section.tasks:
+                previous_fingerprint = previous_fingerprints.get(task.id)
+                if task.id in unknown_ids and (
+                        previous_fingerprint is not None):
+                    task.change = None
+                else:
+                    task.change = task.change_since(previous_fingerprint)
+                if task.change is not None:
+                    changed_tasks.append(task)
+            section.tasks[:] = changed_tasks
         self.sections[:] = [s for s in self.sections if s.tasks]
 
 
 class Section(object):
     '''A class representing a section of tasks within an Asana Project.'''
 
-    def __init__(self, name, tasks=None):
+    def __init__(
+            self, name, tasks=None, omitted_tasks=0, omitted_task_ids=None,
+            project_id=None):
         self.name = name
         self.tasks = tasks
         if self.tasks is None:
             self.tasks = []
+        self.omitted_tasks = omitted_tasks
+        # The ids of the omitted tasks, whose fingerprints --changes-only
+        # carries forward
+        self.omitted_task_ids = omitted_task_ids
+        if self.omitted_task_ids is None:
+            self.omitted_task_ids = []
+        # The Asana Project the section is from, if it isn't the project it's
+        # in (as for the sections of a rollup)
+        self.project_id = project_id
 
     @staticmethod
-    def create_sections(project_tasks_json, task_comments):
+    def create_sections(
+            project_tasks_json, task_comments, pool=None, shard_size=None,
+            limits=None):
         '''Creates sections from task and story JSON from Asana's API.
 
+        If a process pool and shard size are given, the tasks are split into
+        shards of about shard_size tasks (only ever at a section header), and
+        each shard's sections are built in the pool.
+
+        If limits are given, tasks beyond them are counted in their section's
+        omitted_tasks rather than being created, and long descriptions and
+        comment threads are truncated.
+
         :param project_tasks_json: The JSON object for a Project's tasks in
         Asana
         :param task_last_comments: The last comments (stories) for all of the
         tasks in the tasks JSON
+        :param pool: An optional multiprocessing Pool to build sections in
+        :param shard_size: The number of tasks to build in each pool job
+        :param limits: Optional DigestLimits to enforce
         '''
-        sections = []
-        misc_section = Section(u'Misc:')
-        current_section = misc_section
-        for task in project_tasks_json:
-            if task[u'name'].endswith(':'):
-                if current_section.tasks and current_section.name != u'Misc:':
-                    sections.append(current_section)
-                current_section = Section(task[u'name'])
-            else:
-                name = task[u'name']
-                if task[u'assignee']:
-                    assignee = task[u'assignee'][u'name']
-                else:
-                    assignee = None
-                task_id = unicode(task[u'id'])
-                completed = task[u'completed']
-                if completed:
-                    completion_time = dateutil.parser.parse(
-                        task[u'completed_at'])
-                else:
-                    completion_time = None
-                description = task[u'notes'] if task[u'notes'] else None
-                due_date = task[u'due_on']
-                tags = [tag[u'name'] for tag in task[u'tags']]
-                current_task_comments = task_comments.get(task_id)
-                current_task = Task(
-                    name, assignee, completed, completion_time, description,
-                    due_date, tags, current_task_comments)
-                current_section.add_task(current_task)
-        if current_section.tasks:
-            sections.append(current_section)
-        if misc_section.tasks and current_section != misc_section:
-            log.info("Some tasks weren't in a section, adding Misc Section")
-            sections.append(misc_section)
+        if pool is not None and shard_size:
+            shards = shard_tasks_json(project_tasks_json, shard_size)
+            log.info('Building sections in {0} shards'.format(len(shards)))
+            built_shards = pool.map(build_sections, [
+                (shard, dict(
+                    (unicode(task[u'id']), task_comments[unicode(task[u'id'])])
+                    for task in shard
+                    if unicode(task[u'id']) in task_comments), limits)
+                for shard in shards])
+            # Every shard but the first starts at a header, so only the first
+            # shard's leading Misc section can have tasks
+            built_sections = built_shards[0]
+            for built_shard in built_shards[1:]:
+                built_sections.extend(built_shard[1:])
+        else:
+            built_sections = build_sections(
+                (project_tasks_json, task_comments, limits))
+
+        misc_section = built_sections[0]
+        header_sections = built_sections[1:]
+        if not header_sections:
+            sections = [misc_section] if (
+                misc_section.tasks or misc_section.omitted_tasks) else []
+        else:
+            # Sections whose tasks were all omitted are kept for their note
+            sections = [
+                section for section in header_sections[:-1]
+                if (section.tasks or section.omitted_tasks) and
+                section.name != u'Misc:']
+            if header_sections[-1].tasks or header_sections[-1].omitted_tasks:
+                sections.append(header_sections[-1])
+            if misc_section.tasks or misc_section.omitted_tasks:
+                log.info(
+                    "Some tasks weren't in a section, adding Misc Section")
+                sections.append(misc_section)
+        if limits is not None and limits.max_bytes:
+            limits.limit_bytes(sections)
         return sections
 
     def add_task(self, task):
@@ -257,13 +705,78 @@ class Section(object):
         '''
         self.tasks.extend((task for task in tasks if isinstance(task, Task)))
 
+    def to_dict(self):
+        '''Converts the Section and its Tasks into plain data.'''
+        return {
+            u'name': self.name,
+            u'tasks': [task.to_dict() for task in self.tasks],
+            u'omitted_tasks': self.omitted_tasks,
+            u'omitted_task_ids': self.omitted_task_ids,
+            u'project_id': self.project_id
+        }
+
+    @staticmethod
+    def from_dict(section_dict):
+        '''Creates a Section from the output of Section.to_dict.'''
+        return Section(
+            section_dict[u'name'],
+            [Task.from_dict(task) for task in section_dict[u'tasks']],
+            section_dict.get(u'omitted_tasks', 0),
+            section_dict.get(u'omitted_task_ids'),
+            section_dict.get(u'project_id'))
+
+
+def shard_tasks_json(project_tasks_json, shard_size):
+    '''Splits a project's task JSON into shards of about shard_size tasks.
+
+    Shards are only ever split at a section header, so that each section is
+    built by a single shard.
+
+    :return: A list of lists of task JSON
+    '''
+    shards = [[]]
+    for task in project_tasks_json:
+        if task[u'name'].endswith(':') and len(shards[-1]) >= shard_size:
+            shards.append([])
+        shards[-1].append(task)
+    return shards
+
+
+def build_sections(shard):
+    '''Builds a Section for each section header in a shard of task JSON.
+
+    Tasks preceding the first header are added to a leading Misc Section, which
+    is always returned first. Empty sections are kept, they are dropped by
+    Section.create_sections. This is a module level function that takes a
+    single argument so that it can be mapped over a process pool.
+
+    :param shard: A (task JSON, task comments, DigestLimits or None) tuple
+    :return: A list of Sections
+    '''
+    project_tasks_json, task_comments, limits = shard
+    max_tasks = limits.max_tasks_per_section if limits is not None else None
+    sections = [Section(u'Misc:')]
+    for task in project_tasks_json:
+        if task[u'name'].endswith(':'):
+            sections.append(Section(
+                task[u'name'], project_id=task.get(u'project_id')))
+            continue
+        if max_tasks is not None and len(sections[-1].tasks) >= max_tasks:
+            sections[-1].omitted_tasks += 1
+            sections[-1].omitted_task_ids.append(unicode(task[u'id']))
+            continue
+        sections[-1].add_task(Task.create_task(
+            task, task_comments.get(unicode(task[u'id'])), limits))
+    return sections
+
 
 class Task(object):
     '''A class representing an Asana Task.'''
 
     def __init__(
             self, name, assignee, completed, completion_time, description,
-            due_date, tags, comments):
+            due_date, tags, comments, id=None):
+        self.id = id
         self.name = name
         self.assignee = assignee
         self.completed = completed
@@ -272,183 +785,2646 @@ class Task(object):
         self.due_date = due_date
         self.tags = tags
         self.comments = comments
+        # The number of comments left out by DigestLimits, and the
+        # fingerprint key of the last of all the task's comments
+        self.omitted_comments = 0
+        self.last_comment_key = None
+        self.change = None
+        self.subtasks = []
+
+    @staticmethod
+    def create_task(task_json, comments=None, limits=None):
+        '''Creates a Task from its JSON from Asana's API.
+
+        :param task_json: The JSON object for the task in Asana
+        :param comments: The task's comments (stories)
+        :param limits: Optional DigestLimits to truncate the task to
+        :return: The newly created Task instance
+        '''
+        import dateutil.parser
+
+        if task_json[u'assignee']:
+            assignee = task_json[u'assignee'][u'name']
+        else:
+            assignee = None
+        completed = task_json[u'completed']
+        if completed:
+            completion_time = dateutil.parser.parse(task_json[u'completed_at'])
+        else:
+            completion_time = None
+        description = task_json[u'notes'] if task_json[u'notes'] else None
+        all_comments = comments
+        if limits is not None:
+            description = limits.truncate_description(description)
+            comments = limits.truncate_comments(comments)
+        task = Task(
+            task_json[u'name'], assignee, completed, completion_time,
+            description, task_json[u'due_on'],
+            [tag[u'name'] for tag in task_json[u'tags']], comments,
+            id=unicode(task_json[u'id']))
+        if all_comments and len(all_comments) > len(comments or ()):
+            task.omitted_comments = len(all_comments) - len(comments)
+            task.last_comment_key = Task.comment_key(all_comments[-1])
+        return task
+
+    @staticmethod
+    def create_subtasks(task_id, subtasks_json, depth):
+        '''Creates the subtasks of a task, down to depth levels.
+
+        :param task_id: The Asana Task ID of the parent task
+        :param subtasks_json: A dict of task id to the JSON of the task's
+        subtasks, as returned by fetch_subtasks
+        :param depth: The number of levels of subtasks to create
+        :return: The list of subtasks, with their own subtasks set
+        '''
+        if depth <= 0:
+            return []
+        subtasks = []
+        for subtask_json in subtasks_json.get(task_id, ()):
+            subtask = Task.create_task(subtask_json)
+            subtask.subtasks = Task.create_subtasks(
+                subtask.id, subtasks_json, depth - 1)
+            subtasks.append(subtask)
+        return subtasks
 
     def tags_in(self, tag_filter_set):
         '''Determines if a Tasks's tags are within a set of tag filters'''
         task_tag_set = frozenset(self.tags)
         return task_tag_set >= tag_filter_set
 
+    @staticmethod
+    def comment_key(comment):
+        '''The parts of a comment that a task's fingerprint covers.'''
+        return [comment.get(u'created_at'), comment.get(u'text')]
 
-# Filters
+    def fingerprint(self):
+        '''Fingerprints the parts of the task that are shown in the mailer.
 
-def last_comment(task_comments):
-    if task_comments:
-        return task_comments[-1:]
-    else:
-        return []
+        Comments left out by DigestLimits still count, so that a task whose
+        comments are capped is seen to change as more are added.
 
+        :return: A list of a hash of the task's fields, whether the task is
+        completed, and the task's number of comments
+        '''
+        comments = self.comments or []
+        comment_count = len(comments) + self.omitted_comments
+        if self.omitted_comments:
+            last_comment_key = self.last_comment_key
+        elif comments:
+            last_comment_key = Task.comment_key(comments[-1])
+        else:
+            last_comment_key = None
+        fields = json.dumps([
+            self.name, self.assignee, self.completed, self.description,
+            self.due_date, sorted(self.tags), comment_count,
+            last_comment_key], separators=(',', ':'))
+        return [
+            hashlib.sha1(fields.encode('utf-8')).hexdigest()[:16],
+            self.completed, comment_count]
 
-def most_recent_comments(task_comments, num_comments):
-    if num_comments <= 0:
-        num_comments = 1
-    elif num_comments > len(task_comments):
-        num_comments = len(task_comments)
-    if task_comments:
-        return task_comments[-num_comments:]
-    else:
-        return []
+    def change_since(self, previous_fingerprint):
+        '''Describes how the task changed since a previous fingerprint.
 
+        :param previous_fingerprint: The task's fingerprint from a previous
+        run, or None if it wasn't in the previous run
+        :return: 'new', 'completed', 'commented', 'changed', or None if the
+        task hasn't changed
+        '''
+        if previous_fingerprint is None:
+            return u'new'
+        fingerprint = self.fingerprint()
+        if fingerprint[0] == previous_fingerprint[0]:
+            return None
+        if fingerprint[1] and not previous_fingerprint[1]:
+            return u'completed'
+        if fingerprint[2] > previous_fingerprint[2]:
+            return u'commented'
+        return u'changed'
 
-def comments_within_lookback(task_comments, current_time_utc, hours):
-    filtered_comments = []
-    for comment in task_comments:
-        comment_time = dateutil.parser.parse(comment[u'created_at'])
-        delta = current_time_utc - comment_time
-        if delta < datetime.timedelta(hours=hours):
-            filtered_comments.append(comment)
-    if not filtered_comments and task_comments:
-        filtered_comments.append(task_comments[-1])
-    return filtered_comments
+    def to_dict(self):
+        '''Converts the Task into plain data.'''
+        import dateutil.tz
 
+        completion_time = self.completion_time
+        if completion_time is not None:
+            if completion_time.tzinfo is not None:
+                completion_time = completion_time.astimezone(
+                    dateutil.tz.tzutc())
+            completion_time = completion_time.strftime(SNAPSHOT_TIME_FORMAT)
+        return {
+            u'id': self.id,
+            u'name': self.name,
+            u'assignee': self.assignee,
+            u'completed': self.completed,
+            u'completion_time': completion_time,
+            u'description': self.description,
+            u'due_date': self.due_date,
+            u'tags': self.tags,
+            u'comments': self.comments,
+            u'omitted_comments': self.omitted_comments,
+            u'last_comment_key': self.last_comment_key,
+            u'change': self.change,
+            u'subtasks': [subtask.to_dict() for subtask in self.subtasks]
+        }
 
-def as_date(datetime_str):
-    try:
-        parsed_date = dateutil.parser.parse(datetime_str).date().isoformat()
-    except:
-        return datetime_str
-    else:
-        return parsed_date
+    @staticmethod
+    def from_dict(task_dict):
+        '''Creates a Task from the output of Task.to_dict.'''
+        import dateutil.parser
+        import dateutil.tz
 
+        completion_time = task_dict[u'completion_time']
+        if completion_time is not None:
+            try:
+                completion_time = datetime.datetime.strptime(
+                    completion_time, SNAPSHOT_TIME_FORMAT).replace(
+                        tzinfo=dateutil.tz.tzutc())
+            except ValueError:
+                # Written as an ISO 8601 time by an earlier version
+                completion_time = dateutil.parser.parse(completion_time)
+        task = Task(
+            task_dict[u'name'], task_dict[u'assignee'],
+            task_dict[u'completed'], completion_time,
+            task_dict[u'description'], task_dict[u'due_date'],
+            task_dict[u'tags'], task_dict[u'comments'], id=task_dict[u'id'])
+        task.omitted_comments = task_dict.get(u'omitted_comments', 0)
+        task.last_comment_key = task_dict.get(u'last_comment_key')
+        task.change = task_dict.get(u'change')
+        task.subtasks = [
+            Task.from_dict(subtask)
+            for subtask in task_dict.get(u'subtasks', ())]
+        return task
 
-def generate_templates(
-        project, html_template, text_template, current_date, current_time_utc,
-        skip_inline_css=False):
-    '''Generates the templates using Jinja2 templates
 
-    :param html_template: The filename of the HTML template in the templates
-    folder
-    :param text_template: The filename of the text template in the templates
-    folder
-    :param current_date: The current date.
+class DigestLimits(object):
+    '''Budgets that keep the digest of a very large project to a sane size.
+
+    Each limit is optional, None meaning unlimited.
+
+    :param max_tasks_per_section: The number of tasks to include per section
+    :param max_description_length: The number of characters of a task's
+    description to include
+    :param max_comments_per_task: The number of a task's most recent comments
+    to include
+    :param max_bytes: The total size in bytes of the task text (names,
+    descriptions and comments) to include
     '''
-    env = Environment(
-        loader=FileSystemLoader('templates'), trim_blocks=True,
-        lstrip_blocks=True, autoescape=True)
 
-    env.filters['last_comment'] = last_comment
-    env.filters['most_recent_comments'] = most_recent_comments
-    env.filters['comments_within_lookback'] = comments_within_lookback
-    env.filters['as_date'] = as_date
+    def __init__(
+            self, max_tasks_per_section=None, max_description_length=None,
+            max_comments_per_task=None, max_bytes=None):
+        self.max_tasks_per_section = max_tasks_per_section
+        self.max_description_length = max_description_length
+        self.max_comments_per_task = max_comments_per_task
+        self.max_bytes = max_bytes
 
-    log.info('Rendering HTML Template')
-    html = env.get_template(html_template)
-    if skip_inline_css:
-        rendered_html = html.render(
-            project=project, current_date=current_date,
-            current_time_utc=current_time_utc)
-    else:
-        rendered_html = premailer.transform(html.render(
-            project=project, current_date=current_date,
-            current_time_utc=current_time_utc))
+    def truncate_description(self, description):
+        max_length = self.max_description_length
+        if (description is None or max_length is None or
+                len(description) <= max_length):
+            return description
+        return description[:max_length].rstrip() + u'\u2026'
 
-    log.info('Rendering Text Template')
-    env.autoescape = False
-    plaintext = env.get_template(text_template)
-    rendered_plaintext = plaintext.render(
-        project=project, current_date=current_date,
-        current_time_utc=current_time_utc)
+    def truncate_comments(self, comments):
+        max_comments = self.max_comments_per_task
+        if not comments or max_comments is None:
+            return comments
+        return comments[-max_comments:] if max_comments else []
 
-    return (rendered_html, rendered_plaintext)
+    @staticmethod
+    def task_bytes(task):
+        '''The size in bytes of the text of a task.'''
+        text = [task.name, task.description or u'']
+        text.extend(
+            comment.get(u'text', u'') for comment in task.comments or ())
+        return sum(len(part.encode('utf-8')) for part in text)
 
+    def limit_bytes(self, sections):
+        '''Omits every task from the first that takes sections over max_bytes.
 
-def send_email(
-        project, mail_server, from_address, to_addresses, cc_addresses,
-        rendered_html, rendered_text, current_date, smtp_username=None,
-        smtp_password=None, smtp_port=None):
-    '''Sends an email using a Project and rendered templates.
+        :param sections: The sections, in the order they will be rendered
+        '''
+        total_bytes = 0
+        for section in sections:
+            for i, task in enumerate(section.tasks):
+                total_bytes += self.task_bytes(task)
+                if total_bytes > self.max_bytes:
+                    section.omitted_tasks += len(section.tasks) - i
+                    section.omitted_task_ids.extend(
+                        omitted.id for omitted in section.tasks[i:])
+                    del section.tasks[i:]
+                    break
+        if total_bytes > self.max_bytes:
+            log.info('Omitting tasks beyond {0} bytes'.format(self.max_bytes))
 
-    :param project: The Project instance for this email
-    :param mail_server: The hostname of the SMTP server to send mail from
-    :param from_address: The From: Address for the email to send
-    :param to_addresses: The list of To: addresses for the email to be sent to
-    :param cc_addresses: The list of Cc: addresses for the email to be sent to
-    :param rendered_html: The rendered HTML template
-    :param rendered_text: The rendered text template
-    :param current_date: The current date
-    :param smtp_username: The username to authenticate to SMTP server with
-    :param smtp_password: The password to authenticate to SMTP server with
-    :param smtp_port: The port to connect to the SMTP server with
+
+class TaskColumns(object):
+    '''A columnar copy of the tasks of a project, for summary statistics.
+
+    Each attribute used by ProjectStats is stored in an array, one item per
+    task in the order of the project's sections, so that statistics over tens
+    of thousands of tasks are simple passes over compact arrays rather than
+    template loops over Task objects:
+
+    * section: the index of the task's section in the project
+    * completed: 1 if the task is completed, otherwise 0
+    * completion_time: the completion time in seconds since the epoch, or
+      NaN if the task isn't completed
+    * due: the proleptic ordinal of the due date, or 0 if there isn't one
+    * assignee: the index of the assignee in assignees, or -1 if unassigned
+    * tag_masks: a bitmask of the indexes of the task's tags in tags (a list,
+      as there may be more tags than bits in an array item)
     '''
 
-    to_address_str = ', '.join(to_addresses)
-    if cc_addresses:
-        cc_address_str = ', '.join(cc_addresses)
-    else:
-        cc_address_str = ''
+    def __init__(self, project):
+        import array
+        import calendar
 
-    log.info('Preparing Email - From: ({0}) To: ({1}) Cc: ({2})'.format(
-        from_address, to_address_str, cc_address_str))
-    message = MIMEMultipart('alternative')
-    message['Subject'] = '{0} Daily Mailer {1}'.format(
-        project.name, current_date)
-    message['From'] = from_address
-    message['To'] = to_address_str
-    if cc_addresses:
-        message['Cc'] = cc_address_str
+        self.sections = [section.name for section in project.sections]
+        self.assignees = []
+        self.tags = []
+        assignee_indexes = {}
+        tag_bits = {}
+        self.section = array.array('l')
+        self.completed = array.array('b')
+        self.completion_time = array.array('d')
+        self.due = array.array('l')
+        self.assignee = array.array('l')
+        self.tag_masks = []
+        for section_index, section in enumerate(project.sections):
+            for task in section.tasks:
+                self.section.append(section_index)
+                self.completed.append(1 if task.completed else 0)
+                if task.completion_time is not None:
+                    self.completion_time.append(calendar.timegm(
+                        task.completion_time.utctimetuple()))
+                else:
+                    self.completion_time.append(float('nan'))
+                if task.due_date:
+                    self.due.append(datetime.datetime.strptime(
+                        task.due_date[:10], '%Y-%m-%d').toordinal())
+                else:
+                    self.due.append(0)
+                if task.assignee is None:
+                    self.assignee.append(-1)
+                else:
+                    if task.assignee not in assignee_indexes:
+                        assignee_indexes[task.assignee] = len(self.assignees)
+                        self.assignees.append(task.assignee)
+                    self.assignee.append(assignee_indexes[task.assignee])
+                mask = 0
+                for tag in task.tags:
+                    if tag not in tag_bits:
+                        tag_bits[tag] = 1 << len(self.tags)
+                        self.tags.append(tag)
+                    mask |= tag_bits[tag]
+                self.tag_masks.append(mask)
 
-    text_part = MIMEText(rendered_text.encode('utf-8'), 'plain')
-    html_part = MIMEText(rendered_html.encode('utf-8'), 'html')
+    def __len__(self):
+        return len(self.completed)
 
-    message.attach(text_part)
-    message.attach(html_part)
 
-    if cc_addresses:
-        to_addresses.extend(cc_addresses)
+class ProjectStats(object):
+    '''Summary statistics of a project, available to templates as stats.
 
-    try:
-        if (smtp_username is not None and smtp_password is not None):
-            if not smtp_port:
-                smtp_port = 465
-            log.info('Connecting to authenticated SMTP Server: {0}'.format(
-                mail_server))
-            smtp_conn = smtplib.SMTP_SSL(
-                mail_server, port=smtp_port, timeout=300)
-            log.info('Logging in to Email')
-            smtp_conn.ehlo()
-            smtp_conn.login(smtp_username, smtp_password)
-        else:
-            log.info(
-                'Connecting to anonymous SMTP Server: {0}'.format(mail_server))
-            smtp_conn = smtplib.SMTP(mail_server, timeout=300)
-            log.info('Sending Email')
-        smtp_conn.sendmail(from_address, to_addresses, message.as_string())
-        smtp_conn.quit()
-    except smtplib.SMTPException:
-        log.exception('Email could not be sent!')
+    The project's TaskColumns are only built the first time a statistic is
+    used, so templates that don't use any don't pay for them. Templates
+    rendered in shards are given the whole project's statistics, which are
+    pickled as just their columns (building them if they haven't been).
 
+    :param project: The Project, after any filtering
+    :param current_time_utc: The current time in UTC
+    '''
 
-def write_rendered_files(rendered_html, rendered_text, current_date):
-    '''Writes the rendered files out to disk.
+    def __init__(self, project, current_time_utc):
+        self.project = project
+        self.current_time_utc = current_time_utc
+        self._columns = None
 
-    Currently, this creates a AsanaMailer_[Date].html and *.markdown file.
+    def __getstate__(self):
+        return {
+            'project': None, 'current_time_utc': self.current_time_utc,
+            '_columns': self.columns}
 
-    :param rendered_html: The rendered HTML template.
-    :param rendered_text: The rendered text template.
-    :param current_date: The current date.
+    @property
+    def columns(self):
+        if self._columns is None:
+            self._columns = TaskColumns(self.project)
+        return self._columns
+
+    @property
+    def total(self):
+        '''The number of tasks.'''
+        return len(self.columns)
+
+    @property
+    def completed(self):
+        '''The number of completed tasks.'''
+        return sum(self.columns.completed)
+
+    @property
+    def overdue(self):
+        '''The number of incomplete tasks that are past their due date.'''
+        return sum(count for _, count in self.overdue_by_assignee())
+
+    def overdue_by_assignee(self):
+        '''Counts the incomplete tasks past their due date per assignee.
+
+        :return: A list of (assignee or None, count), most overdue first
+        '''
+        columns = self.columns
+        today = self.current_time_utc.date().toordinal()
+        counts = collections.Counter(
+            assignee for completed, due, assignee in zip(
+                columns.completed, columns.due, columns.assignee)
+            if not completed and 0 < due < today)
+        return sorted(
+            ((columns.assignees[assignee] if assignee >= 0 else None, count)
+             for assignee, count in counts.items()),
+            key=lambda item: (-item[1], item[0]))
+
+    def completion_by_section(self):
+        '''Counts the completed tasks per section.
+
+        :return: A list of (section name, completed, total, completion rate)
+        in the order of the sections
+        '''
+        columns = self.columns
+        completed = [0] * len(columns.sections)
+        totals = [0] * len(columns.sections)
+        for section, task_completed in zip(
+                columns.section, columns.completed):
+            completed[section] += task_completed
+            totals[section] += 1
+        return [
+            (name, completed[index], totals[index],
+             completed[index] / float(totals[index]) if totals[index] else 0)
+            for index, name in enumerate(columns.sections)]
+
+    def tagged(self, tag):
+        '''The number of tasks with a tag.'''
+        columns = self.columns
+        if tag not in columns.tags:
+            return 0
+        bit = 1 << columns.tags.index(tag)
+        return sum(1 for mask in columns.tag_masks if mask & bit)
+
+    def burndown(self, hours, steps=6):
+        '''Counts the open tasks at evenly spaced times over the past hours.
+
+        Tasks completed before the completed lookback of the run aren't
+        fetched, so the window should be within it.
+
+        :param hours: The number of hours to look back over
+        :param steps: The number of intervals to split the window into
+        :return: A list of steps + 1 (time, number of open tasks) tuples,
+        oldest first and ending at the current time
+        '''
+        import bisect
+        import calendar
+
+        now = calendar.timegm(self.current_time_utc.utctimetuple())
+        # NaN compares false, so incomplete tasks are never counted as closed
+        completion_times = sorted(
+            time for time in self.columns.completion_time if time <= now)
+        burndown = []
+        for step in range(steps + 1):
+            seconds_ago = hours * 3600.0 * (steps - step) / steps
+            when = now - seconds_ago
+            closed = bisect.bisect_right(completion_times, when)
+            burndown.append((
+                self.current_time_utc - datetime.timedelta(
+                    seconds=seconds_ago),
+                self.total - closed))
+        return burndown
+
+
+class Deadline(object):
+    '''A time budget for a run, starting when it's created.
+
+    Fetching stops at the deadline's fetch time, reserve seconds before the
+    end, leaving that long to render and send with what has been fetched.
+
+    :param seconds: The number of seconds the run has
+    :param reserve: The number of seconds to keep for rendering and sending,
+    by default DEFAULT_DEADLINE_RESERVE or a quarter of the budget if that's
+    less
     '''
-    with codecs.open(
-            'AsanaMailer_{0}.html'.format(current_date), 'w', 'utf-8') as (
-            html_file):
-        log.info('Writing HTML File')
-        html_file.write(rendered_html)
-    with codecs.open(
-            'AsanaMailer_{0}.markdown'.format(current_date), 'w', 'utf-8') as (
-            markdown_file):
-        log.info('Writing Text File')
-        markdown_file.write(rendered_text)
 
+    def __init__(self, seconds, reserve=None):
+        if reserve is None:
+            reserve = min(DEFAULT_DEADLINE_RESERVE, seconds / 4.0)
+        self.end = time.time() + seconds
+        self.fetch_end = self.end - reserve
+        # The number of tasks whose comments weren't fetched, and their ids
+        self.missed = 0
+        self.missed_task_ids = set()
 
-def create_cli_parser():
+    def remaining(self):
+        '''The number of seconds left until the deadline.'''
+        return self.end - time.time()
+
+    def can_fetch(self):
+        '''Whether there's still time to fetch from Asana.'''
+        return time.time() < self.fetch_end
+
+    def smtp_timeout(self):
+        '''The SMTP timeout to use, to give up at about the deadline.'''
+        return max(min(SMTP_TIMEOUT, self.remaining()), MIN_SMTP_TIMEOUT)
+
+
+def fetch_project(
+        asana_client, project_id, current_time_utc,
+        completed_lookback_hours=None, prefetch_pages=False):
+    '''Fetches a project and its tasks.
+
+    :param asana_client: The Asana client to make the API calls with
+    :param project_id: The Asana Project ID
+    :param current_time_utc: The current time in UTC
+    :param completed_lookback_hours: An amount in hours to look back for
+    completed tasks
+    :param prefetch_pages: Whether to return the tasks as an iterator that
+    downloads the next page of tasks in the background while the current one
+    is processed, rather than as a list once every page has been downloaded
+    :return: A (project JSON, list or iterator of task JSON) tuple
+    '''
+    project_json = asana_client.projects.find_by_id(project_id)
+
+    tasks_params = {}
+    if completed_lookback_hours:
+        completed_since = (current_time_utc - datetime.timedelta(
+            hours=completed_lookback_hours)).replace(
+                microsecond=0).isoformat()
+        log.info(
+            'Retaining tasks completed since {0}'.format(completed_since))
+    else:
+        completed_since = 'now'
+    tasks_params['completed_since'] = completed_since
+    project_tasks_json = asana_client.projects.tasks(
+        project_id, params=tasks_params, expand='.')
+    if prefetch_pages:
+        return project_json, prefetch(project_tasks_json, ASANA_PAGE_SIZE)
+    return project_json, list(project_tasks_json)
+
+
+def prefetch(items, size):
+    '''Iterates over items in a background thread, keeping up to size items
+    ahead of the caller.
+
+    Iterating over an Asana collection downloads its next page once the
+    items of the current one run out, so with size a page of items, the next
+    page downloads while the caller processes the current one. Exceptions
+    raised by iterating over items are raised to the caller.
+
+    :return: An iterator over the items
+    '''
+    import Queue
+
+    queue = Queue.Queue(size)
+    stopped = threading.Event()
+    done = object()
+
+    def put(entry):
+        # Stop once the caller stops iterating, rather than block forever
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception:
+            put((done, sys.exc_info()))
+        else:
+            put((done, None))
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, exc_info = queue.get()
+            if item is done:
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def select_tasks(
+        project_tasks_json, task_filters=None, section_filters=None,
+        max_tasks_per_section=None):
+    '''Selects the tasks of a project that pass the filters.
+
+    Only the tasks that pass the filters (and every section header) are
+    selected to be created, so that limits apply to the tasks that will be
+    shown, and comments are only fetched for those tasks. Tasks beyond
+    max_tasks_per_section are still selected, to be counted in their
+    section's omitted tasks, but their comments aren't fetched.
+
+    :param project_tasks_json: The JSON object for a Project's tasks in Asana
+    :param task_filters: A set of tags that tasks must all have
+    :param section_filters: A set of the section names to keep tasks of
+    :param max_tasks_per_section: The number of tasks per section to fetch
+    comments for, as DigestLimits.max_tasks_per_section
+    :return: A (list of task JSON to create, list of (task id, modified_at)
+    of the tasks to fetch comments for) tuple
+    '''
+    selected_tasks_json = []
+    tasks_to_fetch = list(iter_select_tasks(
+        project_tasks_json, selected_tasks_json, task_filters,
+        section_filters, max_tasks_per_section))
+    return selected_tasks_json, tasks_to_fetch
+
+
+def iter_select_tasks(
+        project_tasks_json, selected_tasks_json, task_filters=None,
+        section_filters=None, max_tasks_per_section=None):
+    '''Selects the tasks of a project that pass the filters as they arrive.
+
+    This is select_tasks for an iterator of tasks, so that the comments of
+    the tasks selected so far can be fetched while more are downloaded.
+
+    :param selected_tasks_json: The list to append the task JSON to create to
+    :return: An iterator of the (task id, modified_at) of the tasks to fetch
+    comments for
+    '''
+    current_section = None
+    section_tasks = 0
+    for task in project_tasks_json:
+        is_section = task[u'name'].endswith(':')
+        if is_section:
+            current_section = task[u'name']
+            section_tasks = 0
+            selected_tasks_json.append(task)
+        # Optimize calls to API
+        if section_filters and current_section not in section_filters:
+            continue
+        tag_names = frozenset((tag[u'name'] for tag in task[u'tags']))
+        if task_filters and not tag_names >= task_filters:
+            continue
+        if not is_section:
+            selected_tasks_json.append(task)
+            section_tasks += 1
+            # The task is only counted in its section's omitted tasks
+            if (max_tasks_per_section is not None and
+                    section_tasks > max_tasks_per_section):
+                continue
+        yield unicode(task[u'id']), task.get(u'modified_at')
+
+
+def fetch_comments(
+        asana_client, tasks, story_cache=None, workers=1, comment_window=None,
+        deadline=None):
+    '''Fetches the comments of tasks, concurrently.
+
+    Tasks are fetched as they're drawn from tasks, so when tasks is an
+    iterator (say, of the tasks selected from a page while the next downloads)
+    their comments are fetched while more tasks arrive.
+
+    :param asana_client: The Asana client to make the API calls with
+    :param tasks: A list or iterator of (task id, modified_at) of the tasks
+    :param story_cache: An optional StoryCache used to reuse the comments of
+    tasks that haven't been modified since they were last fetched
+    :param workers: The number of tasks to fetch comments for concurrently
+    :param comment_window: An optional CommentWindow to select the comments
+    to keep with (the story cache keeps every comment)
+    :param deadline: An optional Deadline. The most recently modified tasks
+    are fetched first (so every task is drawn before any is fetched), and
+    once it's past the deadline's fetch time the rest are counted in its
+    missed count (and added to its missed_task_ids) instead of being fetched
+    :return: A dict of task id to the task's comments, for the tasks that
+    have any
+    '''
+    task_comments = {}
+    counts = collections.Counter()
+
+    def keep(task_id, current_task_comments):
+        if comment_window is not None:
+            current_task_comments = comment_window.select(
+                current_task_comments)
+        if current_task_comments:
+            task_comments[task_id] = current_task_comments
+
+    def uncached(tasks):
+        for task_id, modified_at in tasks:
+            counts['tasks'] += 1
+            if story_cache is not None:
+                current_task_comments = story_cache.get(task_id, modified_at)
+                if current_task_comments is not None:
+                    counts['cached'] += 1
+                    keep(task_id, current_task_comments)
+                    continue
+            yield task_id, modified_at
+
+    tasks_to_fetch = uncached(tasks)
+    if deadline is not None:
+        # Timestamps in the same format sort chronologically
+        tasks_to_fetch = sorted(
+            tasks_to_fetch, key=lambda task: task[1] or u'', reverse=True)
+
+    def fetch(task):
+        task_id, modified_at = task
+        if deadline is not None and not deadline.can_fetch():
+            return None
+        if story_cache is not None:
+            # Another mailer may be fetching the same task
+            current_task_comments = story_cache.claim(
+                task_id, modified_at, deadline)
+            if current_task_comments is not None:
+                return current_task_comments
+        current_task_comments = fetch_task_comments(asana_client, task_id)
+        if story_cache is not None:
+            story_cache.set(task_id, modified_at, current_task_comments)
+        return current_task_comments
+
+    log.info('Starting API Calls for Task Comments')
+    missed = 0
+    with span('fetch_comments') as fields:
+        for (task_id, _), current_task_comments in imap_concurrently(
+                fetch, tasks_to_fetch, workers):
+            if current_task_comments is None:
+                missed += 1
+                deadline.missed_task_ids.add(task_id)
+                continue
+            keep(task_id, current_task_comments)
+        fetched = counts['tasks'] - counts['cached']
+        fields.update(
+            tasks=counts['tasks'], cached=counts['cached'],
+            fetched=fetched - missed, missed=missed)
+    if missed:
+        log.warning(
+            'Reached the deadline, not fetching comments for {0} of {1} '
+            'tasks'.format(missed, fetched))
+        deadline.missed += missed
+    return task_comments
+
+
+def fetch_task_comments(asana_client, task_id):
+    '''Fetches the comments of a task, leaving out its other stories.
+
+    :param asana_client: The Asana client to make the API call with
+    :param task_id: The Asana Task ID
+    :return: The list of comments (stories) for the task
+    '''
+    log.debug('Getting task comments for task: %s', task_id)
+    task_stories = asana_client.tasks.stories(task_id)
+    return [story for story in task_stories if story[u'type'] == u'comment']
+
+
+def fetch_subtasks(
+        asana_client, tasks, depth, workers=1, subtask_cache=None,
+        deadline=None):
+    '''Fetches the subtasks of tasks, down to depth levels.
+
+    The tree is walked a level at a time, each level's tasks being fetched
+    concurrently. Each task is only fetched once however many parents it has,
+    and with a subtask_cache, only once per modification across runs and
+    projects, so the number of calls stays linear in the number of unique
+    tasks.
+
+    :param asana_client: The Asana client to make the API calls with
+    :param tasks: A list of (task id, modified_at) of the top level tasks
+    :param depth: The number of levels of subtasks to fetch
+    :param workers: The number of tasks to fetch subtasks for concurrently
+    :param subtask_cache: An optional StoryCache of the subtasks of tasks
+    :param deadline: An optional Deadline, past whose fetch time fetches by
+    other processes sharing the subtask_cache are no longer waited for
+    :return: A dict of task id to the list of the task's subtasks' JSON
+    '''
+    subtasks_json = {}
+    seen = set(task_id for task_id, _ in tasks)
+    level = tasks
+    for _ in range(depth):
+        if not level:
+            break
+        to_fetch = []
+        for task_id, modified_at in level:
+            cached = None
+            if subtask_cache is not None:
+                cached = subtask_cache.get(task_id, modified_at)
+            if cached is not None:
+                subtasks_json[task_id] = cached
+            else:
+                to_fetch.append((task_id, modified_at))
+
+        def fetch(task):
+            task_id, modified_at = task
+            if subtask_cache is not None:
+                fetched = subtask_cache.claim(task_id, modified_at, deadline)
+                if fetched is not None:
+                    return fetched
+            log.debug('Getting subtasks for task: %s', task_id)
+            fetched = list(asana_client.tasks.subtasks(task_id, expand='.'))
+            if subtask_cache is not None:
+                subtask_cache.set(task_id, modified_at, fetched)
+            return fetched
+
+        with span(
+                'fetch_subtasks', tasks=len(level),
+                cached=len(level) - len(to_fetch)):
+            for (task_id, _), fetched in zip(
+                    to_fetch, map_concurrently(fetch, to_fetch, workers)):
+                subtasks_json[task_id] = fetched
+
+        next_level = []
+        for task_id, _ in level:
+            for subtask in subtasks_json[task_id]:
+                subtask_id = unicode(subtask[u'id'])
+                if subtask_id not in seen:
+                    seen.add(subtask_id)
+                    next_level.append(
+                        (subtask_id, subtask.get(u'modified_at')))
+        level = next_level
+    return subtasks_json
+
+
+def map_concurrently(function, items, workers):
+    '''Maps a function over items using a pool of up to workers threads.
+
+    This suits functions that spend their time waiting on the network, such
+    as API calls. With a single worker (or item) it maps in this thread.
+
+    :return: The list of results, in the order of items
+    '''
+    items = list(items)
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [function(item) for item in items]
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def imap_concurrently(function, items, workers):
+    '''Maps a function over items using a pool of up to workers threads,
+    starting on each item as soon as it's drawn from items.
+
+    Unlike map_concurrently, items can be an iterator that's slow to produce
+    (e.g. as pages download): items are drawn in this thread, so the calls
+    for earlier items run while later ones are produced.
+
+    :return: An iterator of (item, result) pairs, in the order of items
+    '''
+    if workers <= 1:
+        for item in items:
+            yield item, function(item)
+        return
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(workers)
+    try:
+        results = [
+            (item, pool.apply_async(function, (item,))) for item in items]
+        for item, result in results:
+            yield item, result.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def create_asana_client(pat, workers=1, prefetch_pages=False):
+    '''Creates an Asana client with an HTTP session tuned for the mailer.
+
+    The session keeps enough pooled keep-alive connections for every worker
+    to reuse its connection (and TLS session) rather than opening a new one
+    per request, asks for gzip compressed responses and fetches collections
+    in pages of ASANA_PAGE_SIZE items.
+
+    :param pat: The Asana personal access token
+    :param workers: The number of threads that will share the client
+    :param prefetch_pages: Whether a project's task pages are downloaded (see
+    prefetch) alongside the workers, needing a connection of their own
+    :return: The Asana client
+    '''
+    import asana
+    import requests.adapters
+
+    pool_maxsize = max(workers, 1)
+    if prefetch_pages:
+        pool_maxsize += 1
+    asana_client = asana.Client.access_token(pat)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_maxsize)
+    asana_client.session.mount('https://', adapter)
+    asana_client.session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive'
+    })
+    asana_client.options['page_size'] = ASANA_PAGE_SIZE
+    return asana_client
+
+
+def connection_stats(asana_client, since=None):
+    '''Counts the requests an Asana client made and the connections it opened.
+
+    The counts are for the client's lifetime, which for a client reused
+    between runs (as by the daemon) spans all of them, so a run passes the
+    stats from before it as since to count its own.
+
+    :param since: Optional stats from an earlier call, to only count the
+    requests and connections made after it
+    :return: A dict of the number of 'requests', 'connections' and 'reused'
+    connections (requests that didn't need a new connection)
+    '''
+    adapter = asana_client.session.get_adapter(ASANA_BASE_URL)
+    pools = adapter.poolmanager.pools
+    stats = {'requests': 0, 'connections': 0}
+    for key in pools.keys():
+        pool = pools[key]
+        stats['requests'] += pool.num_requests
+        stats['connections'] += pool.num_connections
+    if since is not None:
+        stats['requests'] -= since['requests']
+        stats['connections'] -= since['connections']
+    stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+    return stats
+
+
+class CassetteResource(object):
+    '''Stands in for an Asana client resource, such as client.tasks.
+
+    Calling any method of the resource calls the cassette client's call method
+    with the resource and method names.
+    '''
+
+    def __init__(self, cassette_client, name):
+        self.cassette_client = cassette_client
+        self.name = name
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            return self.cassette_client.call(self.name, method, args, kwargs)
+        return call
+
+
+def cassette_key(resource, method, args, kwargs):
+    '''Identifies an Asana API call by its resource, method and arguments.'''
+    return json.dumps(
+        [resource, method, list(args), kwargs], sort_keys=True,
+        separators=(',', ':'))
+
+
+class RecordingAsanaClient(object):
+    '''Wraps an Asana client, recording the calls made through it.
+
+    Every response is recorded along with how long it took, so that
+    ReplayAsanaClient can serve them back with the same latencies. Collection
+    responses are read in full when recorded.
+
+    :param asana_client: The Asana client to make the calls with
+    :param current_time_utc: The current time of the run being recorded,
+    which replays reuse as the calls' parameters can depend on it
+    '''
+
+    def __init__(self, asana_client, current_time_utc=None):
+        self.asana_client = asana_client
+        self.current_time_utc = current_time_utc
+        self.session = getattr(asana_client, 'session', None)
+        self.projects = CassetteResource(self, 'projects')
+        self.tasks = CassetteResource(self, 'tasks')
+        self.interactions = []
+        self.lock = threading.Lock()
+
+    def call(self, resource, method, args, kwargs):
+        start = time.time()
+        response = getattr(getattr(self.asana_client, resource), method)(
+            *args, **kwargs)
+        if not isinstance(response, dict):
+            response = list(response)
+        latency = time.time() - start
+        with self.lock:
+            self.interactions.append({
+                u'request': cassette_key(resource, method, args, kwargs),
+                u'response': response,
+                u'latency': latency
+            })
+        return response
+
+    def save(self, cassette_path):
+        '''Writes the recorded calls out to a compressed cassette file.'''
+        log.info('Writing {0} recorded Asana calls to {1}'.format(
+            len(self.interactions), cassette_path))
+        cassette = {
+            u'version': CASSETTE_VERSION,
+            u'current_time_utc': (
+                self.current_time_utc.isoformat()
+                if self.current_time_utc is not None else None),
+            u'interactions': self.interactions
+        }
+        with open(cassette_path, 'wb') as cassette_file:
+            cassette_file.write(zlib.compress(
+                json.dumps(cassette, separators=(',', ':'))))
+
+
+class ReplayAsanaClient(object):
+    '''Serves the calls recorded by RecordingAsanaClient back, offline.
+
+    Each call sleeps for its recorded latency multiplied by latency_scale
+    before returning its response, so that fetch strategies can be compared
+    on real-shaped data. Calls that were made more than once are served their
+    responses in the order they were recorded, the last being repeated.
+
+    :param cassette_path: The filename of the cassette to replay
+    :param latency_scale: The factor to scale recorded latencies by, 0 to
+    respond immediately
+    '''
+
+    def __init__(self, cassette_path, latency_scale=1.0):
+        import dateutil.parser
+
+        log.info('Replaying Asana calls from {0}'.format(cassette_path))
+        with open(cassette_path, 'rb') as cassette_file:
+            cassette = json.loads(zlib.decompress(cassette_file.read()))
+        if cassette.get(u'version') != CASSETTE_VERSION:
+            raise ValueError(
+                'Unsupported cassette version: {0}'.format(
+                    cassette.get(u'version')))
+        self.current_time_utc = cassette.get(u'current_time_utc')
+        if self.current_time_utc is not None:
+            self.current_time_utc = dateutil.parser.parse(
+                self.current_time_utc)
+        self.responses = collections.defaultdict(collections.deque)
+        for interaction in cassette[u'interactions']:
+            self.responses[interaction[u'request']].append(
+                (interaction[u'response'], interaction[u'latency']))
+        self.latency_scale = latency_scale
+        self.projects = CassetteResource(self, 'projects')
+        self.tasks = CassetteResource(self, 'tasks')
+        self.lock = threading.Lock()
+
+    def call(self, resource, method, args, kwargs):
+        key = cassette_key(resource, method, args, kwargs)
+        with self.lock:
+            recorded = self.responses.get(key)
+            if not recorded:
+                raise LookupError(
+                    'No recorded response for Asana call: {0}'.format(key))
+            response, latency = (
+                recorded.popleft() if len(recorded) > 1 else recorded[0])
+        if latency and self.latency_scale:
+            time.sleep(latency * self.latency_scale)
+        return response
+
+
+class ProjectStore(object):
+    '''An on-disk store of the Asana data of projects.
+
+    Each project is stored in store_dir/[Project ID].store as zlib compressed
+    JSON of the project, its tasks and every task's comments, as fetched from
+    Asana. The store is kept up to date by the webhook command, so that mail
+    runs can read projects from it (with --from-store) rather than fetching
+    them when they are sent.
+
+    :param store_dir: The directory of the store, created when it's written
+    '''
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def path(self, project_id, extension='store'):
+        return os.path.join(
+            self.store_dir, '{0}.{1}'.format(project_id, extension))
+
+    def load(self, project_id):
+        '''Loads the stored data of a project.
+
+        :return: A dict of the project JSON (project), its tasks' JSON
+        (tasks), a dict of task id to [modified_at, comments] (comments) and
+        the completed lookback the tasks were fetched with, or None if the
+        project isn't stored
+        '''
+        try:
+            with open(self.path(project_id), 'rb') as store_file:
+                state = json.loads(zlib.decompress(store_file.read()))
+        except IOError:
+            return None
+        if state.get(u'version') != STORE_VERSION:
+            raise ValueError('Unsupported store version: {0}'.format(
+                state.get(u'version')))
+        return state
+
+    def save(self, project_id, state):
+        '''Saves the data of a project, replacing it atomically.'''
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        state[u'version'] = STORE_VERSION
+        store_path = self.path(project_id)
+        temp_path = '{0}.tmp'.format(store_path)
+        with open(temp_path, 'wb') as store_file:
+            store_file.write(zlib.compress(
+                json.dumps(state, separators=(',', ':'))))
+        os.rename(temp_path, store_path)
+
+    def sync_project(
+            self, asana_client, project_id, current_time_utc,
+            completed_lookback_hours=None, workers=1, stale_task_ids=(),
+            task_ids=None):
+        '''Fetches a project's tasks into the store.
+
+        Only the comments of tasks that were modified since they were stored
+        (or are in stale_task_ids) are fetched again. With task_ids, only
+        those tasks are fetched again rather than the project's whole task
+        list, unless one of them is new to the store.
+
+        :param asana_client: The Asana client to make the API calls with
+        :param project_id: The Asana Project ID
+        :param current_time_utc: The current time in UTC
+        :param completed_lookback_hours: An amount in hours to look back for
+        completed tasks, which should cover that of the mail runs
+        :param workers: The number of tasks to fetch comments for concurrently
+        :param stale_task_ids: The ids of tasks to fetch the comments of
+        whether or not they were modified
+        :param task_ids: The ids of the tasks that changed, or None to fetch
+        every task of the project
+        '''
+        log.info('Syncing project {0} to the store'.format(project_id))
+        state = self.load(project_id)
+        project_tasks_json = None
+        if (task_ids is not None and state is not None and
+                state[u'completed_lookback_hours'] ==
+                completed_lookback_hours):
+            project_json = state[u'project']
+            project_tasks_json = self.refetch_tasks(
+                asana_client, project_id, state[u'tasks'], task_ids, workers)
+        if project_tasks_json is None:
+            project_json, project_tasks_json = fetch_project(
+                asana_client, project_id, current_time_utc,
+                completed_lookback_hours)
+        tasks = [
+            (unicode(task[u'id']), task.get(u'modified_at'))
+            for task in project_tasks_json]
+        story_cache = StoryCache(max_entries=len(tasks))
+        if state is not None:
+            for task_id, (modified_at, comments) in (
+                    state[u'comments'].items()):
+                if task_id not in stale_task_ids:
+                    story_cache.set(task_id, modified_at, comments)
+        task_comments = fetch_comments(
+            asana_client, tasks, story_cache, workers)
+        self.save(project_id, {
+            u'project': project_json,
+            u'tasks': project_tasks_json,
+            u'comments': dict(
+                (task_id, [modified_at, task_comments.get(task_id, [])])
+                for task_id, modified_at in tasks),
+            u'completed_lookback_hours': completed_lookback_hours,
+            u'synced_at': current_time_utc.isoformat()})
+
+    @staticmethod
+    def refetch_tasks(asana_client, project_id, tasks_json, task_ids, workers):
+        '''Fetches the given tasks again, in place of their stored JSON.
+
+        Tasks that were deleted or removed from the project are dropped.
+
+        :return: The updated list of the project's task JSON, or None if a
+        task isn't stored, as its place in the project (and so its section)
+        is only known from the project's task list
+        '''
+        import asana.error
+
+        positions = dict(
+            (unicode(task[u'id']), i) for i, task in enumerate(tasks_json))
+        task_ids = list(task_ids)
+        if any(task_id not in positions for task_id in task_ids):
+            return None
+
+        def fetch(task_id):
+            log.debug('Getting task: %s', task_id)
+            try:
+                return asana_client.tasks.find_by_id(task_id)
+            except asana.error.NotFoundError:
+                return None
+
+        tasks_json = list(tasks_json)
+        removed = set()
+        for task_id, task_json in zip(
+                task_ids, map_concurrently(fetch, task_ids, workers)):
+            if task_json is None or (
+                    u'projects' in task_json and project_id not in [
+                        event_id(project)
+                        for project in task_json[u'projects']]):
+                removed.add(task_id)
+            else:
+                tasks_json[positions[task_id]] = task_json
+        return [
+            task for task in tasks_json
+            if unicode(task[u'id']) not in removed]
+
+
+class StoreAsanaClient(object):
+    '''Serves Asana API calls for the projects in a ProjectStore.
+
+    Projects, their tasks and the tasks' comments are read from the store.
+    Any other call (such as for subtasks), or a call for a project that isn't
+    in the store, is made with the asana_client if one is given.
+
+    :param store: The ProjectStore to read projects from
+    :param asana_client: An optional Asana client to fall back to
+    '''
+
+    def __init__(self, store, asana_client=None):
+        self.store = store
+        self.asana_client = asana_client
+        self.states = {}
+        self.task_comments = {}
+        self.projects = CassetteResource(self, 'projects')
+        self.tasks = CassetteResource(self, 'tasks')
+        self.lock = threading.Lock()
+
+    def load(self, project_id):
+        with self.lock:
+            if project_id not in self.states:
+                state = self.store.load(project_id)
+                if state is not None:
+                    for task_id, (_, comments) in state[u'comments'].items():
+                        self.task_comments[task_id] = comments
+                self.states[project_id] = state
+            return self.states[project_id]
+
+    def tasks_of_project(self, state, completed_since):
+        '''Selects the stored tasks Asana would return for completed_since.'''
+        import dateutil.parser
+
+        if completed_since == 'now':
+            return [task for task in state[u'tasks'] if not task[u'completed']]
+        completed_since = dateutil.parser.parse(completed_since)
+        lookback = state.get(u'completed_lookback_hours')
+        if lookback is None or (
+                dateutil.parser.parse(state[u'synced_at']) -
+                datetime.timedelta(hours=lookback) > completed_since):
+            log.warning(
+                'The store only has the tasks completed within {0} hours of '
+                'its last sync'.format(lookback or 0))
+        return [
+            task for task in state[u'tasks'] if not task[u'completed'] or (
+                dateutil.parser.parse(task[u'completed_at']) >=
+                completed_since)]
+
+    def call(self, resource, method, args, kwargs):
+        if resource == 'projects' and method in ('find_by_id', 'tasks'):
+            state = self.load(args[0])
+            if state is not None:
+                if method == 'find_by_id':
+                    return state[u'project']
+                return self.tasks_of_project(
+                    state, kwargs['params']['completed_since'])
+        elif (resource == 'tasks' and method == 'stories' and
+                args[0] in self.task_comments):
+            return self.task_comments[args[0]]
+        if self.asana_client is None:
+            raise LookupError('{0}.{1} {2} is not in the store'.format(
+                resource, method, args))
+        return getattr(getattr(self.asana_client, resource), method)(
+            *args, **kwargs)
+
+
+class StoryCache(object):
+    '''An in-memory, size bounded cache of task comments.
+
+    Entries are keyed by task id and are only valid for the task's modified_at
+    timestamp; Asana bumps modified_at when a comment is added, so a changed
+    timestamp means the task's stories have to be fetched again. The least
+    recently used entries are evicted once max_entries is reached.
+
+    Subtasks can change without their parent's modified_at changing, so a
+    cache of subtasks is given a ttl, the number of seconds after which its
+    entries are fetched again whatever their modified_at.
+    '''
+
+    def __init__(self, max_entries=DEFAULT_STORY_CACHE_SIZE, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, task_id, modified_at):
+        '''Returns the cached comments for a task, or None on a miss.
+
+        :param task_id: The Asana Task ID
+        :param modified_at: The task's current modified_at timestamp
+        '''
+        if modified_at is None:
+            return None
+        with self.lock:
+            entry = self.entries.pop(task_id, None)
+            if entry is None:
+                return None
+            self.entries[task_id] = entry
+        cached_modified_at, fetched_at, comments = entry
+        if cached_modified_at != modified_at:
+            return None
+        if self.ttl is not None and fetched_at < time.time() - self.ttl:
+            return None
+        return comments
+
+    def set(self, task_id, modified_at, comments):
+        '''Stores the comments for a task at a given modified_at timestamp.
+
+        :param task_id: The Asana Task ID
+        :param modified_at: The task's modified_at timestamp
+        :param comments: The list of comments (stories) for the task
+        '''
+        if modified_at is None:
+            return
+        with self.lock:
+            self.entries.pop(task_id, None)
+            self.entries[task_id] = (modified_at, time.time(), comments)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def claim(self, task_id, modified_at, deadline=None):
+        '''Claims fetching the comments of a task that missed the cache.
+
+        Within a process each task is only fetched once, so there is nothing
+        to wait for and the caller always fetches.
+
+        :return: None, for the caller to fetch and set the comments
+        '''
+        return None
+
+
+class SharedStoryCache(object):
+    '''A cache of task comments (or subtasks) in a SQLite file, shared by the
+    mailer processes on a host.
+
+    Like StoryCache, entries are only valid for the task's modified_at
+    timestamp, and they also expire ttl seconds after being fetched. As
+    subtasks can change without their parent's modified_at changing, the ttl
+    bounds how stale they get. The database is in WAL mode, so processes read
+    while another writes.
+
+    Processes that miss the cache for the same task at the same time claim it
+    first, and only the process whose claim succeeds fetches it; the others
+    wait for it to be stored. Claims expire after claim_timeout seconds, so a
+    process that dies mid-fetch only delays the others.
+
+    :param path: The SQLite file, created if it doesn't exist
+    :param kind: The kind of entries, e.g. 'stories' or 'subtasks', so that
+    caches of each kind can share a file
+    :param ttl: The number of seconds entries stay valid, or None for as long
+    as their modified_at
+    :param claim_timeout: The number of seconds to wait for another process's
+    fetch of a task
+    '''
+
+    def __init__(
+            self, path, kind='stories', ttl=DEFAULT_SHARED_CACHE_TTL,
+            claim_timeout=SHARED_CACHE_CLAIM_TIMEOUT):
+        import sqlite3
+
+        self.kind = kind
+        self.ttl = ttl
+        self.claim_timeout = claim_timeout
+        self.lock = threading.Lock()
+        # The connection is shared by the fetch workers, behind the lock
+        self.connection = sqlite3.connect(
+            path, timeout=claim_timeout, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries (kind TEXT, task_id TEXT, '
+                'modified_at TEXT, fetched_at REAL, data BLOB, '
+                'PRIMARY KEY (kind, task_id))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS claims (kind TEXT, task_id TEXT, '
+                'claimed_at REAL, PRIMARY KEY (kind, task_id))')
+            if ttl is not None:
+                self.connection.execute(
+                    'DELETE FROM entries WHERE kind = ? AND fetched_at < ?',
+                    (kind, time.time() - ttl))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get(self, task_id, modified_at):
+        '''Returns the cached comments for a task, or None on a miss.
+
+        :param task_id: The Asana Task ID
+        :param modified_at: The task's current modified_at timestamp
+        '''
+        if modified_at is None:
+            return None
+        with self.lock:
+            # Reading every row closes the cursor, which would otherwise hold
+            # on to its snapshot of the database
+            rows = self.connection.execute(
+                'SELECT modified_at, fetched_at, data FROM entries '
+                'WHERE kind = ? AND task_id = ?',
+                (self.kind, unicode(task_id))).fetchall()
+        row = rows[0] if rows else None
+        if row is None or row[0] != modified_at:
+            return None
+        if self.ttl is not None and row[1] < time.time() - self.ttl:
+            return None
+        return json.loads(zlib.decompress(bytes(row[2])).decode('utf-8'))
+
+    def set(self, task_id, modified_at, comments):
+        '''Stores the comments for a task, releasing any claim on it.
+
+        :param task_id: The Asana Task ID
+        :param modified_at: The task's modified_at timestamp
+        :param comments: The list of comments (stories) for the task
+        '''
+        import sqlite3
+
+        if modified_at is None:
+            return
+        data = sqlite3.Binary(zlib.compress(json.dumps(comments).encode(
+            'utf-8')))
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                (self.kind, unicode(task_id), modified_at, time.time(), data))
+            self.connection.execute(
+                'DELETE FROM claims WHERE kind = ? AND task_id = ?',
+                (self.kind, unicode(task_id)))
+
+    def claim(self, task_id, modified_at, deadline=None):
+        '''Claims fetching the comments of a task that missed the cache.
+
+        If another process holds the claim, waits for it to store the
+        comments (or for its claim to expire, or for the deadline's fetch
+        time to pass).
+
+        :param deadline: An optional Deadline to stop waiting at
+        :return: The comments, if another process stored them while waiting,
+        otherwise None for the caller to fetch and set them
+        '''
+        if modified_at is None:
+            return None
+        give_up = time.time() + self.claim_timeout
+        while True:
+            # Check for the comments first, as storing them releases the claim
+            comments = self.get(task_id, modified_at)
+            if comments is not None:
+                return comments
+            now = time.time()
+            with self.lock, self.connection:
+                self.connection.execute(
+                    'DELETE FROM claims WHERE kind = ? AND task_id = ? AND '
+                    'claimed_at < ?',
+                    (self.kind, unicode(task_id), now - self.claim_timeout))
+                claimed = self.connection.execute(
+                    'INSERT OR IGNORE INTO claims VALUES (?, ?, ?)',
+                    (self.kind, unicode(task_id), now)).rowcount == 1
+            if claimed:
+                # The comments may have been stored just before the claim
+                comments = self.get(task_id, modified_at)
+                if comments is not None:
+                    with self.lock, self.connection:
+                        self.connection.execute(
+                            'DELETE FROM claims WHERE kind = ? AND '
+                            'task_id = ?', (self.kind, unicode(task_id)))
+                return comments
+            if now >= give_up or (
+                    deadline is not None and not deadline.can_fetch()):
+                return None
+            time.sleep(SHARED_CACHE_POLL_INTERVAL)
+
+
+class MemoryTracer(object):
+    '''Records memory use at the end of each phase of a mailer run.
+
+    With tracemalloc (Python 3.4+, or the pytracemalloc backport) each phase
+    records the current and peak traced memory, and the allocation sites that
+    grew the most during the phase. Otherwise only the peak resident memory
+    of the process is recorded, from the resource module.
+
+    :param top: The number of allocation sites to record per phase
+    '''
+
+    def __init__(self, top=10):
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        self.tracemalloc = tracemalloc
+        self.top = top
+        self.phases = []
+        self.snapshot = None
+
+    def start(self):
+        if self.tracemalloc is not None:
+            self.tracemalloc.start()
+            self.snapshot = self.tracemalloc.take_snapshot()
+
+    def stop(self):
+        if self.tracemalloc is not None:
+            self.tracemalloc.stop()
+            self.snapshot = None
+
+    @staticmethod
+    def max_rss():
+        '''The peak resident memory of the process in bytes.'''
+        import resource
+
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+    def phase(self, name):
+        '''Records memory use at the end of a phase.
+
+        :param name: The name of the phase that just ended
+        '''
+        phase = {'name': name, 'current': None, 'top': []}
+        if self.snapshot is not None:
+            phase['current'], phase['peak'] = (
+                self.tracemalloc.get_traced_memory())
+            snapshot = self.tracemalloc.take_snapshot()
+            phase['top'] = [
+                (str(stat.traceback), stat.size_diff)
+                for stat in snapshot.compare_to(
+                    self.snapshot, 'lineno')[:self.top]]
+            self.snapshot = snapshot
+        else:
+            phase['peak'] = self.max_rss()
+        self.phases.append(phase)
+        log.info('Memory after {0}: peak {1:.1f} MB'.format(
+            name, phase['peak'] / 1048576.0))
+
+    @property
+    def peak(self):
+        '''The highest peak recorded by any phase, in bytes.'''
+        return max(phase['peak'] for phase in self.phases)
+
+    def report(self):
+        '''Formats the recorded phases for display.'''
+        lines = []
+        for phase in self.phases:
+            if phase['current'] is None:
+                lines.append('{0:<16} peak RSS {1:8.1f} MB'.format(
+                    phase['name'], phase['peak'] / 1048576.0))
+                continue
+            lines.append(
+                '{0:<16} current {1:8.1f} MB   peak {2:8.1f} MB'.format(
+                    phase['name'], phase['current'] / 1048576.0,
+                    phase['peak'] / 1048576.0))
+            for site, size_diff in phase['top']:
+                lines.append('    {0:+10.1f} KB  {1}'.format(
+                    size_diff / 1024.0, site))
+        return '\n'.join(lines)
+
+
+# Filters
+
+def last_comment(task_comments):
+    if task_comments:
+        return task_comments[-1:]
+    else:
+        return []
+
+
+def most_recent_comments(task_comments, num_comments):
+    if num_comments <= 0:
+        num_comments = 1
+    elif num_comments > len(task_comments):
+        num_comments = len(task_comments)
+    if task_comments:
+        return task_comments[-num_comments:]
+    else:
+        return []
+
+
+def comments_within_lookback(task_comments, current_time_utc, hours):
+    import dateutil.parser
+
+    filtered_comments = []
+    for comment in task_comments:
+        comment_time = dateutil.parser.parse(comment[u'created_at'])
+        delta = current_time_utc - comment_time
+        if delta < datetime.timedelta(hours=hours):
+            filtered_comments.append(comment)
+    if not filtered_comments and task_comments:
+        filtered_comments.append(task_comments[-1])
+    return filtered_comments
+
+
+class CommentWindow(object):
+    '''Selects which of each task's comments a digest shows.
+
+    The window is applied once, as comments are fetched, so comments outside
+    of it aren't kept in memory, and the comment filters of the templates only
+    ever see the few comments within it. A policy is one of:
+
+    * all: every comment
+    * last: the last comment
+    * recent:N: the N most recent comments
+    * lookback:HOURS: the comments from the past HOURS hours, or the last
+      comment if there are none
+
+    :param policy: The window policy
+    :param current_time_utc: The current time in UTC, for lookback windows
+    '''
+
+    POLICIES = ('all', 'last', 'recent', 'lookback')
+
+    def __init__(self, policy, current_time_utc=None):
+        kind, _, value = policy.partition(':')
+        valid = kind in self.POLICIES and (
+            value.isdigit() if kind in ('recent', 'lookback') else not value)
+        if not valid:
+            raise ValueError(
+                "Invalid comment window '{0}', expected one of all, last, "
+                "recent:N or lookback:HOURS".format(policy))
+        self.policy = policy
+        self.kind = kind
+        self.value = int(value) if value else None
+        self.current_time_utc = current_time_utc
+
+    def select(self, comments):
+        '''Returns the comments within the window.'''
+        if not comments or self.kind == 'all':
+            return comments
+        if self.kind == 'last':
+            return last_comment(comments)
+        if self.kind == 'recent':
+            return most_recent_comments(comments, self.value)
+        return comments_within_lookback(
+            comments, self.current_time_utc, self.value)
+
+
+def comment_window_policy(policy):
+    '''Validates a comment window policy given on the command line.'''
+    try:
+        CommentWindow(policy)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return policy
+
+
+COMMENT_WINDOW_RE = re.compile(r'{#-?\s*comment_window:\s*(\S+?)\s*-?#}')
+
+
+def template_comment_window(
+        template_names, templates_dir='templates', pack=None):
+    '''Reads the comment window policy the templates declare.
+
+    A template declares the comments it shows with a comment such as
+    {# comment_window: recent:5 #}. The policy is only used when every
+    template declares the same one, as each is rendered from the same
+    comments.
+
+    :param template_names: The filenames of the templates in templates_dir
+    :param pack: Optional template pack metadata (from load_template_pack) to
+    read the declared policies from, instead of templates_dir
+    :return: The policy, or None if the templates don't all declare it
+    '''
+    policies = set()
+    for template_name in template_names:
+        if pack is not None:
+            policies.add(
+                pack[u'templates'][template_name][u'comment_window'])
+            continue
+        try:
+            with codecs.open(
+                    os.path.join(templates_dir, template_name),
+                    encoding='utf-8') as template_file:
+                match = COMMENT_WINDOW_RE.search(template_file.read())
+        except (IOError, OSError):
+            # Missing templates fail when they're rendered
+            match = None
+        policies.add(match.group(1) if match else None)
+    if len(policies) != 1:
+        log.info('The templates show different comments, keeping them all')
+        return None
+    return policies.pop()
+
+
+def as_date(datetime_str):
+    import dateutil.parser
+
+    try:
+        parsed_date = dateutil.parser.parse(datetime_str).date().isoformat()
+    except:
+        return datetime_str
+    else:
+        return parsed_date
+
+
+def create_template_environment(autoescape=True, loader=None):
+    '''Creates a Jinja2 environment used to render the templates.
+
+    Environments are not modified after they are created, so a single
+    environment can be shared by concurrent renders and keeps its compiled
+    templates cached between them.
+
+    :param autoescape: Whether to escape HTML in rendered values
+    :param loader: The Jinja2 loader of the templates, by default from the
+    templates folder
+    '''
+    from jinja2 import Environment, FileSystemLoader
+
+    if loader is None:
+        loader = FileSystemLoader('templates')
+    env = Environment(
+        loader=loader, trim_blocks=True, lstrip_blocks=True,
+        autoescape=autoescape)
+
+    env.filters['last_comment'] = last_comment
+    env.filters['most_recent_comments'] = most_recent_comments
+    env.filters['comments_within_lookback'] = comments_within_lookback
+    env.filters['as_date'] = as_date
+    return env
+
+
+def create_template_environments(template_pack=None):
+    '''Creates one environment per templated output format.
+
+    :param template_pack: An optional template pack directory (from
+    build_template_pack) to load the compiled templates from
+    :return: A dict of the 'html' (autoescaped) and 'text' environments
+    '''
+    if template_pack is None:
+        return {
+            'html': create_template_environment(autoescape=True),
+            'text': create_template_environment(autoescape=False)
+        }
+    from jinja2 import ModuleLoader
+
+    # The pack is loaded from an absolute path, wherever the mailer runs from
+    template_pack = os.path.abspath(template_pack)
+    return dict(
+        (kind, create_template_environment(
+            autoescape=kind == 'html',
+            loader=ModuleLoader(os.path.join(template_pack, kind))))
+        for kind in ('html', 'text'))
+
+
+def analyze_template(env, template_name):
+    '''Resolves the templates a template extends, includes and imports, and
+    records the fields and filters used by all of them.
+
+    :param env: The Jinja2 environment to load the templates with
+    :param template_name: The name of the template to analyze
+    :return: A dict of the 'depends' (the templates it's rendered with),
+    'fields' (attribute names such as comments or due_date), 'filters',
+    'names' (the context variables used, such as stats) and 'comment_window'
+    of the template, and whether the fields and filters are 'complete', which
+    they aren't if a template is chosen at render time
+    '''
+    from jinja2 import meta, nodes
+
+    fields = set()
+    filters = set()
+    names = set()
+    depends = []
+    complete = True
+    comment_window = None
+    to_analyze = [template_name]
+    while to_analyze:
+        name = to_analyze.pop(0)
+        source = env.loader.get_source(env, name)[0]
+        if name == template_name:
+            match = COMMENT_WINDOW_RE.search(source)
+            comment_window = match.group(1) if match else None
+        else:
+            depends.append(name)
+        ast = env.parse(source)
+        fields.update(node.attr for node in ast.find_all(nodes.Getattr))
+        filters.update(node.name for node in ast.find_all(nodes.Filter))
+        names.update(meta.find_undeclared_variables(ast))
+        for referenced in meta.find_referenced_templates(ast):
+            if referenced is None:
+                complete = False
+            elif referenced != template_name and referenced not in depends:
+                to_analyze.append(referenced)
+    return {
+        u'depends': depends, u'fields': sorted(fields),
+        u'filters': sorted(filters), u'names': sorted(names),
+        u'comment_window': comment_window, u'complete': complete}
+
+
+def build_template_pack(pack_dir, templates_dir='templates', names=None):
+    '''Compiles templates into a pack that renders without parsing them, and
+    records what each of them uses.
+
+    The templates are compiled into Python modules for each output format
+    (HTML autoescaped, and text), as autoescaping is compiled in. The
+    analysis of each template is written to the pack's PACK_METADATA file.
+
+    CSS is still inlined per render, as premailer can only inline CSS into
+    rendered HTML.
+
+    :param pack_dir: The directory to write the pack to
+    :param templates_dir: The directory of the templates to pack
+    :param names: The names of the templates to pack, by default all of them
+    :return: The pack metadata
+    '''
+    from jinja2 import FileSystemLoader
+
+    loader = FileSystemLoader(templates_dir)
+    if names is None:
+        names = loader.list_templates()
+    analysis_env = create_template_environment(loader=loader)
+    templates = dict(
+        (name, analyze_template(analysis_env, name)) for name in names)
+    # Templates are compiled along with those they're rendered with
+    packed = set(names)
+    for analysis in templates.values():
+        packed.update(analysis[u'depends'])
+    for kind in ('html', 'text'):
+        env = create_template_environment(
+            autoescape=kind == 'html', loader=loader)
+        env.compile_templates(
+            os.path.join(pack_dir, kind), zip=None,
+            filter_func=packed.__contains__, ignore_errors=False)
+
+    pack = {u'version': PACK_VERSION, u'templates': templates}
+    with codecs.open(
+            os.path.join(pack_dir, PACK_METADATA), 'w',
+            encoding='utf-8') as pack_file:
+        json.dump(pack, pack_file, indent=2, sort_keys=True)
+    return pack
+
+
+def load_template_pack(pack_dir):
+    '''Loads the metadata of a template pack written by build_template_pack.
+
+    :return: The metadata, with the analysis of each template by name
+    '''
+    with codecs.open(
+            os.path.join(pack_dir, PACK_METADATA),
+            encoding='utf-8') as pack_file:
+        pack = json.load(pack_file)
+    if pack.get(u'version') != PACK_VERSION:
+        raise ValueError(
+            'Unsupported template pack version: {0}'.format(
+                pack.get(u'version')))
+    return pack
+
+
+def templates_use_comments(pack, template_names):
+    '''Whether any of the templates (or those they're rendered with) show
+    task comments, according to their template pack metadata.
+    '''
+    for template_name in template_names:
+        analysis = pack[u'templates'][template_name]
+        if (not analysis[u'complete'] or u'comments' in analysis[u'fields'] or
+                COMMENT_FILTERS.intersection(analysis[u'filters'])):
+            return True
+    return False
+
+
+def templates_use_time(template_names, templates_dir='templates', pack=None):
+    '''Whether any of the templates (or those they're rendered with) use the
+    current time, directly or through the project's stats.
+
+    :param template_names: The filenames of the templates in templates_dir
+    :param pack: Optional template pack metadata (from load_template_pack) to
+    read what the templates use from, instead of analyzing templates_dir
+    '''
+    from jinja2 import FileSystemLoader, TemplateNotFound
+
+    if pack is not None:
+        analyses = [pack[u'templates'][name] for name in template_names]
+    else:
+        env = create_template_environment(
+            loader=FileSystemLoader(templates_dir))
+        try:
+            analyses = [
+                analyze_template(env, name) for name in template_names]
+        except TemplateNotFound:
+            # Missing templates fail when they're rendered
+            return True
+    # Packs built before the variables were recorded have no names
+    return any(
+        not analysis[u'complete'] or u'names' not in analysis or
+        TIME_DEPENDENT_NAMES.intersection(analysis[u'names'])
+        for analysis in analyses)
+
+
+def inline_css(rendered_html):
+    '''Inlines the CSS of rendered HTML using premailer.
+
+    This is a module level function so that it can be run in a process pool.
+    '''
+    import premailer
+
+    return premailer.transform(rendered_html)
+
+
+def shard_sections(sections, shard_size):
+    '''Splits sections into shards of about shard_size tasks.
+
+    :return: A list of lists of Sections
+    '''
+    shards = [[]]
+    shard_tasks = 0
+    for section in sections:
+        if shards[-1] and shard_tasks >= shard_size:
+            shards.append([])
+            shard_tasks = 0
+        shards[-1].append(section)
+        shard_tasks += len(section.tasks)
+    return shards
+
+
+# The tasks_block of a template is rendered in shards by templates extending
+# it, one marking out the block's content in a render of a shard's sections,
+# the other substituting the rendered shards for the block
+TASKS_BLOCK_MARKER = u'<!-- asana_mailer:tasks_block -->'
+SHARD_TEMPLATE = (
+    u'{% extends tasks_block_layout %}{% block tasks_block %}' +
+    TASKS_BLOCK_MARKER + u'{{ super() }}' + TASKS_BLOCK_MARKER +
+    u'{% endblock %}')
+ASSEMBLE_TEMPLATE = (
+    u'{% extends tasks_block_layout %}{% block tasks_block %}'
+    u'{% for fragment in tasks_block_fragments %}{{ fragment|safe }}'
+    u'{% endfor %}{% endblock %}')
+
+# The environment of each kind of template, and SHARD_TEMPLATE compiled in
+# it, per template pack
+_shard_template_envs = {}
+
+
+def render_tasks_block(shard):
+    '''Renders a template's tasks_block for a project with a shard of sections.
+
+    This is a module level function that takes a single argument so that it
+    can be mapped over a process pool, each process creating its template
+    environments once (per template pack).
+
+    :param shard: A (template kind, template name, project, current date,
+    current time, template pack, stats) tuple, where the project only has the
+    shard's sections and stats are the whole project's ProjectStats
+    :return: The rendered block
+    '''
+    (kind, template_name, project, current_date, current_time_utc,
+     template_pack, stats) = shard
+    if template_pack not in _shard_template_envs:
+        _shard_template_envs[template_pack] = dict(
+            (env_kind, (env, env.from_string(SHARD_TEMPLATE)))
+            for env_kind, env in create_template_environments(
+                template_pack).items())
+    env, shard_template = _shard_template_envs[template_pack][kind]
+    rendered = shard_template.render(
+        tasks_block_layout=env.get_template(template_name), project=project,
+        current_date=current_date, current_time_utc=current_time_utc,
+        stats=stats)
+    parts = rendered.split(TASKS_BLOCK_MARKER)
+    if len(parts) != 3:
+        raise ValueError(
+            'Template {0} has no tasks_block to render in shards'.format(
+                template_name))
+    return parts[1]
+
+
+def render_with_tasks_block(template, variables, tasks_block_fragments):
+    '''Renders a template, substituting pre-rendered tasks_block fragments.
+
+    This relies on the tasks_block rendering each section independently of the
+    others, as the included templates do. ASSEMBLE_TEMPLATE is small enough to
+    compile for each render, rather than keeping it for every environment.
+    '''
+    return template.environment.from_string(ASSEMBLE_TEMPLATE).render(
+        variables, tasks_block_layout=template,
+        tasks_block_fragments=tasks_block_fragments)
+
+
+def generate_templates(
+        project, html_template, text_template, current_date, current_time_utc,
+        skip_inline_css=False, envs=None, pool=None, shard_size=None,
+        tracer=None, template_pack=None):
+    '''Generates the templates using Jinja2 templates
+
+    If a process pool is given, CSS inlining (the most CPU heavy step) runs in
+    it while the text template is rendered in this process. If a shard size is
+    also given, the sections of both templates are rendered in the pool in
+    shards of about shard_size tasks too.
+
+    :param html_template: The filename of the HTML template in the templates
+    folder
+    :param text_template: The filename of the text template in the templates
+    folder
+    :param current_date: The current date.
+    :param envs: Optional environments from create_template_environments to
+    reuse
+    :param pool: An optional multiprocessing Pool to inline CSS in
+    :param shard_size: The number of tasks to render in each pool job
+    :param tracer: An optional MemoryTracer to record each phase with
+    :param template_pack: An optional template pack directory to load the
+    templates from, instead of the templates folder
+    '''
+    if envs is None:
+        envs = create_template_environments(template_pack)
+
+    variables = {
+        'project': project, 'current_date': current_date,
+        'current_time_utc': current_time_utc,
+        'stats': ProjectStats(project, current_time_utc)}
+    html = envs['html'].get_template(html_template)
+    plaintext = envs['text'].get_template(text_template)
+    sharded = pool is not None and shard_size
+    if sharded:
+        shards = [
+            Project(
+                project.id, project.name, project.description, sections,
+                project.partial_comments)
+            for sections in shard_sections(project.sections, shard_size)]
+        log.info('Rendering templates in {0} shards'.format(len(shards)))
+        stats = variables['stats']
+        html_fragments = pool.map_async(render_tasks_block, [
+            ('html', html_template, shard, current_date, current_time_utc,
+             template_pack, stats)
+            for shard in shards])
+        text_fragments = pool.map_async(render_tasks_block, [
+            ('text', text_template, shard, current_date, current_time_utc,
+             template_pack, stats)
+            for shard in shards])
+        rendered_html = render_with_tasks_block(
+            html, variables, html_fragments.get())
+    else:
+        log.info('Rendering HTML Template')
+        rendered_html = html.render(**variables)
+    if tracer is not None:
+        tracer.phase('render_html')
+    inlined_html = None
+    if not skip_inline_css:
+        if pool is not None:
+            inlined_html = pool.apply_async(inline_css, (rendered_html,))
+        else:
+            rendered_html = inline_css(rendered_html)
+            if tracer is not None:
+                tracer.phase('inline_css')
+
+    if sharded:
+        rendered_plaintext = render_with_tasks_block(
+            plaintext, variables, text_fragments.get())
+    else:
+        log.info('Rendering Text Template')
+        rendered_plaintext = plaintext.render(**variables)
+    if tracer is not None:
+        tracer.phase('render_text')
+
+    if inlined_html is not None:
+        rendered_html = inlined_html.get()
+        if tracer is not None:
+            tracer.phase('inline_css')
+
+    return (rendered_html, rendered_plaintext)
+
+
+def render_json_digest(project, current_date, current_time_utc):
+    '''Renders the project as a JSON digest.'''
+    return json.dumps({
+        u'date': current_date,
+        u'generated_at': current_time_utc.isoformat(),
+        u'project': project.to_dict()
+    }, sort_keys=True)
+
+
+def render_slack_blocks(project, current_date, current_time_utc):
+    '''Renders the project as a Slack Block Kit message payload.
+
+    Slack limits a section block's text to 3000 characters, so long sections
+    are split over several blocks.
+    '''
+    max_text_length = 3000
+    blocks = [{
+        u'type': u'header',
+        u'text': {
+            u'type': u'plain_text',
+            u'text': u'{0} Daily Actions {1}'.format(
+                project.name, current_date)
+        }
+    }]
+    for section in project.sections:
+        lines = [u'*{0}*'.format(section.name)]
+        for task in section.tasks:
+            name = u'~{0}~'.format(task.name) if task.completed else task.name
+            line = u'\u2022 {0} - {1}'.format(
+                name, task.assignee if task.assignee else u'Unassigned')
+            if task.due_date:
+                line += u' (due {0})'.format(as_date(task.due_date))
+            lines.append(line)
+        if section.omitted_tasks:
+            lines.append(u'\u2026 <{0}0/{1}/{1}|{2} more in Asana>'.format(
+                ASANA_BASE_URL, section.project_id or project.id,
+                section.omitted_tasks))
+        text = u''
+        for line in lines:
+            if text and len(text) + len(line) + 1 > max_text_length:
+                blocks.append({
+                    u'type': u'section',
+                    u'text': {u'type': u'mrkdwn', u'text': text}})
+                text = u''
+            text = u'{0}\n{1}'.format(text, line) if text else line
+        blocks.append({
+            u'type': u'section', u'text': {u'type': u'mrkdwn', u'text': text}})
+    return json.dumps({u'blocks': blocks}, sort_keys=True)
+
+
+# Additional output formats, mapped to (file extension, render function)
+OUTPUT_FORMATS = {
+    'json': ('json', render_json_digest),
+    'slack': ('slack.json', render_slack_blocks),
+}
+
+
+def render_extra_formats(project, formats, current_date, current_time_utc):
+    '''Renders a project into additional (non-email) output formats.
+
+    These are rendered from the already fetched Project, so they don't cost
+    any extra calls to Asana's API.
+
+    :param formats: A list of names from OUTPUT_FORMATS
+    :return: A dict of format name to rendered output
+    '''
+    rendered_formats = {}
+    for output_format in formats:
+        log.info('Rendering {0} output'.format(output_format))
+        render_function = OUTPUT_FORMATS[output_format][1]
+        rendered_formats[output_format] = render_function(
+            project, current_date, current_time_utc)
+    return rendered_formats
+
+
+def send_email(
+        project, mail_server, from_address, to_addresses, cc_addresses,
+        rendered_html, rendered_text, current_date, smtp_username=None,
+        smtp_password=None, smtp_port=None, smtp_conn=None,
+        max_recipients=None, workers=1, timeout=SMTP_TIMEOUT,
+        get_smtp_conn=None):
+    '''Sends an email using a Project and rendered templates.
+
+    The recipients are split into batches by plan_deliveries, and the batches
+    for different domains are sent over up to workers SMTP connections at
+    once. The message is only serialized once, for every batch.
+
+    :param project: The Project instance for this email
+    :param mail_server: The hostname of the SMTP server to send mail from
+    :param from_address: The From: Address for the email to send
+    :param to_addresses: The list of To: addresses for the email to be sent to
+    :param cc_addresses: The list of Cc: addresses for the email to be sent to
+    :param rendered_html: The rendered HTML template
+    :param rendered_text: The rendered text template
+    :param current_date: The current date
+    :param smtp_username: The username to authenticate to SMTP server with
+    :param smtp_password: The password to authenticate to SMTP server with
+    :param smtp_port: The port to connect to the SMTP server with
+    :param smtp_conn: An already connected SMTP connection to send with, which
+    is left open for reuse
+    :param max_recipients: The maximum number of recipients per transaction
+    :param workers: The number of SMTP connections to send over at once
+    :param timeout: The timeout in seconds of new SMTP connections
+    :param get_smtp_conn: An optional callable returning a connection to
+    reuse, which is called just before sending instead of passing smtp_conn
+    :return: Whether the email was sent to every batch of recipients
+    '''
+    import smtplib
+
+    message = create_message(
+        project, from_address, to_addresses, cc_addresses, rendered_html,
+        rendered_text, current_date)
+
+    if cc_addresses:
+        to_addresses.extend(cc_addresses)
+    message_str = message.as_string()
+    domain_plans = plan_deliveries(to_addresses, max_recipients)
+    workers = max(min(workers, len(domain_plans)), 1)
+
+    def deliver(worker):
+        reused_conn = None
+        if worker == 0:
+            if get_smtp_conn is not None:
+                reused_conn = get_smtp_conn()
+            else:
+                reused_conn = smtp_conn
+        conn = reused_conn
+        sent = True
+        for batches in domain_plans[worker::workers]:
+            for batch in batches:
+                try:
+                    if conn is None:
+                        conn = connect_smtp(
+                            mail_server, smtp_username, smtp_password,
+                            smtp_port, timeout=timeout)
+                    log.info('Sending Email to {0} recipients'.format(
+                        len(batch)))
+                    try:
+                        conn.sendmail(from_address, batch, message_str)
+                    except smtplib.SMTPServerDisconnected:
+                        if conn is not reused_conn:
+                            raise
+                        # The server dropped the reused connection while it
+                        # sat idle, so the batch is sent over a new one
+                        log.warning('Reused SMTP connection was closed')
+                        conn = None
+                        conn = connect_smtp(
+                            mail_server, smtp_username, smtp_password,
+                            smtp_port, timeout=timeout)
+                        conn.sendmail(from_address, batch, message_str)
+                except smtplib.SMTPException:
+                    log.exception('Email could not be sent!')
+                    sent = False
+                    if conn is not reused_conn:
+                        _close_smtp(conn)
+                        conn = None
+        if conn is not reused_conn:
+            _close_smtp(conn)
+        return sent
+
+    return all(map_concurrently(deliver, range(workers), workers))
+
+
+def plan_deliveries(recipients, max_recipients=None):
+    '''Plans the SMTP transactions to send an email to its recipients in.
+
+    Recipients are grouped by domain, so that a relay's per domain limits
+    apply to as few transactions as possible, and each domain's recipients are
+    split into batches of at most max_recipients. Without max_recipients,
+    every recipient is sent to in a single transaction.
+
+    :param recipients: The list of recipient addresses
+    :param max_recipients: The maximum number of recipients per transaction
+    :return: A list, per domain, of lists of recipient batches
+    '''
+    if not max_recipients:
+        return [[recipients]]
+    domains = collections.OrderedDict()
+    for recipient in recipients:
+        domain = recipient.rpartition('@')[2].lower()
+        domains.setdefault(domain, []).append(recipient)
+    return [
+        [group[i:i + max_recipients]
+         for i in range(0, len(group), max_recipients)]
+        for group in domains.values()]
+
+
+def create_message(
+        project, from_address, to_addresses, cc_addresses, rendered_html,
+        rendered_text, current_date):
+    '''Creates the multipart/alternative email for a Project.
+
+    :param project: The Project instance for this email
+    :param from_address: The From: Address for the email to send
+    :param to_addresses: The list of To: addresses for the email to be sent to
+    :param cc_addresses: The list of Cc: addresses for the email to be sent to
+    :param rendered_html: The rendered HTML template
+    :param rendered_text: The rendered text template
+    :param current_date: The current date
+    :return: The MIMEMultipart message
+    '''
+    to_address_str = ', '.join(to_addresses)
+    if cc_addresses:
+        cc_address_str = ', '.join(cc_addresses)
+    else:
+        cc_address_str = ''
+
+    log.info('Preparing Email - From: ({0}) To: ({1}) Cc: ({2})'.format(
+        from_address, to_address_str, cc_address_str))
+    message = MIMEMultipart('alternative')
+    message['Subject'] = '{0} Daily Mailer {1}'.format(
+        project.name, current_date)
+    message['From'] = from_address
+    message['To'] = to_address_str
+    if cc_addresses:
+        message['Cc'] = cc_address_str
+
+    text_part = MIMEText(rendered_text.encode('utf-8'), 'plain')
+    html_part = MIMEText(rendered_html.encode('utf-8'), 'html')
+
+    message.attach(text_part)
+    message.attach(html_part)
+    return message
+
+
+_spool_counter = itertools.count()
+
+
+def spool_message(spool_dir, message):
+    '''Writes a message to a maildir style spool for later delivery.
+
+    The message is written and fsync'd in spool_dir/tmp before being renamed
+    into spool_dir/new, so a crash never leaves a partial message in new.
+
+    :param spool_dir: The spool directory, created if it doesn't exist
+    :param message: The email message to spool
+    :return: The message's filename within the spool
+    '''
+    for subdir in ('tmp', 'new', 'cur'):
+        path = os.path.join(spool_dir, subdir)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    name = '{0:.6f}.{1}_{2}.{3}'.format(
+        time.time(), os.getpid(), next(_spool_counter), socket.gethostname())
+    temp_path = os.path.join(spool_dir, 'tmp', name)
+    with open(temp_path, 'wb') as spool_file:
+        spool_file.write(message.as_string())
+        spool_file.flush()
+        os.fsync(spool_file.fileno())
+    os.rename(temp_path, os.path.join(spool_dir, 'new', name))
+    _fsync_dir(os.path.join(spool_dir, 'new'))
+    log.info('Spooled email {0}'.format(name))
+    return name
+
+
+def _fsync_dir(path):
+    '''fsyncs a directory so that renames into it survive a crash.'''
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def flush_spool(
+        spool_dir, mail_server, smtp_username=None, smtp_password=None,
+        smtp_port=None, retries=DEFAULT_SEND_RETRIES, workers=1,
+        max_recipients=None, timeout=SMTP_TIMEOUT, names=None,
+        claim_timeout=SPOOL_CLAIM_TIMEOUT):
+    '''Delivers the messages waiting in a spool written by spool_message.
+
+    Messages are split between up to workers threads, each reusing a single
+    SMTP connection for its messages. A message is claimed by moving it to
+    spool_dir/cur, so concurrent flushes don't deliver it twice. It's deleted
+    once delivered. Failed deliveries are retried with an exponential backoff
+    and, if they still fail, moved back to spool_dir/new for the next flush.
+    Messages claimed more than claim_timeout seconds ago were left behind by a
+    flush that crashed, and are moved back to spool_dir/new first.
+    Recipients are taken from the message's To: and Cc: headers, and sent to
+    in the batches planned by plan_deliveries. If only some batches were
+    delivered, the recipients left are kept in a SPOOL_RECIPIENTS_HEADER
+    header, so the next flush doesn't send to anyone twice.
+
+    :param spool_dir: The spool directory
+    :param mail_server: The hostname of the SMTP server to send mail from
+    :param smtp_username: The username to authenticate to SMTP server with
+    :param smtp_password: The password to authenticate to SMTP server with
+    :param smtp_port: The port to connect to the SMTP server with
+    :param retries: The number of times to retry a failed delivery
+    :param workers: The number of SMTP connections to deliver over at once
+    :param max_recipients: The maximum number of recipients per transaction
+    :param timeout: The timeout in seconds of the SMTP connections
+    :param names: The names of the messages to deliver, or None to deliver
+    every message in the spool, after recovering any abandoned claims
+    :param claim_timeout: The number of seconds after which a claimed message
+    is considered abandoned
+    :return: The list of delivered message names
+    '''
+    import email
+    import email.utils
+    import smtplib
+
+    new_dir = os.path.join(spool_dir, 'new')
+    cur_dir = os.path.join(spool_dir, 'cur')
+    if not os.path.isdir(new_dir):
+        return []
+    if names is None:
+        _recover_spool_claims(spool_dir, claim_timeout)
+        names = sorted(os.listdir(new_dir))
+    log.info('Flushing {0} spooled emails'.format(len(names)))
+    workers = max(min(workers, len(names)), 1)
+
+    def deliver(names):
+        smtp_conn = None
+        delivered = []
+        for name in names:
+            claimed_path = os.path.join(cur_dir, name)
+            try:
+                # The claim's age is the message's mtime
+                os.utime(os.path.join(new_dir, name), None)
+                os.rename(os.path.join(new_dir, name), claimed_path)
+            except OSError:
+                # Claimed by another flush
+                continue
+            with open(claimed_path, 'rb') as spool_file:
+                message_str = spool_file.read()
+            message = email.message_from_string(message_str)
+            if SPOOL_RECIPIENTS_HEADER in message:
+                recipient_headers = message.get_all(SPOOL_RECIPIENTS_HEADER)
+                del message[SPOOL_RECIPIENTS_HEADER]
+                message_str = message.as_string()
+            else:
+                recipient_headers = (
+                    message.get_all('To', []) + message.get_all('Cc', []))
+            recipients = [
+                address for _, address in email.utils.getaddresses(
+                    recipient_headers)]
+            pending = [
+                batch for batches in plan_deliveries(
+                    recipients, max_recipients)
+                for batch in batches]
+            while pending:
+                for attempt in range(retries + 1):
+                    try:
+                        if smtp_conn is None:
+                            smtp_conn = connect_smtp(
+                                mail_server, smtp_username, smtp_password,
+                                smtp_port, timeout=timeout)
+                        log.info('Sending spooled email {0}'.format(name))
+                        smtp_conn.sendmail(
+                            message['From'], pending[0], message_str)
+                    except (smtplib.SMTPException, socket.error):
+                        log.exception(
+                            'Spooled email {0} could not be sent (attempt '
+                            '{1})'.format(name, attempt + 1))
+                        _close_smtp(smtp_conn)
+                        smtp_conn = None
+                        if attempt < retries:
+                            time.sleep(SEND_RETRY_DELAY * 2 ** attempt)
+                    else:
+                        pending.pop(0)
+                        break
+                else:
+                    break
+            if not pending:
+                os.remove(claimed_path)
+                delivered.append(name)
+                continue
+            remaining = [address for batch in pending for address in batch]
+            if remaining != recipients:
+                message[SPOOL_RECIPIENTS_HEADER] = ', '.join(remaining)
+                temp_path = os.path.join(spool_dir, 'tmp', name)
+                with open(temp_path, 'wb') as spool_file:
+                    spool_file.write(message.as_string())
+                    spool_file.flush()
+                    os.fsync(spool_file.fileno())
+                os.rename(temp_path, claimed_path)
+            os.rename(claimed_path, os.path.join(new_dir, name))
+        _close_smtp(smtp_conn)
+        return delivered
+
+    delivered = []
+    for worker_delivered in map_concurrently(
+            deliver, [names[i::workers] for i in range(workers)], workers):
+        delivered.extend(worker_delivered)
+    log.info('Delivered {0} of {1} spooled emails'.format(
+        len(delivered), len(names)))
+    return delivered
+
+
+def _recover_spool_claims(spool_dir, claim_timeout):
+    '''Moves messages claimed more than claim_timeout seconds ago back from
+    spool_dir/cur to spool_dir/new.'''
+    new_dir = os.path.join(spool_dir, 'new')
+    cur_dir = os.path.join(spool_dir, 'cur')
+    if not os.path.isdir(cur_dir):
+        return
+    expired = time.time() - claim_timeout
+    for name in os.listdir(cur_dir):
+        claimed_path = os.path.join(cur_dir, name)
+        try:
+            if os.path.getmtime(claimed_path) >= expired:
+                continue
+            os.rename(claimed_path, os.path.join(new_dir, name))
+        except OSError:
+            # Delivered or recovered by another flush
+            continue
+        log.warning('Recovered abandoned spooled email {0}'.format(name))
+
+
+def _close_smtp(smtp_conn):
+    '''Closes an SMTP connection, ignoring errors from a broken connection.'''
+    import smtplib
+
+    if smtp_conn is None:
+        return
+    try:
+        smtp_conn.quit()
+    except (smtplib.SMTPException, socket.error):
+        smtp_conn.close()
+
+
+def connect_smtp(
+        mail_server, smtp_username=None, smtp_password=None, smtp_port=None,
+        timeout=SMTP_TIMEOUT):
+    '''Opens a connection to an SMTP server.
+
+    If both a username and password are given, the connection is made over SSL
+    and authenticated, otherwise an anonymous connection is made.
+
+    :param mail_server: The hostname of the SMTP server to send mail from
+    :param smtp_username: The username to authenticate to SMTP server with
+    :param smtp_password: The password to authenticate to SMTP server with
+    :param smtp_port: The port to connect to the SMTP server with
+    :param timeout: The timeout in seconds of the connection's operations
+    :return: The connected SMTP instance
+    '''
+    import smtplib
+
+    if (smtp_username is not None and smtp_password is not None):
+        if not smtp_port:
+            smtp_port = 465
+        log.info('Connecting to authenticated SMTP Server: {0}'.format(
+            mail_server))
+        smtp_conn = smtplib.SMTP_SSL(
+            mail_server, port=smtp_port, timeout=timeout)
+        log.info('Logging in to Email')
+        smtp_conn.ehlo()
+        smtp_conn.login(smtp_username, smtp_password)
+    else:
+        log.info(
+            'Connecting to anonymous SMTP Server: {0}'.format(mail_server))
+        smtp_conn = smtplib.SMTP(mail_server, timeout=timeout)
+    return smtp_conn
+
+
+def dump_snapshot(project, snapshot_path):
+    '''Writes a built Project out to disk as a compressed snapshot.
+
+    The snapshot is zlib compressed JSON of Project.to_dict, so that a later
+    run can render templates without making any calls to Asana's API.
+
+    :param project: The Project instance to snapshot
+    :param snapshot_path: The filename of the snapshot to write
+    '''
+    log.info('Writing project snapshot to {0}'.format(snapshot_path))
+    snapshot = {u'version': SNAPSHOT_VERSION, u'project': project.to_dict()}
+    with open(snapshot_path, 'wb') as snapshot_file:
+        snapshot_file.write(zlib.compress(
+            json.dumps(snapshot, separators=(',', ':'))))
+
+
+def load_snapshot(snapshot_path):
+    '''Loads a Project from a snapshot written by dump_snapshot.
+
+    :param snapshot_path: The filename of the snapshot to read
+    :return: The Project instance stored in the snapshot
+    '''
+    log.info('Loading project snapshot from {0}'.format(snapshot_path))
+    with open(snapshot_path, 'rb') as snapshot_file:
+        snapshot = json.loads(zlib.decompress(snapshot_file.read()))
+    if snapshot.get(u'version') != SNAPSHOT_VERSION:
+        raise ValueError(
+            'Unsupported snapshot version: {0}'.format(
+                snapshot.get(u'version')))
+    return Project.from_dict(snapshot[u'project'])
+
+
+def load_fingerprints(fingerprint_path):
+    '''Loads task fingerprints written by save_fingerprints.
+
+    :param fingerprint_path: The filename of the fingerprint file
+    :return: A dict of task id to fingerprint, empty if there is no file yet
+    '''
+    try:
+        with open(fingerprint_path, 'rb') as fingerprint_file:
+            return json.loads(zlib.decompress(fingerprint_file.read()))
+    except IOError:
+        log.info('No fingerprints found at {0}, all tasks are new'.format(
+            fingerprint_path))
+        return {}
+
+
+def save_fingerprints(fingerprint_path, fingerprints):
+    '''Saves task fingerprints, replacing the previous file atomically.
+
+    :param fingerprint_path: The filename of the fingerprint file
+    :param fingerprints: A dict of task id to fingerprint
+    '''
+    log.info('Saving {0} task fingerprints to {1}'.format(
+        len(fingerprints), fingerprint_path))
+    temp_path = '{0}.tmp'.format(fingerprint_path)
+    with open(temp_path, 'wb') as fingerprint_file:
+        fingerprint_file.write(zlib.compress(
+            json.dumps(fingerprints, separators=(',', ':'))))
+    os.rename(temp_path, fingerprint_path)
+
+
+def render_cache_key(
+        project, html_template, text_template, current_date,
+        completed_lookback_hours, skip_inline_css, templates_dir='templates',
+        current_time_utc=None):
+    '''Hashes everything that a render of the templates depends on.
+
+    That is the project's data, the templates (by name, and the modification
+    times of every file in the templates folder, as templates extend each
+    other) and the render parameters.
+
+    :param current_time_utc: The current time in UTC if the templates use it
+    (see templates_use_time), which is truncated to the hour, so that renders
+    within the same hour share their entries
+    :return: A hex digest to use as a RenderCache key
+    '''
+    if current_time_utc is not None:
+        current_time_utc = current_time_utc.replace(
+            minute=0, second=0, microsecond=0).isoformat()
+    template_mtimes = sorted(
+        (name, os.path.getmtime(os.path.join(templates_dir, name)))
+        for name in os.listdir(templates_dir))
+    key_data = json.dumps([
+        project.to_dict(), html_template, text_template, template_mtimes,
+        current_date, completed_lookback_hours, skip_inline_css,
+        current_time_utc],
+        sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+
+class RenderCache(object):
+    '''A size bounded, on-disk cache of rendered HTML and text templates.
+
+    Entries are stored as one compressed file per key. Reading an entry
+    touches its file, so that when the cache grows beyond max_bytes the least
+    recently used entries are evicted first.
+    '''
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, '{0}.render'.format(key))
+
+    def get(self, key):
+        '''Returns the cached (rendered_html, rendered_text), or None.'''
+        try:
+            with open(self.path(key), 'rb') as cache_file:
+                rendered = json.loads(zlib.decompress(cache_file.read()))
+            os.utime(self.path(key), None)
+        except (IOError, OSError, ValueError, zlib.error):
+            return None
+        log.info('Using cached render {0}'.format(key))
+        return tuple(rendered)
+
+    def set(self, key, rendered_html, rendered_text):
+        '''Stores a render, then evicts entries until within max_bytes.'''
+        temp_path = '{0}.{1}.tmp'.format(self.path(key), os.getpid())
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(zlib.compress(json.dumps(
+                [rendered_html, rendered_text], separators=(',', ':'))))
+        os.rename(temp_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        '''Removes the least recently used entries beyond max_bytes.'''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.render'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total_bytes -= size
+
+
+def write_extra_formats(rendered_formats, current_date):
+    '''Writes the additional output formats out to disk.
+
+    Each format is written to AsanaMailer_[Date].[Extension].
+
+    :param rendered_formats: A dict of format name to rendered output
+    :param current_date: The current date.
+    '''
+    for output_format, rendered in sorted(rendered_formats.items()):
+        extension = OUTPUT_FORMATS[output_format][0]
+        with codecs.open(
+                'AsanaMailer_{0}.{1}'.format(current_date, extension), 'w',
+                'utf-8') as output_file:
+            log.info('Writing {0} File'.format(output_format))
+            output_file.write(rendered)
+
+
+def write_rendered_files(rendered_html, rendered_text, current_date):
+    '''Writes the rendered files out to disk.
+
+    Currently, this creates a AsanaMailer_[Date].html and *.markdown file.
+
+    :param rendered_html: The rendered HTML template.
+    :param rendered_text: The rendered text template.
+    :param current_date: The current date.
+    '''
+    with codecs.open(
+            'AsanaMailer_{0}.html'.format(current_date), 'w', 'utf-8') as (
+            html_file):
+        log.info('Writing HTML File')
+        html_file.write(rendered_html)
+    with codecs.open(
+            'AsanaMailer_{0}.markdown'.format(current_date), 'w', 'utf-8') as (
+            markdown_file):
+        log.info('Writing Text File')
+        markdown_file.write(rendered_text)
+
+
+def create_cli_parser():
     parser = argparse.ArgumentParser(
         description='Generates an email template for an Asana project',
         fromfile_prefix_chars='@')
@@ -475,6 +3451,115 @@ def create_cli_parser():
     parser.add_argument(
         '--text-template', default='Default.markdown',
         help='a custom template to use for the plaintext portion')
+    parser.add_argument(
+        '--template-pack', metavar='DIR',
+        help='load the templates from a pack built by the pack command, '
+        'skipping fetching comments if the templates don\'t show them')
+    parser.add_argument(
+        '--dump-snapshot', metavar='FILE',
+        help='write the fetched project to a compressed snapshot file')
+    parser.add_argument(
+        '--from-snapshot', metavar='FILE',
+        help='render from a snapshot file instead of fetching from Asana')
+    parser.add_argument(
+        '--from-store', metavar='DIR',
+        help='read the project from a store kept up to date by the webhook '
+        'command instead of fetching it from Asana')
+    parser.add_argument(
+        '--trace-memory', type=int, nargs='?', const=10, default=0,
+        metavar='TOP',
+        help='report memory use after each phase of the run, with the TOP '
+        '(default: 10) allocation sites that grew the most where tracemalloc '
+        'is available')
+    parser.add_argument(
+        '--record', metavar='CASSETTE',
+        help='record the Asana API calls made and their responses to a '
+        'compressed cassette file')
+    parser.add_argument(
+        '--replay', metavar='CASSETTE',
+        help='serve the Asana API calls from a recorded cassette instead of '
+        'calling Asana')
+    parser.add_argument(
+        '--replay-latency-scale', type=float, default=1.0, metavar='FACTOR',
+        help='scale the recorded latencies of replayed calls by this factor, '
+        '0 to replay without delays (default: 1.0)')
+    parser.add_argument(
+        '--changes-only', action='store_true',
+        help='only show tasks that are new or have changed since the last '
+        'run that used the same fingerprint file')
+    parser.add_argument(
+        '--fingerprint-file', metavar='FILE',
+        help='where --changes-only keeps the fingerprints of the tasks of '
+        'the last run (default: AsanaMailer_[Project ID].fingerprints)')
+    parser.add_argument(
+        '--extra-formats', nargs='+', default=[],
+        choices=sorted(OUTPUT_FORMATS), metavar='FORMAT',
+        help='additional formats to write out, from: {0}'.format(
+            ', '.join(sorted(OUTPUT_FORMATS))))
+    parser.add_argument(
+        '--rollup', nargs='+', default=[], metavar='PROJECT_ID',
+        help='roll up these projects with project_id into one digest, with a '
+        'section per section of each project')
+    parser.add_argument(
+        '--rollup-name', metavar='NAME',
+        help="the name of a rollup digest (default: the projects' names)")
+    parser.add_argument(
+        '--subtask-depth', type=int, default=0, metavar='N',
+        help='include this many levels of subtasks under each task '
+        '(default: 0)')
+    parser.add_argument(
+        '--comment-window', type=comment_window_policy, metavar='POLICY',
+        help='the comments of each task to keep: all, last, recent:N or '
+        'lookback:HOURS (default: as declared by the templates, otherwise '
+        'all)')
+    parser.add_argument(
+        '--max-tasks-per-section', type=int, metavar='N',
+        help='include at most this many tasks per section, summarizing the '
+        'rest')
+    parser.add_argument(
+        '--max-description-length', type=int, metavar='CHARS',
+        help='truncate task descriptions longer than this')
+    parser.add_argument(
+        '--max-comments-per-task', type=int, metavar='N',
+        help="include at most this many of each task's most recent comments")
+    parser.add_argument(
+        '--max-bytes', type=int, metavar='BYTES',
+        help='include at most this many bytes of task names, descriptions '
+        'and comments, summarizing the tasks beyond it')
+    parser.add_argument(
+        '--shard-size', type=int, metavar='TASKS',
+        help='with -j/--processes, build and render sections in the process '
+        'pool in shards of about this many tasks, for very large projects')
+    parser.add_argument(
+        '--render-cache', metavar='DIR',
+        help='reuse rendered templates from this directory when the project '
+        'data, templates and render options are unchanged')
+    parser.add_argument(
+        '--render-cache-size', type=int, default=DEFAULT_RENDER_CACHE_SIZE,
+        metavar='MB', help='the size to limit the render cache to '
+        '(default: {0} MB)'.format(DEFAULT_RENDER_CACHE_SIZE))
+    parser.add_argument(
+        '--shared-cache', metavar='FILE',
+        help='share fetched comments and subtasks with the other mailers on '
+        'this host through a SQLite file, so that concurrent runs covering '
+        'the same tasks only fetch them once')
+    parser.add_argument(
+        '--shared-cache-ttl', type=int, default=DEFAULT_SHARED_CACHE_TTL,
+        metavar='SECONDS', help='how long shared cache entries are reused '
+        'for (default: {0})'.format(DEFAULT_SHARED_CACHE_TTL))
+    parser.add_argument(
+        '-j', '--processes', type=int, default=0,
+        help='the number of worker processes to use for CPU heavy rendering '
+        'steps (default: 0, render in this process)')
+    parser.add_argument(
+        '--fetch-workers', type=int, default=1, metavar='WORKERS',
+        help='the number of tasks to fetch comments for concurrently '
+        '(default: 1)')
+    parser.add_argument(
+        '--deadline', type=float, metavar='SECONDS',
+        help='finish the run within this many seconds, fetching the '
+        'comments of the most recently modified tasks first and sending '
+        'with only some comments if fetching all of them would take too long')
     email_group = parser.add_argument_group(
         'email', 'arguments for sending emails')
     email_group.add_argument(
@@ -498,51 +3583,1000 @@ def create_cli_parser():
         '--password', metavar='ADDRESS', default=None,
         help='the password to authenticate to the outgoing (SMTP) mail server '
         'over SSL')
+    email_group.add_argument(
+        '--spool-dir', metavar='DIR',
+        help='spool the email to this directory before sending it, so that '
+        'it can be resent by the flush command if sending fails')
+    email_group.add_argument(
+        '--retries', type=int, default=DEFAULT_SEND_RETRIES,
+        help='the number of times to retry sending a spooled email '
+        '(default: {0})'.format(DEFAULT_SEND_RETRIES))
+    email_group.add_argument(
+        '--max-recipients', type=int, metavar='N',
+        help='send to at most this many recipients per SMTP transaction, '
+        'batching recipients by domain')
+    email_group.add_argument(
+        '--send-workers', type=int, default=1, metavar='N',
+        help='the number of SMTP connections to send batches for different '
+        'domains over at once (default: 1)')
 
+    add_logging_arguments(parser)
     return parser
 
 
-def main():
-    '''The main function for generating the mailer.
-
-    Based on the arguments, the mailer generates a Project object with its
-    appropriate Section and Tasks objects, and then renders templates
-    accordingly. This can either be written out to two files, or can be mailed
-    out using a SMTP server running on localhost.
-    '''
+def add_logging_arguments(parser):
+    '''Adds the logging arguments shared by the mailer and its commands.'''
+    logging_group = parser.add_argument_group(
+        'logging', 'arguments for where and how to log')
+    logging_group.add_argument(
+        '--log-file', default=DEFAULT_LOG_FILE, metavar='PATH',
+        help="the file to log to, or '-' for standard error (default: "
+        "{0})".format(DEFAULT_LOG_FILE))
+    logging_group.add_argument(
+        '--log-format', choices=LOG_FORMATS, default='text',
+        help='write the log as text lines, or as JSON objects with the '
+        'timings of each phase as fields (default: text)')
+    logging_group.add_argument(
+        '--log-sample', type=int, metavar='N',
+        help='log every Nth debug line of each kind, such as the line for '
+        'each task fetched (default: no debug lines)')
 
-    parser = create_cli_parser()
-    args = parser.parse_args()
 
+def validate_args(parser, args):
+    '''Validates parsed mailer arguments, exiting via the parser on error.'''
     if bool(args.from_address) != bool(args.to_addresses):
         parser.error(
             "'To:' and 'From:' address are required for sending email")
+    if args.record and args.replay:
+        parser.error('--record and --replay are mutually exclusive')
+    if args.from_store and args.replay:
+        parser.error('--from-store and --replay are mutually exclusive')
+    if args.shard_size and args.processes <= 0:
+        parser.error('--shard-size requires -j/--processes')
+    pack = None
+    if args.template_pack:
+        try:
+            pack = load_template_pack(args.template_pack)
+        except (IOError, OSError, ValueError) as e:
+            parser.error('Could not load the template pack: {0}'.format(e))
+        missing = [
+            template_name
+            for template_name in (args.html_template, args.text_template)
+            if template_name not in pack[u'templates']]
+        if missing:
+            parser.error('{0} not in the template pack'.format(
+                ', '.join(missing)))
+    if not args.comment_window:
+        policy = template_comment_window(
+            [args.html_template, args.text_template], pack=pack)
+        try:
+            if policy:
+                CommentWindow(policy)
+        except ValueError as e:
+            parser.error('{0} (declared by the templates)'.format(e))
+
+
+def run_mailer(
+        args, asana_client=None, story_cache=None, template_envs=None,
+        smtp_conn=None, pool=None, subtask_cache=None, get_smtp_conn=None):
+    '''Generates (and sends or writes out) the mailer for parsed arguments.
+
+    :param args: The parsed arguments from create_cli_parser
+    :param asana_client: An optional Asana client to reuse
+    :param story_cache: An optional StoryCache to reuse between runs, unless
+    args.shared_cache is set
+    :param template_envs: Optional Jinja2 environments to reuse, unless
+    args.template_pack is set
+    :param smtp_conn: An optional connected SMTP instance to send with
+    :param pool: An optional multiprocessing Pool to reuse, otherwise one is
+    created for the run if args.processes is set
+    :param subtask_cache: An optional StoryCache of subtasks to reuse between
+    runs
+    :param get_smtp_conn: An optional callable returning a connected SMTP
+    instance, which is only called once the email is ready to send
+    '''
+    import dateutil.tz
 
-    asana_client = asana.Client.access_token(args.pat)
     filters = frozenset((unicode(filter) for filter in args.tag_filters))
     section_filters = frozenset(
         (unicode(section + ':') for section in args.section_filters))
+    deadline = Deadline(args.deadline) if args.deadline else None
     current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
     current_date = str(datetime.date.today())
-    project = Project.create_project(
-        asana_client, args.project_id, current_time_utc, task_filters=filters,
-        section_filters=section_filters,
-        completed_lookback_hours=args.completed_lookback_hours)
-    rendered_html, rendered_text = generate_templates(
-        project, args.html_template, args.text_template, current_date,
-        current_time_utc, args.skip_inline_css)
-
-    if args.to_addresses and args.from_address:
-        if args.cc_addresses:
-            cc_addresses = args.cc_addresses[:]
+    template_names = [args.html_template, args.text_template]
+    pack = None
+    if args.template_pack:
+        pack = load_template_pack(args.template_pack)
+    comment_window_policy = args.comment_window or template_comment_window(
+        template_names, pack=pack)
+    # The other outputs include every comment
+    with_comments = bool(
+        pack is None or args.extra_formats or args.dump_snapshot or
+        args.changes_only or templates_use_comments(pack, template_names))
+    if not with_comments:
+        log.info('The templates don\'t show comments, not fetching them')
+    # Snapshots, fingerprints and extra formats need every comment, in which
+    # case the comments are only windowed for rendering the templates
+    window_when_fetched = not (
+        args.dump_snapshot or args.changes_only or args.extra_formats)
+    windowed = False
+    own_pool = pool is None and args.processes > 0
+    if own_pool:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(args.processes)
+    shared_caches = []
+    if args.shared_cache and not args.from_snapshot:
+        story_cache = SharedStoryCache(
+            args.shared_cache, 'stories', args.shared_cache_ttl)
+        subtask_cache = SharedStoryCache(
+            args.shared_cache, 'subtasks', args.shared_cache_ttl)
+        shared_caches = [story_cache, subtask_cache]
+    tracer = None
+    if args.trace_memory:
+        tracer = MemoryTracer(args.trace_memory)
+        tracer.start()
+    fetched_and_rendered = False
+    try:
+        if args.from_snapshot:
+            with span('load_snapshot'):
+                project = load_snapshot(args.from_snapshot)
+            if tracer is not None:
+                tracer.phase('load_snapshot')
+            project.filter_tasks(
+                current_time_utc, section_filters=section_filters,
+                task_filters=filters)
+            if tracer is not None:
+                tracer.phase('filter_tasks')
         else:
-            cc_addresses = None
-        send_email(
-            project, args.mail_server, args.from_address, args.to_addresses[:],
-            cc_addresses, rendered_html, rendered_text, current_date,
-            args.username, args.password)
-    else:
-        write_rendered_files(rendered_html, rendered_text, current_date)
+            if args.replay:
+                asana_client = ReplayAsanaClient(
+                    args.replay, args.replay_latency_scale)
+                # Replay the run as of when it was recorded
+                current_time_utc = (
+                    asana_client.current_time_utc or current_time_utc)
+            elif asana_client is None:
+                asana_client = create_asana_client(
+                    args.pat, workers=args.fetch_workers,
+                    prefetch_pages=True)
+            if args.from_store:
+                # Anything not in the store, such as subtasks, is fetched
+                asana_client = StoreAsanaClient(
+                    ProjectStore(args.from_store), asana_client)
+            if args.record:
+                asana_client = RecordingAsanaClient(
+                    asana_client, current_time_utc)
+            count_connections = not args.replay and not args.from_store
+            if count_connections:
+                connections_before = connection_stats(asana_client)
+            comment_window = None
+            if comment_window_policy and window_when_fetched:
+                comment_window = CommentWindow(
+                    comment_window_policy, current_time_utc)
+                windowed = True
+            create_kwargs = dict(
+                task_filters=filters, section_filters=section_filters,
+                completed_lookback_hours=args.completed_lookback_hours,
+                story_cache=story_cache, fetch_workers=args.fetch_workers,
+                pool=pool, shard_size=args.shard_size, limits=DigestLimits(
+                    args.max_tasks_per_section, args.max_description_length,
+                    args.max_comments_per_task, args.max_bytes),
+                subtask_depth=args.subtask_depth,
+                subtask_cache=subtask_cache, tracer=tracer,
+                comment_window=comment_window, deadline=deadline,
+                with_comments=with_comments)
+            with span('fetch', projects=1 + len(args.rollup)):
+                if args.rollup:
+                    project = Project.create_rollup(
+                        asana_client, [args.project_id] + args.rollup,
+                        current_time_utc, name=args.rollup_name,
+                        **create_kwargs)
+                else:
+                    project = Project.create_project(
+                        asana_client, args.project_id, current_time_utc,
+                        **create_kwargs)
+            if args.record:
+                asana_client.save(args.record)
+            if count_connections:
+                log.info(
+                    'Asana HTTP connections: {requests} requests, '
+                    '{connections} connections opened, {reused} '
+                    'reused'.format(**connection_stats(
+                        asana_client, since=connections_before)))
+        if args.dump_snapshot:
+            dump_snapshot(project, args.dump_snapshot)
+        if args.changes_only:
+            fingerprint_path = args.fingerprint_file or (
+                'AsanaMailer_{0}.fingerprints'.format(
+                    '+'.join([project.id] + args.rollup)))
+            previous_fingerprints = load_fingerprints(fingerprint_path)
+            fingerprints = project.fingerprints()
+            missed_task_ids = (
+                deadline.missed_task_ids if deadline is not None else ())
+            # Tasks whose comments weren't fetched keep their previous
+            # fingerprint, to be compared once they are, as do tasks left out
+            # of the digest by its limits
+            omitted_task_ids = [
+                task_id for section in project.sections
+                for task_id in section.omitted_task_ids]
+            for task_id in itertools.chain(missed_task_ids, omitted_task_ids):
+                if task_id in previous_fingerprints:
+                    fingerprints[task_id] = previous_fingerprints[task_id]
+            project.filter_changes(previous_fingerprints, missed_task_ids)
+        if args.extra_formats:
+            write_extra_formats(render_extra_formats(
+                project, args.extra_formats, current_date, current_time_utc),
+                current_date)
+        if comment_window_policy and not windowed:
+            project.select_comments(
+                CommentWindow(comment_window_policy, current_time_utc))
+        render_cache = None
+        rendered = None
+        if args.render_cache:
+            render_cache = RenderCache(
+                args.render_cache, args.render_cache_size * 1024 * 1024)
+            uses_time = templates_use_time(template_names, pack=pack)
+            render_key = render_cache_key(
+                project, args.html_template, args.text_template, current_date,
+                args.completed_lookback_hours, args.skip_inline_css,
+                templates_dir=args.template_pack or 'templates',
+                current_time_utc=current_time_utc if uses_time else None)
+            rendered = render_cache.get(render_key)
+        if rendered is not None:
+            rendered_html, rendered_text = rendered
+        else:
+            with span('render'):
+                rendered_html, rendered_text = generate_templates(
+                    project, args.html_template, args.text_template,
+                    current_date, current_time_utc, args.skip_inline_css,
+                    envs=None if args.template_pack else template_envs,
+                    pool=pool, shard_size=args.shard_size, tracer=tracer,
+                    template_pack=args.template_pack)
+            if render_cache is not None:
+                render_cache.set(render_key, rendered_html, rendered_text)
+        fetched_and_rendered = True
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+        for shared_cache in shared_caches:
+            shared_cache.close()
+        # On success the tracer goes on to record the send phase
+        if tracer is not None and not fetched_and_rendered:
+            tracer.stop()
+
+    try:
+        if args.to_addresses and args.from_address:
+            smtp_timeout = (
+                deadline.smtp_timeout() if deadline is not None
+                else SMTP_TIMEOUT)
+            if args.cc_addresses:
+                cc_addresses = args.cc_addresses[:]
+            else:
+                cc_addresses = None
+            with span('send') as fields:
+                if args.spool_dir:
+                    # Spool first so an SMTP outage doesn't lose the rendered
+                    # email
+                    name = spool_message(args.spool_dir, create_message(
+                        project, args.from_address, args.to_addresses,
+                        cc_addresses, rendered_html, rendered_text,
+                        current_date))
+                    # Only this run's email is sent with its credentials; the
+                    # rest of the spool is left to the flush command
+                    sent = name in flush_spool(
+                        args.spool_dir, args.mail_server, args.username,
+                        args.password, retries=args.retries,
+                        workers=args.send_workers,
+                        max_recipients=args.max_recipients,
+                        timeout=smtp_timeout, names=[name])
+                else:
+                    sent = send_email(
+                        project, args.mail_server, args.from_address,
+                        args.to_addresses[:], cc_addresses, rendered_html,
+                        rendered_text, current_date, args.username,
+                        args.password, smtp_conn=smtp_conn,
+                        max_recipients=args.max_recipients,
+                        workers=args.send_workers, timeout=smtp_timeout,
+                        get_smtp_conn=get_smtp_conn)
+                fields['sent'] = bool(sent)
+        else:
+            write_rendered_files(rendered_html, rendered_text, current_date)
+            sent = True
+        # Only move the baseline forward once the changes have been delivered,
+        # and not from a snapshot that doesn't record whose comments are
+        # missing
+        if args.changes_only and sent:
+            if project.partial_comments and deadline is None:
+                log.warning(
+                    'Not saving fingerprints, the snapshot is missing some '
+                    'comments')
+            else:
+                save_fingerprints(fingerprint_path, fingerprints)
+    finally:
+        if tracer is not None:
+            tracer.phase('send')
+            tracer.stop()
+            report = tracer.report()
+            log.info('Memory use by phase:\n{0}'.format(report))
+            sys.stderr.write(report + '\n')
+
+
+class CronSchedule(object):
+    '''A cron expression (minute hour day-of-month month day-of-week).
+
+    Each field supports '*', numbers, ranges ('1-5'), steps ('*/15', '0-30/5')
+    and comma separated lists of those. As with cron, when both the
+    day-of-month and day-of-week fields are restricted, a time matches if
+    either of them does.
+    '''
+
+    FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(
+                'Cron expressions need 5 fields: {0}'.format(expression))
+        self.fields = [
+            CronSchedule.parse_field(field, low, high)
+            for field, (low, high) in zip(fields, CronSchedule.FIELD_RANGES)]
+        # Sunday is both 0 and 7
+        if 7 in self.fields[4]:
+            self.fields[4] = self.fields[4] | frozenset((0,))
+        self.dom_restricted = fields[2] != '*'
+        self.dow_restricted = fields[4] != '*'
+
+    @staticmethod
+    def parse_field(field, low, high):
+        '''Parses a single cron field into the set of values it matches.'''
+        values = set()
+        for part in field.split(','):
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            else:
+                step = 1
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(value) for value in part.split('-', 1))
+            else:
+                start = end = int(part)
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError('Invalid cron field: {0}'.format(field))
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def matches(self, when):
+        '''Determines if a datetime falls on this schedule.'''
+        minutes, hours, days, months, weekdays = self.fields
+        if (when.minute not in minutes or when.hour not in hours or
+                when.month not in months):
+            return False
+        day_matches = when.day in days
+        # isoweekday is 1 (Monday) through 7 (Sunday), which is 0 in the field
+        weekday_matches = when.isoweekday() % 7 in weekdays
+        if self.dom_restricted and self.dow_restricted:
+            return day_matches or weekday_matches
+        return day_matches and weekday_matches
+
+
+class ScheduledJob(object):
+    '''A mailer run (its parsed arguments) and the schedule to run it on.'''
+
+    def __init__(self, schedule, args, line):
+        self.schedule = schedule
+        self.args = args
+        self.line = line
+
+    @staticmethod
+    def parse_schedule(schedule_lines):
+        '''Parses schedule lines into ScheduledJobs.
+
+        Each line holds a cron expression followed by the mailer's arguments,
+        e.g. "30 13 * * 1-5 @awesome_webapp.args". Blank lines and lines
+        starting with '#' are ignored.
+
+        :param schedule_lines: An iterable of lines from a schedule file
+        :return: A list of ScheduledJobs
+        :raises ValueError: If a line's schedule or arguments are invalid
+        '''
+        jobs = []
+        parser = create_cli_parser()
+        for line in schedule_lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split(None, 5)
+            if len(fields) != 6:
+                raise ValueError('Invalid schedule line: {0}'.format(line))
+            # The parser exits on invalid arguments, which shouldn't take the
+            # daemon down with it
+            try:
+                args = parser.parse_args(shlex.split(fields[5]))
+                validate_args(parser, args)
+            except SystemExit:
+                raise ValueError('Invalid schedule line: {0}'.format(line))
+            jobs.append(ScheduledJob(
+                CronSchedule(' '.join(fields[:5])), args, line))
+        return jobs
+
+
+class MailerDaemon(object):
+    '''Runs scheduled mailer jobs from a single resident process.
+
+    Compared to starting a process per cron entry, the daemon only pays for
+    interpreter startup and imports once, and keeps state warm between runs:
+    Asana clients (and their HTTP connection pools) per PAT, shared template
+    environments with their compiled templates, an optional process pool for
+    CSS inlining, SMTP connections per worker thread, and StoryCaches so that
+    only modified tasks have their comments and subtasks refetched. The
+    schedule file is reloaded whenever it changes.
+    '''
+
+    def __init__(
+            self, schedule_path, workers=DEFAULT_SERVE_WORKERS,
+            story_cache_size=DEFAULT_STORY_CACHE_SIZE, processes=0):
+        import multiprocessing
+        from multiprocessing.pool import ThreadPool
+
+        self.schedule_path = schedule_path
+        self.schedule_mtime = None
+        self.jobs = []
+        # Fork the process pool before any worker threads are started
+        if processes > 0:
+            self.process_pool = multiprocessing.Pool(processes)
+        else:
+            self.process_pool = None
+        self.workers = workers
+        self.pool = ThreadPool(workers)
+        self.template_envs = create_template_environments()
+        self.story_cache = StoryCache(story_cache_size)
+        self.subtask_cache = StoryCache(
+            story_cache_size, ttl=DEFAULT_SHARED_CACHE_TTL)
+        self.asana_clients = {}
+        self.running = set()
+        self.lock = threading.Lock()
+        self.worker_state = threading.local()
+
+    def load_schedule(self):
+        '''Loads the schedule file if it has changed since it was loaded.'''
+        mtime = os.path.getmtime(self.schedule_path)
+        if mtime == self.schedule_mtime:
+            return
+        log.info('Loading schedule from {0}'.format(self.schedule_path))
+        with codecs.open(self.schedule_path, 'r', 'utf-8') as schedule_file:
+            self.jobs = ScheduledJob.parse_schedule(schedule_file)
+        self.schedule_mtime = mtime
+
+    def get_asana_client(self, pat, fetch_workers=1):
+        '''Returns the shared Asana client for a PAT, creating it once.
+
+        The client's connection pool is sized for every worker thread running
+        a job that fetches with fetch_workers threads, plus the thread
+        downloading the job's task pages.
+        '''
+        with self.lock:
+            asana_client = self.asana_clients.get(pat)
+            if asana_client is None:
+                asana_client = create_asana_client(
+                    pat, workers=self.workers * (fetch_workers + 1))
+                self.asana_clients[pat] = asana_client
+            return asana_client
+
+    def get_smtp_conn(self, args):
+        '''Returns this worker's SMTP connection for a job's mail server.
+
+        Connections that the server has since dropped are replaced. This is
+        called once a job's email is ready to send, as a connection checked
+        before fetching may time out while the job runs.
+        '''
+        import smtplib
+
+        smtp_conns = getattr(self.worker_state, 'smtp_conns', None)
+        if smtp_conns is None:
+            smtp_conns = self.worker_state.smtp_conns = {}
+        key = (args.mail_server, args.username, args.password)
+        smtp_conn = smtp_conns.get(key)
+        if smtp_conn is not None:
+            try:
+                smtp_conn.noop()
+            except (smtplib.SMTPException, socket.error):
+                _close_smtp(smtp_conn)
+                smtp_conn = None
+        if smtp_conn is None:
+            smtp_conn = connect_smtp(
+                args.mail_server, args.username, args.password)
+            smtp_conns[key] = smtp_conn
+        return smtp_conn
+
+    def run_job(self, job):
+        '''Runs a single job on a worker thread, logging any failure.'''
+        try:
+            if job.args.to_addresses and job.args.from_address:
+                def get_smtp_conn():
+                    return self.get_smtp_conn(job.args)
+            else:
+                get_smtp_conn = None
+            log.info('Running scheduled job: {0}'.format(job.line))
+            run_mailer(
+                job.args, asana_client=self.get_asana_client(
+                    job.args.pat, job.args.fetch_workers),
+                story_cache=self.story_cache,
+                template_envs=self.template_envs, pool=self.process_pool,
+                subtask_cache=self.subtask_cache, get_smtp_conn=get_smtp_conn)
+        except Exception:
+            log.exception('Scheduled job failed: {0}'.format(job.line))
+        finally:
+            with self.lock:
+                self.running.discard(job.line)
+
+    def run_due_jobs(self, when):
+        '''Submits the jobs scheduled for a minute to the worker pool.
+
+        A job that is still running from an earlier slot is skipped.
+        '''
+        for job in self.jobs:
+            if not job.schedule.matches(when):
+                continue
+            with self.lock:
+                if job.line in self.running:
+                    log.warning(
+                        'Skipping job that is still running: {0}'.format(
+                            job.line))
+                    continue
+                self.running.add(job.line)
+            self.pool.apply_async(self.run_job, (job,))
+
+    def serve_forever(self):
+        '''Runs due jobs every minute until interrupted.'''
+        log.info('Serving schedule {0}'.format(self.schedule_path))
+        last_minute = datetime.datetime.now().replace(second=0, microsecond=0)
+        try:
+            while True:
+                time.sleep(60 - time.time() % 60)
+                try:
+                    self.load_schedule()
+                except (IOError, OSError, ValueError):
+                    log.exception('Could not load schedule, keeping old jobs')
+                now = datetime.datetime.now().replace(second=0, microsecond=0)
+                # Catch up on any minutes skipped by a late wakeup
+                while last_minute < now:
+                    last_minute += datetime.timedelta(minutes=1)
+                    self.run_due_jobs(last_minute)
+        except KeyboardInterrupt:
+            log.info('Shutting down')
+        finally:
+            self.pool.close()
+            self.pool.join()
+            if self.process_pool is not None:
+                self.process_pool.close()
+                self.process_pool.join()
+
+
+def event_id(value):
+    '''The id of an event's resource or parent, which may be an object.'''
+    if isinstance(value, dict):
+        value = value.get(u'gid', value.get(u'id'))
+    return unicode(value) if value is not None else None
+
+
+class WebhookReceiver(object):
+    '''Keeps a ProjectStore up to date from Asana webhook events.
+
+    Asana posts the events of each project to /[Project ID]. Events are queued
+    and the request answered straight away, then a worker thread syncs each
+    project with events to the store, a batch at a time: the tasks named by
+    the events are fetched again, along with their comments if they changed.
+    The project's whole task list is only fetched again when tasks are added
+    to, moved within or removed from it, or for events on other resources.
+
+    :param store: The ProjectStore to keep up to date
+    :param asana_client: The Asana client to make the API calls with
+    :param project_ids: The Asana Project IDs to accept events for
+    :param completed_lookback_hours: An amount in hours to look back for
+    completed tasks, which should cover that of the mail runs
+    :param workers: The number of tasks to fetch comments for concurrently
+    '''
+
+    def __init__(
+            self, store, asana_client, project_ids,
+            completed_lookback_hours=None, workers=1):
+        import Queue
+
+        self.store = store
+        self.asana_client = asana_client
+        self.project_ids = frozenset(project_ids)
+        self.completed_lookback_hours = completed_lookback_hours
+        self.workers = workers
+        self.events = Queue.Queue()
+
+    def sync(self, project_id, stale_task_ids=(), task_ids=None):
+        import dateutil.tz
+
+        self.store.sync_project(
+            self.asana_client, project_id,
+            datetime.datetime.now(dateutil.tz.tzutc()),
+            self.completed_lookback_hours, self.workers, stale_task_ids,
+            task_ids)
+
+    def secret(self, project_id):
+        try:
+            with open(self.store.path(project_id, 'secret')) as secret_file:
+                return secret_file.read()
+        except IOError:
+            return None
+
+    def handle(self, project_id, headers, body):
+        '''Handles a request posted by Asana.
+
+        A request with an X-Hook-Secret header is the handshake of a new
+        webhook, its secret is kept to verify the X-Hook-Signature of the
+        events posted later. Handshakes are only accepted while the project
+        has no secret, and events are rejected until it has one. To register
+        a project's webhook again, delete its secret file from the store.
+
+        :return: A (status code, dict of response headers) tuple
+        '''
+        import hmac
+
+        if project_id not in self.project_ids:
+            return 404, {}
+        secret = self.secret(project_id)
+        hook_secret = headers.get('X-Hook-Secret')
+        if hook_secret:
+            if secret is not None:
+                log.warning(
+                    'Rejected a webhook handshake for project {0}, which '
+                    'already has a secret'.format(project_id))
+                return 403, {}
+            log.info('Webhook handshake for project {0}'.format(project_id))
+            if not os.path.isdir(self.store.store_dir):
+                os.makedirs(self.store.store_dir)
+            with open(self.store.path(project_id, 'secret'), 'w') as (
+                    secret_file):
+                secret_file.write(hook_secret)
+            return 200, {'X-Hook-Secret': hook_secret}
+        if secret is None:
+            log.warning(
+                'Rejected webhook events for project {0} before its '
+                'handshake'.format(project_id))
+            return 401, {}
+        signature = hmac.new(secret, body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(
+                signature, headers.get('X-Hook-Signature', '')):
+            log.warning('Rejected webhook events with a bad signature')
+            return 401, {}
+        try:
+            events = json.loads(body)[u'events']
+        except (ValueError, KeyError, TypeError):
+            return 400, {}
+        if events:
+            self.events.put((project_id, events))
+        return 200, {}
+
+    def process_events(self, block=True):
+        '''Syncs the projects of the queued events to the store.
+
+        Events queued while a batch is synced are synced in the next batch.
+
+        :param block: Whether to wait for events if none are queued
+        :return: The ids of the projects synced
+        '''
+        import Queue
+
+        try:
+            batch = [self.events.get(block)]
+        except Queue.Empty:
+            return []
+        while True:
+            try:
+                batch.append(self.events.get_nowait())
+            except Queue.Empty:
+                break
+        stale_task_ids = collections.OrderedDict()
+        changed_task_ids = {}
+        full_syncs = set()
+        for project_id, events in batch:
+            stale = stale_task_ids.setdefault(project_id, set())
+            changed = changed_task_ids.setdefault(project_id, set())
+            for event in events:
+                resource = event.get(u'resource')
+                resource_type = event.get(u'type') or (
+                    resource.get(u'resource_type')
+                    if isinstance(resource, dict) else None)
+                if resource_type == u'story' and event.get(u'parent'):
+                    # A story's parent is its task
+                    stale.add(event_id(event[u'parent']))
+                    changed.add(event_id(event[u'parent']))
+                elif (resource_type == u'task' and
+                        event.get(u'action') in (u'changed', u'deleted')):
+                    changed.add(event_id(resource))
+                else:
+                    # Tasks added, moved or removed change the task list
+                    full_syncs.add(project_id)
+        for project_id, task_ids in stale_task_ids.items():
+            log.info('Syncing project {0} after webhook events'.format(
+                project_id))
+            try:
+                self.sync(
+                    project_id, task_ids,
+                    None if project_id in full_syncs
+                    else changed_task_ids[project_id])
+            except Exception:
+                log.exception('Could not sync project {0}'.format(project_id))
+        return list(stale_task_ids)
+
+    def register(self, target_url):
+        '''Creates a webhook for each project, posting to target_url.
+
+        Asana makes the handshake request before this returns, so the server
+        must already be running.
+        '''
+        for project_id in sorted(self.project_ids):
+            log.info('Registering webhook for project {0}'.format(project_id))
+            self.asana_client.webhooks.create({
+                'resource': project_id, 'target': '{0}/{1}'.format(
+                    target_url.rstrip('/'), project_id)})
+
+    def create_server(self, host='', port=DEFAULT_WEBHOOK_PORT):
+        '''Creates the HTTP server to receive events with.'''
+        import BaseHTTPServer
+
+        receiver = self
+
+        class WebhookRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                status, headers = receiver.handle(
+                    self.path.strip('/'), self.headers, body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                log.info('Webhook request: {0}'.format(format % args))
+
+        return BaseHTTPServer.HTTPServer((host, port), WebhookRequestHandler)
+
+
+def create_webhook_parser():
+    parser = argparse.ArgumentParser(
+        prog='asana_mailer.py webhook',
+        description='Keeps a store of projects up to date from Asana webhook '
+        'events, for mail runs with --from-store',
+        fromfile_prefix_chars='@')
+    parser.add_argument('store_dir', help='the store directory')
+    parser.add_argument('pat', help='your asana PAT (personal access token)')
+    parser.add_argument(
+        'project_ids', nargs='+', metavar='project_id',
+        help='the asana project ids to keep up to date')
+    parser.add_argument(
+        '--host', default='',
+        help='the address to listen on (default: all addresses)')
+    parser.add_argument(
+        '--port', type=int, default=DEFAULT_WEBHOOK_PORT,
+        help='the port to listen on (default: {0})'.format(
+            DEFAULT_WEBHOOK_PORT))
+    parser.add_argument(
+        '--register', metavar='URL',
+        help='create webhooks for the projects, posting to URL/[project id], '
+        'the address Asana reaches this server at')
+    parser.add_argument(
+        '-c', '--completed', type=int, dest='completed_lookback_hours',
+        metavar='HOURS',
+        help='keep non-archived tasks completed within the past hours '
+        'specified, at least as many as the mail runs show')
+    parser.add_argument(
+        '--fetch-workers', type=int, default=1, metavar='WORKERS',
+        help='the number of tasks to fetch comments for concurrently '
+        '(default: 1)')
+    add_logging_arguments(parser)
+    return parser
+
+
+def webhook_main(argv):
+    '''Entry point for the webhook command.'''
+    args = create_webhook_parser().parse_args(argv)
+    init_logging(args.log_file, args.log_format, args.log_sample)
+    receiver = WebhookReceiver(
+        ProjectStore(args.store_dir),
+        create_asana_client(args.pat, workers=args.fetch_workers),
+        args.project_ids, args.completed_lookback_hours, args.fetch_workers)
+    # Start from a full sync, in case events were missed while stopped
+    for project_id in args.project_ids:
+        receiver.sync(project_id)
+
+    def process_events():
+        while True:
+            receiver.process_events()
+    processor = threading.Thread(target=process_events)
+    processor.daemon = True
+    processor.start()
+
+    server = receiver.create_server(args.host, args.port)
+    if args.register:
+        registration = threading.Thread(
+            target=receiver.register, args=(args.register,))
+        registration.daemon = True
+        registration.start()
+    log.info('Receiving webhook events on port {0}'.format(
+        server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('Shutting down')
+    finally:
+        server.server_close()
+
+
+def create_serve_parser():
+    parser = argparse.ArgumentParser(
+        prog='asana_mailer.py serve',
+        description='Runs mailers from a schedule in a resident process')
+    parser.add_argument(
+        'schedule', help='a file of cron expressions followed by mailer '
+        'arguments, one job per line')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=DEFAULT_SERVE_WORKERS,
+        help='the number of jobs to run concurrently (default: {0})'.format(
+            DEFAULT_SERVE_WORKERS))
+    parser.add_argument(
+        '--story-cache-size', type=int, default=DEFAULT_STORY_CACHE_SIZE,
+        metavar='TASKS', help='the number of tasks to cache comments for '
+        '(default: {0})'.format(DEFAULT_STORY_CACHE_SIZE))
+    parser.add_argument(
+        '-j', '--processes', type=int, default=0,
+        help='the number of worker processes shared by all jobs for CPU '
+        'heavy rendering steps (default: 0, render in the worker threads)')
+    add_logging_arguments(parser)
+    return parser
+
+
+def serve_main(argv):
+    '''Entry point for the serve command.'''
+    args = create_serve_parser().parse_args(argv)
+    init_logging(args.log_file, args.log_format, args.log_sample)
+    daemon = MailerDaemon(
+        args.schedule, workers=args.workers,
+        story_cache_size=args.story_cache_size, processes=args.processes)
+    daemon.load_schedule()
+    daemon.serve_forever()
+
+
+def create_flush_parser():
+    parser = argparse.ArgumentParser(
+        prog='asana_mailer.py flush',
+        description='Sends the emails waiting in a spool directory',
+        fromfile_prefix_chars='@')
+    parser.add_argument('spool_dir', help='the spool directory')
+    parser.add_argument(
+        '--mail-server', metavar='HOSTNAME', default='localhost',
+        help='the hostname of the mail server to send email from '
+        '(default: localhost)')
+    parser.add_argument(
+        '--username', metavar='ADDRESS', default=None,
+        help='the username to authenticate to the outgoing (SMTP) mail server '
+        'over SSL')
+    parser.add_argument(
+        '--password', metavar='ADDRESS', default=None,
+        help='the password to authenticate to the outgoing (SMTP) mail server '
+        'over SSL')
+    parser.add_argument(
+        '--port', type=int, default=None,
+        help='the port of the outgoing (SMTP) mail server')
+    parser.add_argument(
+        '--retries', type=int, default=DEFAULT_SEND_RETRIES,
+        help='the number of times to retry sending an email (default: '
+        '{0})'.format(DEFAULT_SEND_RETRIES))
+    parser.add_argument(
+        '-w', '--workers', type=int, default=1,
+        help='the number of SMTP connections to send over at once '
+        '(default: 1)')
+    parser.add_argument(
+        '--max-recipients', type=int, metavar='N',
+        help='send to at most this many recipients per SMTP transaction, '
+        'batching recipients by domain')
+    parser.add_argument(
+        '--claim-timeout', type=int, metavar='SECONDS',
+        default=SPOOL_CLAIM_TIMEOUT,
+        help='resend emails claimed by a flush this many seconds ago that '
+        'were never sent (default: {0})'.format(SPOOL_CLAIM_TIMEOUT))
+    add_logging_arguments(parser)
+    return parser
+
+
+def flush_main(argv):
+    '''Entry point for the flush command.
+
+    Exits with a non-zero status if any emails are left in the spool.
+    '''
+    args = create_flush_parser().parse_args(argv)
+    init_logging(args.log_file, args.log_format, args.log_sample)
+    flush_spool(
+        args.spool_dir, args.mail_server, args.username, args.password,
+        args.port, retries=args.retries, workers=args.workers,
+        max_recipients=args.max_recipients, claim_timeout=args.claim_timeout)
+    new_dir = os.path.join(args.spool_dir, 'new')
+    if os.path.isdir(new_dir) and os.listdir(new_dir):
+        sys.exit(1)
+
+
+def create_pack_parser():
+    parser = argparse.ArgumentParser(
+        prog='asana_mailer.py pack',
+        description='Compiles templates into a pack for --template-pack, '
+        'recording the templates, fields and filters each of them uses')
+    parser.add_argument('pack_dir', help='the directory to write the pack to')
+    parser.add_argument(
+        'templates', nargs='*', metavar='TEMPLATE',
+        help='the templates to pack, with those they extend or include '
+        '(default: every template)')
+    parser.add_argument(
+        '--templates-dir', default='templates', metavar='DIR',
+        help='the directory of the templates (default: templates)')
+    add_logging_arguments(parser)
+    return parser
+
+
+def pack_main(argv):
+    '''Entry point for the pack command.
+
+    Prints what each packed template was found to use.
+    '''
+    args = create_pack_parser().parse_args(argv)
+    init_logging(args.log_file, args.log_format, args.log_sample)
+    pack = build_template_pack(
+        args.pack_dir, args.templates_dir, args.templates or None)
+    for template_name, analysis in sorted(pack[u'templates'].items()):
+        sys.stdout.write(
+            '{0}: extends/includes {1}; fields {2}; filters {3}{4}\n'.format(
+                template_name,
+                ', '.join(analysis[u'depends']) or 'nothing',
+                ', '.join(analysis[u'fields']) or 'none',
+                ', '.join(analysis[u'filters']) or 'none',
+                '' if analysis[u'complete'] else
+                ' (incomplete, templates are chosen at render time)'))
+    log.info('Packed {0} templates into {1}'.format(
+        len(pack[u'templates']), args.pack_dir))
+
+
+COMMANDS = {
+    'flush': flush_main,
+    'pack': pack_main,
+    'serve': serve_main,
+    'webhook': webhook_main,
+}
+
+
+def main(argv=None):
+    '''The main function for generating the mailer.
+
+    Based on the arguments, the mailer generates a Project object with its
+    appropriate Section and Tasks objects, and then renders templates
+    accordingly. This can either be written out to two files, or can be mailed
+    out using a SMTP server running on localhost.
+
+    If the first argument names one of the COMMANDS, that command is run
+    instead.
+    '''
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        COMMANDS[argv[0]](argv[1:])
+        return
+
+    parser = create_cli_parser()
+    args = parser.parse_args(argv)
+    validate_args(parser, args)
+    init_logging(args.log_file, args.log_format, args.log_sample)
+    run_mailer(args)
     log.info('Finished')
 
 
@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2013 Palantir Technologies
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Benchmarks for Asana Mailer.
+
+Each benchmark is a subcommand, e.g. `python bench_asana_mailer.py startup`.
+Benchmarks that accept a budget exit with a non-zero status when the budget is
+exceeded, so they can be run as part of CI.
+
+:copyright: (c) 2013 by Palantir Technologies
+:license: Apache 2.0, see LICENSE for more details.
+'''
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = (
+    'asana', 'dateutil', 'jinja2', 'lxml', 'premailer', 'smtplib')
+
+
+def time_command(command, repeat):
+    '''Runs a command repeatedly, returning the wall clock time of each run.
+
+    :param command: The command (a list of arguments) to run
+    :param repeat: The number of times to run the command
+    :return: A list of run times in seconds
+    '''
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(
+                command, cwd=BENCH_DIR, stdout=devnull, stderr=devnull)
+            timings.append(time.time() - start)
+    return timings
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def percentile(values, fraction):
+    '''The nearest-rank percentile of values, e.g. fraction 0.99 for p99.'''
+    values = sorted(values)
+    rank = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def report(name, timings):
+    print('{0:<30} min {1:8.1f} ms   median {2:8.1f} ms'.format(
+        name, min(timings) * 1000, median(timings) * 1000))
+
+
+def bench_startup(args):
+    '''Measures interpreter startup, module import and --help times.
+
+    The heavy dependencies are imported on their own for comparison, as they
+    are what the lazy imports in asana_mailer avoid paying for.
+    '''
+    python = sys.executable
+    commands = (
+        ('interpreter', [python, '-c', 'pass']),
+        ('import asana_mailer', [python, '-c', 'import asana_mailer']),
+        ('asana_mailer.py --help', [python, 'asana_mailer.py', '--help']),
+        ('import heavy dependencies', [
+            python, '-c', 'import asana, dateutil.parser, jinja2, premailer']),
+    )
+    results = {}
+    for name, command in commands:
+        results[name] = time_command(command, args.repeat)
+        report(name, results[name])
+
+    imported = subprocess.check_output([
+        python, '-c',
+        'import sys, asana_mailer; print(" ".join(name for name in {0!r} '
+        'if name in sys.modules))'.format(HEAVY_MODULES)], cwd=BENCH_DIR)
+    imported = imported.decode('utf-8').strip()
+    print('heavy modules imported by asana_mailer: {0}'.format(
+        imported or 'none'))
+
+    import_ms = (
+        min(results['import asana_mailer']) -
+        min(results['interpreter'])) * 1000
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        print('FAIL: importing asana_mailer took {0:.1f} ms (budget {1} ms)'
+              .format(import_ms, args.max_import_ms))
+        return 1
+    if imported and args.max_import_ms is not None:
+        print('FAIL: asana_mailer imported {0} at import time'.format(
+            imported))
+        return 1
+    return 0
+
+
+class SyntheticAsanaClient(object):
+    '''Stands in for an Asana client, serving a generated project of sections
+    of tasks, each task with a description and comments.
+    '''
+
+    class Projects(object):
+        def __init__(self, tasks_json):
+            self.tasks_json = tasks_json
+
+        def find_by_id(self, project_id):
+            return {u'name': u'Synthetic Project', u'notes': u''}
+
+        def tasks(self, project_id, params=None, expand=None):
+            return iter(self.tasks_json)
+
+    class Tasks(object):
+        def __init__(self, stories_json):
+            self.stories_json = stories_json
+
+        def stories(self, task_id):
+            return list(self.stories_json)
+
+        def subtasks(self, task_id, expand=None):
+            return []
+
+    def __init__(
+            self, sections, tasks_per_section, description_length,
+            comments_per_task):
+        tasks_json = []
+        for section in range(sections):
+            tasks_json.append({
+                u'id': u's{0}'.format(section),
+                u'name': u'Section {0}:'.format(section), u'tags': []})
+            for task in range(tasks_per_section):
+                tasks_json.append({
+                    u'id': u'{0}-{1}'.format(section, task),
+                    u'name': u'Task {0} of section {1}'.format(task, section),
+                    u'assignee': {u'name': u'User {0}'.format(task % 7)},
+                    u'completed': False,
+                    u'notes': u'x' * description_length,
+                    u'due_on': u'2013-06-10',
+                    u'tags': [{u'name': u'tag{0}'.format(task % 3)}],
+                    u'modified_at': u'2013-06-03T12:00:00.000Z'})
+        stories_json = [
+            {u'text': u'Comment {0}'.format(i), u'type': u'comment',
+             u'created_by': {u'name': u'User'},
+             u'created_at': u'2013-06-03T12:00:00.000Z'}
+            for i in range(comments_per_task)]
+        self.projects = self.Projects(tasks_json)
+        self.tasks = self.Tasks(stories_json)
+
+
+def bench_fetch(args):
+    '''Times building a project from a recorded cassette with each number of
+    fetch workers, to compare serial and concurrent comment fetching offline.
+    '''
+    import asana_mailer
+
+    asana_mailer.init_logging(args.log_file)
+    for workers in args.workers:
+        timings = []
+        for _ in range(args.repeat):
+            replayer = asana_mailer.ReplayAsanaClient(
+                args.cassette, args.latency_scale)
+            start = time.time()
+            asana_mailer.Project.create_project(
+                replayer, args.project_id, replayer.current_time_utc,
+                completed_lookback_hours=args.completed_lookback_hours,
+                fetch_workers=workers)
+            timings.append(time.time() - start)
+        report('{0} fetch workers'.format(workers), timings)
+    return 0
+
+
+def bench_memory(args):
+    '''Builds and renders a synthetic project while tracing memory, to check
+    that the memory used by large digests stays within a budget.
+    '''
+    import datetime
+    import asana_mailer
+
+    asana_mailer.init_logging(args.log_file)
+    client = SyntheticAsanaClient(
+        args.sections, args.tasks_per_section, args.description_length,
+        args.comments_per_task)
+    current_time_utc = datetime.datetime(2013, 6, 3, 12)
+    tracer = asana_mailer.MemoryTracer(args.top)
+    tracer.start()
+    try:
+        project = asana_mailer.Project.create_project(
+            client, 'synthetic', current_time_utc,
+            completed_lookback_hours=None, tracer=tracer)
+        asana_mailer.generate_templates(
+            project, 'Project.html', 'Project.markdown',
+            current_time_utc.date(), current_time_utc,
+            skip_inline_css=args.skip_inline_css, tracer=tracer)
+    finally:
+        tracer.stop()
+    print(tracer.report())
+
+    peak_mb = tracer.peak / 1048576.0
+    if args.max_peak_mb is not None and peak_mb > args.max_peak_mb:
+        print('FAIL: peak memory was {0:.1f} MB (budget {1} MB)'.format(
+            peak_mb, args.max_peak_mb))
+        return 1
+    return 0
+
+
+class SmtpSink(object):
+    '''A local SMTP server that accepts mail and throws it away.
+
+    Each connection is served by its own thread, so that concurrent senders
+    aren't serialized by the sink. Every message is delayed by latency
+    seconds before it's accepted, and a failure_rate fraction of messages is
+    rejected with a temporary failure.
+
+    :param latency: The number of seconds to take to accept each message
+    :param failure_rate: The fraction of messages to reject
+    :param seed: The seed of the failures, for repeatable runs
+    '''
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        import SocketServer
+
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.transactions = 0
+        self.recipients = 0
+        self.failures = 0
+        sink = self
+
+        class SmtpHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                sink.serve(self.rfile, self.wfile)
+
+        class SmtpServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = SmtpServer(('127.0.0.1', 0), SmtpHandler)
+        # smtplib takes the port as part of the host name
+        self.address = '127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def serve(self, rfile, wfile):
+        '''Speaks just enough SMTP to accept mail from smtplib.'''
+        def reply(line):
+            wfile.write(line + '\r\n')
+            wfile.flush()
+
+        with self.lock:
+            self.connections += 1
+        recipients = 0
+        reply('220 sink ESMTP')
+        while True:
+            line = rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ('HELO', 'EHLO', 'RSET', 'NOOP'):
+                reply('250 OK')
+            elif command == 'MAIL':
+                recipients = 0
+                reply('250 OK')
+            elif command == 'RCPT':
+                recipients += 1
+                reply('250 OK')
+            elif command == 'DATA':
+                reply('354 End data with <CR><LF>.<CR><LF>')
+                while True:
+                    line = rfile.readline()
+                    if not line or line.rstrip('\r\n') == '.':
+                        break
+                if self.latency:
+                    time.sleep(self.latency)
+                with self.lock:
+                    failed = self.random.random() < self.failure_rate
+                    if failed:
+                        self.failures += 1
+                    else:
+                        self.transactions += 1
+                        self.recipients += recipients
+                reply('451 Injected failure' if failed else '250 OK')
+            elif command == 'QUIT':
+                reply('221 Bye')
+                return
+            else:
+                reply('502 Command not implemented')
+
+
+def bench_loadtest(args):
+    '''Sends synthetic digests of each size to many recipients through a local
+    SMTP sink, measuring the throughput and latency of the delivery path.
+    '''
+    import datetime
+    import asana_mailer
+
+    asana_mailer.init_logging(args.log_file)
+    sink = SmtpSink(args.latency_ms / 1000.0, args.failure_rate, args.seed)
+    sink.start()
+    recipients = [
+        'user{0}@example{1}.com'.format(i, i % args.domains)
+        for i in range(args.recipients)]
+    current_time_utc = datetime.datetime(2013, 6, 3, 12)
+    over_budget = False
+    try:
+        for tasks in args.tasks:
+            sections = max(tasks // 50, 1)
+            client = SyntheticAsanaClient(
+                sections, max(tasks // sections, 1), args.description_length,
+                args.comments_per_task)
+            project = asana_mailer.Project.create_project(
+                client, 'synthetic', current_time_utc,
+                completed_lookback_hours=None)
+            rendered_html, rendered_text = asana_mailer.generate_templates(
+                project, 'Project.html', 'Project.markdown',
+                current_time_utc.date(), current_time_utc,
+                skip_inline_css=True)
+            size_kb = (
+                len(rendered_html.encode('utf-8')) +
+                len(rendered_text.encode('utf-8'))) / 1024.0
+
+            transactions = sink.transactions
+
+            def send(_):
+                start = time.time()
+                sent = asana_mailer.send_email(
+                    project, sink.address, 'mailer@example.com',
+                    recipients[:], None, rendered_html, rendered_text,
+                    str(current_time_utc.date()),
+                    max_recipients=args.max_recipients,
+                    workers=args.send_workers)
+                return time.time() - start, sent
+
+            start = time.time()
+            results = asana_mailer.map_concurrently(
+                send, range(args.messages), args.concurrency)
+            elapsed = time.time() - start
+            latencies = [latency for latency, _ in results]
+            failed = sum(1 for _, sent in results if not sent)
+            p99_ms = percentile(latencies, 0.99) * 1000
+            print(
+                '{0:>6} tasks {1:8.1f} KB   {2:6.1f} emails/s   {3:8.1f} '
+                'transactions/s   p50 {4:8.1f} ms   p99 {5:8.1f} ms   '
+                '{6} failed   peak RSS {7:.1f} MB'.format(
+                    tasks, size_kb, len(results) / elapsed,
+                    (sink.transactions - transactions) / elapsed,
+                    percentile(latencies, 0.5) * 1000, p99_ms, failed,
+                    asana_mailer.MemoryTracer.max_rss() / 1048576.0))
+            if args.max_p99_ms is not None and p99_ms > args.max_p99_ms:
+                over_budget = True
+    finally:
+        sink.stop()
+    print('sink: {0} connections, {1} transactions, {2} recipients, {3} '
+          'injected failures'.format(
+              sink.connections, sink.transactions, sink.recipients,
+              sink.failures))
+
+    if over_budget:
+        print('FAIL: p99 send latency exceeded {0} ms'.format(
+            args.max_p99_ms))
+        return 1
+    return 0
+
+
+def create_cli_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for Asana Mailer')
+    parser.add_argument(
+        '--log-file', default=os.devnull,
+        help="where to write the mailer's log, '-' for standard error "
+        '(default: discarded)')
+    subparsers = parser.add_subparsers(title='benchmarks')
+
+    startup_parser = subparsers.add_parser(
+        'startup', help='time interpreter startup, import and --help')
+    startup_parser.add_argument(
+        '-n', '--repeat', type=int, default=10,
+        help='the number of times to run each command (default: 10)')
+    startup_parser.add_argument(
+        '--max-import-ms', type=float, metavar='MS',
+        help='fail if importing asana_mailer takes longer than this (over '
+        'bare interpreter startup) or imports a heavy dependency')
+    startup_parser.set_defaults(func=bench_startup)
+
+    fetch_parser = subparsers.add_parser(
+        'fetch', help='time building a project from a recorded cassette')
+    fetch_parser.add_argument(
+        'cassette', help='a cassette recorded with asana_mailer.py --record')
+    fetch_parser.add_argument(
+        'project_id', help='the project id the cassette was recorded for')
+    fetch_parser.add_argument(
+        '-w', '--workers', type=int, nargs='+', default=[1, 4, 8],
+        help='the numbers of fetch workers to compare (default: 1 4 8)')
+    fetch_parser.add_argument(
+        '-l', '--completed-lookback-hours', type=int,
+        help='the lookback the cassette was recorded with')
+    fetch_parser.add_argument(
+        '--latency-scale', type=float, default=1.0, metavar='FACTOR',
+        help='scale the recorded latencies by this factor (default: 1.0)')
+    fetch_parser.add_argument(
+        '-n', '--repeat', type=int, default=3,
+        help='the number of times to build the project (default: 3)')
+    fetch_parser.set_defaults(func=bench_fetch)
+
+    memory_parser = subparsers.add_parser(
+        'memory', help='trace memory while building a synthetic project')
+    memory_parser.add_argument(
+        '--sections', type=int, default=20,
+        help='the number of sections to generate (default: 20)')
+    memory_parser.add_argument(
+        '--tasks-per-section', type=int, default=100,
+        help='the number of tasks per section (default: 100)')
+    memory_parser.add_argument(
+        '--description-length', type=int, default=500,
+        help='the length of each task description (default: 500)')
+    memory_parser.add_argument(
+        '--comments-per-task', type=int, default=3,
+        help='the number of comments per task (default: 3)')
+    memory_parser.add_argument(
+        '--skip-inline-css', action='store_true',
+        help='skip inlining CSS into the HTML digest')
+    memory_parser.add_argument(
+        '--top', type=int, default=10,
+        help='the number of allocation sites to report per phase, where '
+        'tracemalloc is available (default: 10)')
+    memory_parser.add_argument(
+        '--max-peak-mb', type=float, metavar='MB',
+        help='fail if the peak memory of any phase exceeds this')
+    memory_parser.set_defaults(func=bench_memory)
+
+    loadtest_parser = subparsers.add_parser(
+        'loadtest', help='send synthetic digests through a local SMTP sink')
+    loadtest_parser.add_argument(
+        '--tasks', type=int, nargs='+', default=[10, 100, 1000],
+        help='the numbers of tasks of the digests to send (default: 10 100 '
+        '1000)')
+    loadtest_parser.add_argument(
+        '--description-length', type=int, default=500,
+        help='the length of each task description (default: 500)')
+    loadtest_parser.add_argument(
+        '--comments-per-task', type=int, default=3,
+        help='the number of comments per task (default: 3)')
+    loadtest_parser.add_argument(
+        '--recipients', type=int, default=1000,
+        help='the number of recipients of each email (default: 1000)')
+    loadtest_parser.add_argument(
+        '--domains', type=int, default=10,
+        help='the number of domains the recipients are spread over '
+        '(default: 10)')
+    loadtest_parser.add_argument(
+        '--max-recipients', type=int, default=100, metavar='N',
+        help='the recipients per SMTP transaction (default: 100)')
+    loadtest_parser.add_argument(
+        '--send-workers', type=int, default=4, metavar='N',
+        help='the SMTP connections each email is sent over (default: 4)')
+    loadtest_parser.add_argument(
+        '-n', '--messages', type=int, default=20,
+        help='the number of emails to send of each size (default: 20)')
+    loadtest_parser.add_argument(
+        '-c', '--concurrency', type=int, default=4,
+        help='the number of emails to send at once (default: 4)')
+    loadtest_parser.add_argument(
+        '--latency-ms', type=float, default=0.0, metavar='MS',
+        help='how long the sink takes to accept each transaction (default: '
+        '0)')
+    loadtest_parser.add_argument(
+        '--failure-rate', type=float, default=0.0, metavar='FRACTION',
+        help='the fraction of transactions the sink rejects (default: 0)')
+    loadtest_parser.add_argument(
+        '--seed', type=int,
+        help='the seed of the injected failures, for repeatable runs')
+    loadtest_parser.add_argument(
+        '--max-p99-ms', type=float, metavar='MS',
+        help='fail if the p99 latency of sending an email exceeds this')
+    loadtest_parser.set_defaults(func=bench_loadtest)
+
+    return parser
+
+
+def main():
+    args = create_cli_parser().parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
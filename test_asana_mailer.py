@@ -1,13 +1,29 @@
 import argparse
 import codecs
 import datetime
+import email.mime.text
 import glob
+import hashlib
+import itertools
+import json
+import multiprocessing.pool
 import os
 import os.path
+import pickle
+import shutil
 import smtplib
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
-import dateutil
+import asana.error
+import dateutil.parser
+import dateutil.tz
 import mock
 
 import asana_mailer
@@ -107,7 +123,8 @@ class ProjectTestCase(unittest.TestCase):
             mock_asana, u'123', current_time_utc)
         self.assertEquals(new_project.sections, new_sections)
         mock_create_sections.assert_called_once_with(
-            project_tasks_json, task_comments)
+            project_tasks_json, task_comments, pool=None, shard_size=None,
+            limits=None)
         mock_filter_tasks.assert_called_once_with(
             current_time_utc, section_filters=None, task_filters=None)
 
@@ -137,8 +154,10 @@ class ProjectTestCase(unittest.TestCase):
             mock_asana, u'123', current_time_utc,
             section_filters=section_filters)
         self.assertEquals(new_project.sections, new_sections)
+        # Only the section headers are created for filtered out sections
         mock_create_sections.assert_called_once_with(
-            project_tasks_json, {})
+            project_tasks_json[:1], {}, pool=None, shard_size=None,
+            limits=None)
         mock_filter_tasks.assert_called_once_with(
             current_time_utc, section_filters=section_filters,
             task_filters=None)
@@ -155,7 +174,8 @@ class ProjectTestCase(unittest.TestCase):
             task_filters=task_filters)
         self.assertEquals(new_project.sections, new_sections)
         mock_create_sections.assert_called_once_with(
-            project_tasks_json, {})
+            project_tasks_json[:1], {}, pool=None, shard_size=None,
+            limits=None)
         mock_filter_tasks.assert_called_once_with(
             current_time_utc, section_filters=None, task_filters=task_filters)
 
@@ -175,10 +195,155 @@ class ProjectTestCase(unittest.TestCase):
         remove_not_comments = dict(task_comments)
         del remove_not_comments[u'456']
         mock_create_sections.assert_called_once_with(
-            project_tasks_json, remove_not_comments)
+            project_tasks_json, remove_not_comments, pool=None,
+            shard_size=None, limits=None)
         mock_filter_tasks.assert_called_once_with(
             current_time_utc, section_filters=None, task_filters=None)
 
+        # Story Cache
+        mock_create_sections.reset_mock()
+        for i, task in enumerate(project_tasks_json):
+            task[u'modified_at'] = now
+        story_cache = asana_mailer.StoryCache()
+        story_cache.set(u'123', now, [])
+        story_cache.set(u'456', u'older', [{u'text': u'stale'}])
+        mock_asana.tasks.stories.reset_mock()
+        mock_asana.tasks.stories.side_effect = [task_comments_json[-1]]
+        new_project = asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc, story_cache=story_cache)
+        mock_asana.tasks.stories.assert_called_once_with(u'456')
+        mock_create_sections.assert_called_once_with(
+            project_tasks_json, {}, pool=None, shard_size=None,
+            limits=None)
+        self.assertEqual(story_cache.get(u'456', now), [])
+
+        # Concurrent fetching
+        mock_create_sections.reset_mock()
+        mock_asana.tasks.stories.side_effect = None
+        mock_asana.tasks.stories.return_value = [
+            {u'text': u'blah', u'type': u'comment'}]
+        new_project = asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc, fetch_workers=2)
+        mock_create_sections.assert_called_once_with(project_tasks_json, {
+            u'123': [{u'text': u'blah', u'type': u'comment'}],
+            u'456': [{u'text': u'blah', u'type': u'comment'}]},
+            pool=None, shard_size=None,
+            limits=None)
+
+    def test_create_project_prefetch(self):
+        stories_fetched = threading.Event()
+        waited = []
+
+        def task_json(task_id, name):
+            return {
+                u'id': task_id, u'name': name, u'tags': [], u'assignee': None,
+                u'completed': False, u'notes': u'', u'due_on': None}
+
+        def tasks(project_id, params=None, expand=None):
+            yield task_json(u'1', u'Section:')
+            yield task_json(u'2', u'First page task')
+            # The first page's comments are fetched while the next page
+            # downloads
+            waited.append(stories_fetched.wait(5))
+            yield task_json(u'3', u'Second page task')
+
+        def stories(task_id):
+            if task_id == u'2':
+                stories_fetched.set()
+            return [{u'text': task_id, u'type': u'comment'}]
+        mock_asana = mock.MagicMock()
+        mock_asana.projects.find_by_id.return_value = {
+            u'name': u'Project', u'notes': u''}
+        mock_asana.projects.tasks.side_effect = tasks
+        mock_asana.tasks.stories.side_effect = stories
+        current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+        project = asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc)
+        self.assertEqual(waited, [True])
+        self.assertEqual(
+            [(task.name, task.comments) for task in project.sections[0].tasks],
+            [(u'First page task', [{u'text': u'2', u'type': u'comment'}]),
+             (u'Second page task', [{u'text': u'3', u'type': u'comment'}])])
+
+    def test_create_rollup(self):
+        def task_json(id, name, tags=()):
+            return {
+                u'id': id, u'name': name, u'assignee': None,
+                u'completed': False, u'notes': u'', u'due_on': None,
+                u'tags': [{u'name': tag} for tag in tags]}
+        projects_json = {
+            u'1': {u'name': u'Alpha', u'notes': u''},
+            u'2': {u'name': u'Beta', u'notes': u''}
+        }
+        projects_tasks_json = {
+            u'1': [
+                task_json(u'10', u'Doing:'),
+                task_json(u'11', u'Alpha Task', [u'urgent']),
+                task_json(u'12', u'Shared Task', [u'urgent'])],
+            u'2': [
+                task_json(u'12', u'Shared Task', [u'urgent']),
+                task_json(u'21', u'Beta Task', [u'urgent']),
+                task_json(u'22', u'Untagged Task'),
+                task_json(u'23', u'Done:'),
+                task_json(u'24', u'Done Task', [u'urgent'])]
+        }
+        fetched = []
+
+        def stories(task_id):
+            fetched.append(task_id)
+            return [{u'text': task_id, u'type': u'comment'}]
+        mock_asana = mock.MagicMock()
+        mock_asana.projects.find_by_id.side_effect = projects_json.get
+        mock_asana.projects.tasks.side_effect = (
+            lambda project_id, **kwargs: projects_tasks_json[project_id])
+        mock_asana.tasks.stories.side_effect = stories
+
+        current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+        rollup = asana_mailer.Project.create_rollup(
+            mock_asana, [u'1', u'2'], current_time_utc,
+            task_filters=frozenset([u'urgent']), fetch_workers=2)
+        self.assertEqual(rollup.id, u'1')
+        self.assertEqual(rollup.name, u'Alpha, Beta')
+        self.assertEqual(
+            [(section.name, [task.name for task in section.tasks])
+             for section in rollup.sections], [
+                (u'Alpha: Doing:', [u'Alpha Task', u'Shared Task']),
+                (u'Beta:', [u'Beta Task']),
+                (u'Beta: Done:', [u'Done Task'])])
+        self.assertEqual(
+            rollup.sections[1].tasks[0].comments,
+            [{u'text': u'21', u'type': u'comment'}])
+        # The shared task's comments are only fetched once
+        self.assertEqual(
+            sorted(fetched), [u'11', u'12', u'21', u'24'])
+
+        # The limit applies to the rollup's sections, leaving out the tasks
+        # already in the rollup
+        fetched[:] = []
+        rollup = asana_mailer.Project.create_rollup(
+            mock_asana, [u'1', u'2'], current_time_utc,
+            task_filters=frozenset([u'urgent']),
+            limits=asana_mailer.DigestLimits(max_tasks_per_section=1))
+        self.assertEqual(
+            [(section.name, [task.name for task in section.tasks],
+              section.omitted_tasks) for section in rollup.sections], [
+                (u'Alpha: Doing:', [u'Alpha Task'], 1),
+                (u'Beta:', [u'Beta Task'], 0),
+                (u'Beta: Done:', [u'Done Task'], 0)])
+        self.assertEqual(sorted(fetched), [u'11', u'21', u'24'])
+        # Each section records the project it's from
+        self.assertEqual(
+            [section.project_id for section in rollup.sections],
+            [u'1', u'2', u'2'])
+
+        # Section filters match the projects' own section names
+        rollup = asana_mailer.Project.create_rollup(
+            mock_asana, [u'1', u'2'], current_time_utc, name=u'Rollup',
+            section_filters=frozenset([u'Done:']))
+        self.assertEqual(rollup.name, u'Rollup')
+        self.assertEqual(
+            [section.name for section in rollup.sections], [u'Beta: Done:'])
+
     def test_add_section(self):
         self.project.add_section('test')
         self.assertNotIn('test', self.project.sections)
@@ -238,6 +403,45 @@ class ProjectTestCase(unittest.TestCase):
         self.assertEquals(len(self.project.sections), 1)
         self.assertEquals(len(self.project.sections[0].tasks), 1)
 
+    def test_filter_changes(self):
+        tasks = [
+            asana_mailer.Task(
+                u'Task {0}'.format(i), None, False, None, None, None, [], [],
+                id=unicode(i))
+            for i in range(5)]
+        self.project.sections = [
+            asana_mailer.Section(u'One:', tasks[:2]),
+            asana_mailer.Section(u'Two:', tasks[2:])]
+        fingerprints = self.project.fingerprints()
+        self.assertEqual(sorted(fingerprints), [u'0', u'1', u'2', u'3', u'4'])
+        del fingerprints[u'4']
+        tasks[1].completed = True
+        tasks[2].comments = [{u'text': u'blah'}]
+        tasks[3].name = u'Renamed'
+        self.project.filter_changes(fingerprints)
+        self.assertEqual(len(self.project.sections), 2)
+        self.assertEqual(
+            [(task.id, task.change)
+             for task in self.project.sections[0].tasks],
+            [(u'1', u'completed')])
+        self.assertEqual(
+            [(task.id, task.change)
+             for task in self.project.sections[1].tasks],
+            [(u'2', u'commented'), (u'3', u'changed'), (u'4', u'new')])
+
+        # Sections without changes are removed
+        self.project.sections = [asana_mailer.Section(u'One:', tasks[:1])]
+        self.project.filter_changes(fingerprints)
+        self.assertEqual(self.project.sections, [])
+
+        # Tasks whose comments weren't fetched are only kept if they're new
+        self.project.sections = [asana_mailer.Section(u'Two:', tasks[2:])]
+        self.project.filter_changes(fingerprints, set([u'2', u'4']))
+        self.assertEqual(
+            [(task.id, task.change)
+             for task in self.project.sections[0].tasks],
+            [(u'3', u'changed'), (u'4', u'new')])
+
 
 class SectionTestCase(unittest.TestCase):
 
@@ -302,6 +506,7 @@ class SectionTestCase(unittest.TestCase):
         self.assertEquals(sections[0].name, u'Test Section:')
         self.assertEquals(len(sections[0].tasks), 2)
         first_task = sections[0].tasks[0]
+        self.assertEquals(first_task.id, u'321')
         self.assertEquals(first_task.name, u'Do Work')
         self.assertEquals(first_task.assignee, u'test_user')
         self.assertEquals(first_task.completed, True)
@@ -352,6 +557,88 @@ class SectionTestCase(unittest.TestCase):
         self.assertIsNone(misc_task.due_date)
         self.assertEquals(misc_task.tags, [])
 
+    def test_create_sections_limits(self):
+        project_tasks_json = [
+            {u'id': u'0', u'name': u'One:', u'tags': []}] + [
+            {
+                u'id': unicode(i), u'name': u'Task {0}'.format(i),
+                u'assignee': None, u'completed': False,
+                u'notes': u'0123456789', u'due_on': None, u'tags': []
+            }
+            for i in range(1, 6)]
+        task_comments = {u'1': [
+            {u'text': u'blah{0}'.format(i), u'type': u'comment'}
+            for i in range(3)]}
+        limits = asana_mailer.DigestLimits(
+            max_tasks_per_section=3, max_description_length=4,
+            max_comments_per_task=1)
+        sections = asana_mailer.Section.create_sections(
+            project_tasks_json, task_comments, limits=limits)
+        self.assertEqual(len(sections[0].tasks), 3)
+        self.assertEqual(sections[0].omitted_tasks, 2)
+        self.assertEqual(sections[0].omitted_task_ids, [u'4', u'5'])
+        first_task = sections[0].tasks[0]
+        self.assertEqual(first_task.description, u'0123\u2026')
+        self.assertEqual(
+            first_task.comments, [{u'text': u'blah2', u'type': u'comment'}])
+        self.assertEqual(first_task.omitted_comments, 2)
+
+        # Comments aren't fetched for the tasks beyond the limit
+        selected_tasks_json, tasks_to_fetch = asana_mailer.select_tasks(
+            project_tasks_json, max_tasks_per_section=3)
+        self.assertEqual(selected_tasks_json, project_tasks_json)
+        self.assertEqual(
+            [task_id for task_id, _ in tasks_to_fetch],
+            [u'0', u'1', u'2', u'3'])
+
+        # Sections whose tasks are all omitted are kept for their note
+        sections = asana_mailer.Section.create_sections(
+            project_tasks_json, {},
+            limits=asana_mailer.DigestLimits(max_tasks_per_section=0))
+        self.assertEqual(
+            [(section.name, section.tasks, section.omitted_tasks)
+             for section in sections], [(u'One:', [], 5)])
+
+        # Each task is 16 bytes of text, the third takes it over 40
+        limits = asana_mailer.DigestLimits(max_bytes=40)
+        sections = asana_mailer.Section.create_sections(
+            project_tasks_json, {}, limits=limits)
+        self.assertEqual(len(sections[0].tasks), 2)
+        self.assertEqual(sections[0].omitted_tasks, 3)
+        self.assertEqual(sections[0].omitted_task_ids, [u'3', u'4', u'5'])
+
+    def test_create_sections_sharded(self):
+        project_tasks_json = [
+            {
+                u'id': unicode(i), u'name': name, u'assignee': None,
+                u'completed': False, u'notes': None, u'due_on': None,
+                u'tags': []
+            }
+            for i, name in enumerate([
+                u'Misc Task', u'One:', u'Task 1', u'Task 2', u'Empty:',
+                u'Two:', u'Task 3', u'Three:', u'Task 4', u'Task 5'])]
+        task_comments = {u'3': [{u'text': u'blah', u'type': u'comment'}]}
+        self.assertEqual(
+            [len(shard) for shard in asana_mailer.shard_tasks_json(
+                project_tasks_json, 3)],
+            [4, 3, 3])
+
+        pool = multiprocessing.pool.ThreadPool(2)
+        try:
+            sharded_sections = asana_mailer.Section.create_sections(
+                project_tasks_json, task_comments, pool=pool, shard_size=3)
+        finally:
+            pool.close()
+            pool.join()
+        sections = asana_mailer.Section.create_sections(
+            project_tasks_json, task_comments)
+        self.assertEqual(
+            [section.to_dict() for section in sharded_sections],
+            [section.to_dict() for section in sections])
+        self.assertEqual(
+            [section.name for section in sections],
+            [u'One:', u'Two:', u'Three:', u'Misc:'])
+
     def test_add_task(self):
         self.section.add_task('test')
         self.assertNotIn('test', self.section.tasks)
@@ -426,6 +713,57 @@ class FiltersTestCase(unittest.TestCase):
         self.assertEqual(asana_mailer.as_date('garbage'), 'garbage')
         self.assertEqual(asana_mailer.as_date(now_str), now_date_str)
 
+    def test_comment_window(self):
+        now = datetime.datetime.now(dateutil.tz.tzutc())
+        comments = [
+            {u'text': unicode(i), u'created_at': (
+                now - datetime.timedelta(hours=10 - i)).isoformat()}
+            for i in range(10)]
+        for policy, expected in (
+                ('all', comments), ('last', comments[-1:]),
+                ('recent:3', comments[-3:]), ('lookback:4', comments[-3:]),
+                ('lookback:0', comments[-1:])):
+            window = asana_mailer.CommentWindow(policy, now)
+            self.assertEqual(window.select(comments), expected)
+            self.assertEqual(window.select(None), None)
+        for policy in ('none', 'last:1', 'recent', 'recent:x', 'lookback:'):
+            with self.assertRaises(ValueError):
+                asana_mailer.CommentWindow(policy)
+            with self.assertRaises(argparse.ArgumentTypeError):
+                asana_mailer.comment_window_policy(policy)
+
+        # The story cache keeps every comment, whatever the window
+        mock_asana = mock.MagicMock()
+        mock_asana.tasks.stories.return_value = [
+            dict(comment, type=u'comment') for comment in comments]
+        story_cache = asana_mailer.StoryCache()
+        task_comments = asana_mailer.fetch_comments(
+            mock_asana, [(u'1', now)], story_cache,
+            comment_window=asana_mailer.CommentWindow('last', now))
+        self.assertEqual(
+            [comment[u'text'] for comment in task_comments[u'1']], [u'9'])
+        self.assertEqual(len(story_cache.get(u'1', now)), 10)
+        task_comments = asana_mailer.fetch_comments(
+            mock_asana, [(u'1', now)], story_cache,
+            comment_window=asana_mailer.CommentWindow('recent:2', now))
+        self.assertEqual(
+            [comment[u'text'] for comment in task_comments[u'1']],
+            [u'8', u'9'])
+        mock_asana.tasks.stories.assert_called_once_with(u'1')
+
+    def test_template_comment_window(self):
+        self.assertEqual(asana_mailer.template_comment_window(
+            ['Default.html', 'Default.markdown']), 'last')
+        self.assertEqual(asana_mailer.template_comment_window(
+            ['Last_Weeks_Comments.html', 'Last_Weeks_Comments.markdown']),
+            'lookback:168')
+        self.assertIsNone(asana_mailer.template_comment_window(
+            ['All_Comments.html', 'Default.markdown']))
+        self.assertIsNone(asana_mailer.template_comment_window(
+            ['Project.html', 'Project.markdown']))
+        self.assertIsNone(asana_mailer.template_comment_window(
+            ['Missing.html', 'Missing.markdown']))
+
 
 class TaskTestCase(unittest.TestCase):
 
@@ -460,6 +798,76 @@ class TaskTestCase(unittest.TestCase):
         self.assertEqual(task.tags, original.tags)
         self.assertEqual(task.comments, original.comments)
 
+    def test_to_dict_from_dict(self):
+        original = type(self).task
+        task_dict = original.to_dict()
+        self.assertEqual(
+            task_dict[u'completion_time'],
+            original.completion_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+        task = asana_mailer.Task.from_dict(task_dict)
+        self.assertEqual(task.to_dict(), task_dict)
+        self.assertEqual(task.completion_time, original.completion_time)
+        # Times in other zones are written in UTC
+        eastern = original.completion_time.astimezone(
+            dateutil.tz.tzoffset(None, -5 * 3600))
+        task_dict[u'completion_time'] = asana_mailer.Task(
+            u'Task', None, True, eastern, None, None, [], None).to_dict()[
+                u'completion_time']
+        self.assertEqual(
+            asana_mailer.Task.from_dict(task_dict).completion_time,
+            original.completion_time)
+        # ISO 8601 times from earlier versions are still read
+        task_dict[u'completion_time'] = eastern.isoformat()
+        self.assertEqual(
+            asana_mailer.Task.from_dict(task_dict).completion_time,
+            original.completion_time)
+        task_dict[u'completion_time'] = None
+        self.assertIsNone(
+            asana_mailer.Task.from_dict(task_dict).completion_time)
+
+    def test_fingerprint(self):
+        task = asana_mailer.Task(
+            u'Task', None, False, None, None, None, [u'b', u'a'], None)
+        fingerprint = task.fingerprint()
+        self.assertEqual(fingerprint[1:], [False, 0])
+        self.assertIsNone(task.change_since(fingerprint))
+        # Round trips through JSON
+        self.assertIsNone(
+            task.change_since(json.loads(json.dumps(fingerprint))))
+        task.tags = [u'a', u'b']
+        self.assertIsNone(task.change_since(fingerprint))
+        self.assertEqual(task.change_since(None), u'new')
+        task.comments = [{u'text': u'blah', u'created_at': u'now'}]
+        self.assertEqual(task.change_since(fingerprint), u'commented')
+        task.completed = True
+        self.assertEqual(task.change_since(fingerprint), u'completed')
+        fingerprint = task.fingerprint()
+        task.comments[0][u'text'] = u'edited'
+        self.assertEqual(task.change_since(fingerprint), u'changed')
+
+        # Comments left out by the limits still count
+        task_json = {
+            u'id': u'1', u'name': u'Task', u'assignee': None,
+            u'completed': False, u'notes': None, u'due_on': None,
+            u'tags': []}
+        comments = [
+            {u'text': u'blah{0}'.format(i), u'created_at': unicode(i)}
+            for i in range(3)]
+        for max_comments in (0, 2):
+            limits = asana_mailer.DigestLimits(
+                max_comments_per_task=max_comments)
+            fingerprint = asana_mailer.Task.create_task(
+                task_json, comments, limits).fingerprint()
+            self.assertEqual(fingerprint[2], 3)
+            task = asana_mailer.Task.create_task(
+                task_json, comments + [{u'text': u'new', u'created_at': u'3'}],
+                limits)
+            self.assertEqual(task.change_since(fingerprint), u'commented')
+            task = asana_mailer.Task.from_dict(
+                asana_mailer.Task.create_task(
+                    task_json, comments, limits).to_dict())
+            self.assertIsNone(task.change_since(fingerprint))
+
     def test_tags_in(self):
         filter_set = set()
         self.assertEqual(type(self).task.tags_in(filter_set), True)
@@ -471,6 +879,799 @@ class TaskTestCase(unittest.TestCase):
         self.assertEqual(type(self).task.tags_in(filter_set), False)
 
 
+class ProjectStatsTestCase(unittest.TestCase):
+
+    def test_stats(self):
+        now = datetime.datetime(2013, 6, 3, 12, tzinfo=dateutil.tz.tzutc())
+
+        def hours_ago(hours):
+            return now - datetime.timedelta(hours=hours)
+        project = asana_mailer.Project(u'123', u'Project', None, [
+            asana_mailer.Section(u'One:', [
+                asana_mailer.Task(
+                    u'Done', u'ann', True, hours_ago(2), None,
+                    u'2013-06-01', [u'a'], None, id=u'1'),
+                asana_mailer.Task(
+                    u'Late', u'bob', False, None, None, u'2013-06-01',
+                    [u'a', u'b'], None, id=u'2')]),
+            asana_mailer.Section(u'Two:', [
+                asana_mailer.Task(
+                    u'Also Late', None, False, None, None, u'2013-06-02',
+                    [u'b'], None, id=u'3'),
+                asana_mailer.Task(
+                    u'Due Today', u'bob', False, None, None, u'2013-06-03',
+                    [], None, id=u'4'),
+                asana_mailer.Task(
+                    u'Done Earlier', u'bob', True, hours_ago(10), None, None,
+                    [], None, id=u'5')])])
+        stats = asana_mailer.ProjectStats(project, now)
+        self.assertIsNone(stats._columns)
+        self.assertEqual(stats.total, 5)
+        self.assertEqual(stats.completed, 2)
+        self.assertEqual(stats.overdue, 2)
+        self.assertEqual(
+            stats.overdue_by_assignee(), [(None, 1), (u'bob', 1)])
+        self.assertEqual(stats.completion_by_section(), [
+            (u'One:', 1, 2, 0.5), (u'Two:', 1, 3, 1 / 3.0)])
+        self.assertEqual(stats.tagged(u'a'), 2)
+        self.assertEqual(stats.tagged(u'b'), 2)
+        self.assertEqual(stats.tagged(u'c'), 0)
+        self.assertEqual(stats.burndown(12, 3), [
+            (hours_ago(12), 5), (hours_ago(8), 4), (hours_ago(4), 4),
+            (now, 3)])
+
+        # Only the columns are pickled, for the shards of a render
+        unpickled = pickle.loads(pickle.dumps(
+            asana_mailer.ProjectStats(project, now)))
+        self.assertIsNone(unpickled.project)
+        self.assertEqual(unpickled.total, 5)
+        self.assertEqual(
+            unpickled.completion_by_section(), stats.completion_by_section())
+
+
+class AsanaClientTestCase(unittest.TestCase):
+
+    def test_map_concurrently(self):
+        items = range(10)
+        self.assertEqual(
+            asana_mailer.map_concurrently(lambda i: i * 2, items, 1),
+            [i * 2 for i in items])
+        threads = set()
+
+        def double(i):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.01)
+            return i * 2
+
+        self.assertEqual(
+            asana_mailer.map_concurrently(double, items, 4),
+            [i * 2 for i in items])
+        self.assertGreater(len(threads), 1)
+        self.assertEqual(asana_mailer.map_concurrently(double, [], 4), [])
+
+    def test_imap_concurrently(self):
+        called = threading.Event()
+        waited = []
+
+        def items():
+            yield 0
+            # The call for the first item runs while the next is produced
+            waited.append(called.wait(5))
+            yield 1
+
+        def double(i):
+            called.set()
+            return i * 2
+
+        for workers in (1, 4):
+            called.clear()
+            self.assertEqual(
+                list(asana_mailer.imap_concurrently(double, items(), workers)),
+                [(0, 0), (1, 2)])
+        self.assertEqual(waited, [True, True])
+
+    def test_prefetch(self):
+        self.assertEqual(
+            list(asana_mailer.prefetch(iter(range(250)), 100)), range(250))
+
+        def failing():
+            yield 1
+            raise ValueError('page failed')
+        prefetched = asana_mailer.prefetch(failing(), 100)
+        self.assertEqual(next(prefetched), 1)
+        with self.assertRaises(ValueError):
+            next(prefetched)
+
+        # The producer stops once the caller stops iterating
+        threads = threading.active_count()
+        prefetched = asana_mailer.prefetch(itertools.count(), 10)
+        self.assertEqual(next(prefetched), 0)
+        prefetched.close()
+        for _ in range(50):
+            if threading.active_count() == threads:
+                break
+            time.sleep(0.05)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_create_asana_client(self):
+        asana_client = asana_mailer.create_asana_client('pat', workers=8)
+        adapter = asana_client.session.get_adapter(
+            asana_mailer.ASANA_BASE_URL)
+        self.assertEqual(adapter._pool_maxsize, 8)
+        self.assertEqual(
+            asana_client.session.headers['Accept-Encoding'], 'gzip, deflate')
+        self.assertEqual(
+            asana_client.options['page_size'], asana_mailer.ASANA_PAGE_SIZE)
+        # The task pages are downloaded alongside the workers
+        asana_client = asana_mailer.create_asana_client(
+            'pat', workers=8, prefetch_pages=True)
+        adapter = asana_client.session.get_adapter(
+            asana_mailer.ASANA_BASE_URL)
+        self.assertEqual(adapter._pool_maxsize, 9)
+
+    def test_connection_stats(self):
+        asana_client = asana_mailer.create_asana_client('pat')
+        self.assertEqual(
+            asana_mailer.connection_stats(asana_client),
+            {'requests': 0, 'connections': 0, 'reused': 0})
+        adapter = asana_client.session.get_adapter(
+            asana_mailer.ASANA_BASE_URL)
+        pool = adapter.poolmanager.connection_from_url(
+            asana_mailer.ASANA_BASE_URL)
+        pool.num_requests = 10
+        pool.num_connections = 2
+        self.assertEqual(
+            asana_mailer.connection_stats(asana_client),
+            {'requests': 10, 'connections': 2, 'reused': 8})
+        # A run of a shared client only counts its own
+        before = asana_mailer.connection_stats(asana_client)
+        pool.num_requests = 15
+        pool.num_connections = 4
+        self.assertEqual(
+            asana_mailer.connection_stats(asana_client, since=before),
+            {'requests': 5, 'connections': 2, 'reused': 3})
+
+    def test_fetch_comments_deadline(self):
+        deadline = asana_mailer.Deadline(600)
+        self.assertEqual(deadline.fetch_end, deadline.end - 30)
+        self.assertTrue(deadline.can_fetch())
+        self.assertEqual(deadline.smtp_timeout(), 300)
+        short_deadline = asana_mailer.Deadline(20)
+        self.assertEqual(short_deadline.fetch_end, short_deadline.end - 5)
+        fetched = []
+
+        def stories(task_id):
+            fetched.append(task_id)
+            if len(fetched) == 2:
+                # The deadline's fetch time passes during the second fetch
+                deadline.fetch_end = 0
+            return [{u'text': task_id, u'type': u'comment'}]
+        mock_asana = mock.MagicMock()
+        mock_asana.tasks.stories.side_effect = stories
+        story_cache = asana_mailer.StoryCache()
+        tasks = [
+            (u'1', u'2013-06-01T00:00:00.000Z'),
+            (u'2', u'2013-06-03T00:00:00.000Z'),
+            (u'3', None),
+            (u'4', u'2013-06-02T00:00:00.000Z')]
+        task_comments = asana_mailer.fetch_comments(
+            mock_asana, tasks, story_cache, deadline=deadline)
+        # The most recently modified tasks are fetched first
+        self.assertEqual(fetched, [u'2', u'4'])
+        self.assertEqual(sorted(task_comments), [u'2', u'4'])
+        self.assertEqual(deadline.missed, 2)
+        self.assertEqual(deadline.missed_task_ids, set([u'1', u'3']))
+        self.assertIsNone(story_cache.get(u'1', tasks[0][1]))
+
+        deadline.end = 0
+        self.assertEqual(deadline.smtp_timeout(), 10)
+
+        # The project notes that its comments are partial
+        mock_asana.projects.find_by_id.return_value = {
+            u'name': u'Project', u'notes': u''}
+        mock_asana.projects.tasks.return_value = [
+            {u'id': task_id, u'name': u'Task ' + task_id, u'tags': [],
+             u'assignee': None, u'completed': False, u'notes': u'',
+             u'due_on': None, u'modified_at': modified_at}
+            for task_id, modified_at in tasks]
+        current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+        project = asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc,
+            deadline=asana_mailer.Deadline(600), subtask_depth=1)
+        self.assertFalse(project.partial_comments)
+        deadline = asana_mailer.Deadline(600)
+        deadline.fetch_end = 0
+        mock_asana.tasks.subtasks.reset_mock()
+        project = asana_mailer.Project.create_project(
+            mock_asana, u'123', current_time_utc, deadline=deadline,
+            subtask_depth=1)
+        self.assertTrue(project.partial_comments)
+        self.assertFalse(mock_asana.tasks.subtasks.called)
+        self.assertTrue(asana_mailer.Project.from_dict(
+            project.to_dict()).partial_comments)
+        rendered_html, rendered_text = asana_mailer.generate_templates(
+            project, 'Default.html', 'Default.markdown', u'2013-06-03',
+            current_time_utc, True)
+        self.assertIn(u'<p class="partial-comments">', rendered_html)
+        self.assertIn(u'\n_Asana was too slow', rendered_text)
+
+    def test_fetch_subtasks(self):
+        def subtask(task_id):
+            return {
+                u'id': task_id, u'name': u'Subtask {0}'.format(task_id),
+                u'assignee': None, u'completed': False, u'notes': None,
+                u'due_on': None, u'tags': [], u'modified_at': u'time'}
+
+        # 3 is a subtask of both 1 and 2, and has a subtask of its own
+        tree = {
+            u'1': [subtask(u'3')], u'2': [subtask(u'3'), subtask(u'4')],
+            u'3': [subtask(u'5')], u'4': [], u'5': []}
+        # Mocks don't count calls from several threads reliably
+        fetched = []
+
+        def subtasks(task_id, expand):
+            fetched.append(task_id)
+            return iter(tree[task_id])
+
+        mock_asana = mock.MagicMock()
+        mock_asana.tasks.subtasks.side_effect = subtasks
+        subtask_cache = asana_mailer.StoryCache()
+        subtasks_json = asana_mailer.fetch_subtasks(
+            mock_asana, [(u'1', u'time'), (u'2', u'time')], 3, workers=2,
+            subtask_cache=subtask_cache)
+        self.assertEqual(subtasks_json, tree)
+        self.assertEqual(sorted(fetched), [u'1', u'2', u'3', u'4', u'5'])
+
+        subtasks = asana_mailer.Task.create_subtasks(u'2', subtasks_json, 2)
+        self.assertEqual([task.id for task in subtasks], [u'3', u'4'])
+        self.assertEqual([task.id for task in subtasks[0].subtasks], [u'5'])
+        self.assertEqual(subtasks[0].subtasks[0].subtasks, [])
+
+        # Depth limits the levels fetched, and the cache avoids refetching
+        mock_asana.tasks.subtasks.reset_mock()
+        subtasks_json = asana_mailer.fetch_subtasks(
+            mock_asana, [(u'1', u'time'), (u'2', u'newer')], 1,
+            subtask_cache=subtask_cache)
+        self.assertEqual(set(subtasks_json), set((u'1', u'2')))
+        mock_asana.tasks.subtasks.assert_called_once_with(u'2', expand='.')
+
+        # Subtasks can change without their parent's modified_at changing, so
+        # a ttl bounds how long the cached subtasks are served
+        subtask_cache = asana_mailer.StoryCache(ttl=60)
+        subtask_cache.set(u'1', u'time', [])
+        self.assertEqual(subtask_cache.get(u'1', u'time'), [])
+        later = time.time() + 61
+        with mock.patch('asana_mailer.time.time', return_value=later):
+            self.assertIsNone(subtask_cache.get(u'1', u'time'))
+
+    def test_record_replay(self):
+        mock_asana = mock.MagicMock()
+        mock_asana.projects.find_by_id.return_value = {
+            u'name': u'Project', u'notes': None}
+        mock_asana.projects.tasks.return_value = iter([
+            {
+                u'id': 1, u'name': u'Section:', u'tags': []
+            },
+            {
+                u'id': 2, u'name': u'Task', u'assignee': None,
+                u'completed': False, u'notes': None, u'due_on': None,
+                u'tags': []
+            }])
+        mock_asana.tasks.stories.return_value = [
+            {u'text': u'blah', u'type': u'comment'},
+            {u'text': u'blah2', u'type': u'system'}]
+        current_time_utc = datetime.datetime.now(dateutil.tz.tzutc())
+        recorder = asana_mailer.RecordingAsanaClient(
+            mock_asana, current_time_utc)
+        project = asana_mailer.Project.create_project(
+            recorder, u'123', current_time_utc, completed_lookback_hours=1,
+            fetch_workers=2)
+        self.assertEqual(len(recorder.interactions), 4)
+
+        cassette = 'AsanaMailer_test.cassette'
+        recorder.save(cassette)
+        try:
+            replayer = asana_mailer.ReplayAsanaClient(
+                cassette, latency_scale=0)
+        finally:
+            os.remove(cassette)
+        self.assertEqual(replayer.current_time_utc, current_time_utc)
+        replayed_project = asana_mailer.Project.create_project(
+            replayer, u'123', replayer.current_time_utc,
+            completed_lookback_hours=1)
+        self.assertEqual(replayed_project.to_dict(), project.to_dict())
+        with self.assertRaises(LookupError):
+            replayer.tasks.stories(u'789')
+
+
+class StoryCacheTestCase(unittest.TestCase):
+
+    def test_get_set(self):
+        story_cache = asana_mailer.StoryCache(max_entries=2)
+        self.assertIsNone(story_cache.get(u'1', u'time'))
+        story_cache.set(u'1', u'time', [u'comment'])
+        self.assertEqual(story_cache.get(u'1', u'time'), [u'comment'])
+        self.assertIsNone(story_cache.get(u'1', u'newer time'))
+        self.assertIsNone(story_cache.get(u'1', None))
+        story_cache.set(u'2', None, [])
+        self.assertIsNone(story_cache.get(u'2', None))
+
+        # Least recently used entries are evicted
+        story_cache.set(u'2', u'time', [])
+        story_cache.get(u'1', u'time')
+        story_cache.set(u'3', u'time', [])
+        self.assertEqual(story_cache.get(u'1', u'time'), [u'comment'])
+        self.assertIsNone(story_cache.get(u'2', u'time'))
+        self.assertEqual(story_cache.get(u'3', u'time'), [])
+        self.assertIsNone(story_cache.claim(u'4', u'time'))
+
+    def test_shared_story_cache(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'cache.sqlite')
+        # Two caches on the same file stand in for two mailer processes
+        first = asana_mailer.SharedStoryCache(path, claim_timeout=5)
+        second = asana_mailer.SharedStoryCache(path, claim_timeout=5)
+        subtasks = asana_mailer.SharedStoryCache(path, 'subtasks')
+        self.addCleanup(first.close)
+        self.addCleanup(second.close)
+        self.addCleanup(subtasks.close)
+
+        self.assertIsNone(second.get(u'1', u'time'))
+        first.set(u'1', u'time', [{u'text': u'comment \u2603'}])
+        self.assertEqual(
+            second.get(u'1', u'time'), [{u'text': u'comment \u2603'}])
+        self.assertIsNone(second.get(u'1', u'newer time'))
+        self.assertIsNone(second.get(u'1', None))
+        self.assertIsNone(subtasks.get(u'1', u'time'))
+
+        # Entries expire after the ttl, even if the task is unchanged
+        with mock.patch('time.time', return_value=time.time() + 1000):
+            self.assertIsNone(second.get(u'1', u'time'))
+
+        # Only the first process to claim a task fetches it, the other waits
+        # for it to be stored
+        self.assertIsNone(first.claim(u'2', u'time'))
+        timer = threading.Timer(0.2, first.set, (u'2', u'time', [u'fetched']))
+        timer.start()
+        self.assertEqual(second.claim(u'2', u'time'), [u'fetched'])
+        timer.join()
+        # Storing the comments released the claim
+        self.assertIsNone(second.claim(u'2', u'newer time'))
+
+        # Claims expire, so a process that died mid-fetch only delays others
+        first.claim_timeout = second.claim_timeout = 0.2
+        self.assertIsNone(first.claim(u'3', u'time'))
+        self.assertIsNone(second.claim(u'3', u'time'))
+
+        # Nor is a claim waited for past the deadline's fetch time
+        first.claim_timeout = second.claim_timeout = 5
+        self.assertIsNone(first.claim(u'4', u'time'))
+        deadline = asana_mailer.Deadline(600)
+        deadline.fetch_end = time.time() + 0.2
+        start = time.time()
+        self.assertIsNone(second.claim(u'4', u'time', deadline))
+        self.assertLess(time.time() - start, 2)
+
+    def test_fetch_comments_shared_cache(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        story_cache = asana_mailer.SharedStoryCache(
+            os.path.join(tempdir, 'cache.sqlite'))
+        self.addCleanup(story_cache.close)
+        asana_client = mock.MagicMock()
+        asana_client.tasks.stories.return_value = [
+            {u'type': u'comment', u'text': u'fetched'}]
+        with mock.patch.object(
+                story_cache, 'claim', side_effect=[
+                    [{u'type': u'comment', u'text': u'claimed'}], None]) as (
+                    mock_claim):
+            task_comments = asana_mailer.fetch_comments(
+                asana_client, [(u'1', u'time'), (u'2', u'time')],
+                story_cache)
+        mock_claim.assert_called_with(u'2', u'time', None)
+        self.assertEqual(task_comments, {
+            u'1': [{u'type': u'comment', u'text': u'claimed'}],
+            u'2': [{u'type': u'comment', u'text': u'fetched'}]})
+        asana_client.tasks.stories.assert_called_once_with(u'2')
+        self.assertEqual(
+            story_cache.get(u'2', u'time'),
+            [{u'type': u'comment', u'text': u'fetched'}])
+
+
+class MemoryTracerTestCase(unittest.TestCase):
+
+    def test_phase_without_tracemalloc(self):
+        with mock.patch.dict('sys.modules', {'tracemalloc': None}):
+            tracer = asana_mailer.MemoryTracer()
+        tracer.start()
+        tracer.phase('fetch')
+        tracer.stop()
+        self.assertIsNone(tracer.phases[0]['current'])
+        self.assertGreater(tracer.peak, 0)
+        self.assertTrue(tracer.report().startswith('fetch'))
+
+    def test_phase_with_tracemalloc(self):
+        mock_tracemalloc = mock.MagicMock()
+        mock_tracemalloc.get_traced_memory.return_value = (1048576, 2097152)
+        stat = mock.MagicMock(traceback='asana_mailer.py:1', size_diff=2048)
+        mock_tracemalloc.take_snapshot.return_value.compare_to.return_value = [
+            stat]
+        with mock.patch.dict('sys.modules', {'tracemalloc': mock_tracemalloc}):
+            tracer = asana_mailer.MemoryTracer(top=5)
+        tracer.start()
+        tracer.phase('render_html')
+        tracer.stop()
+        mock_tracemalloc.start.assert_called_once_with()
+        mock_tracemalloc.stop.assert_called_once_with()
+        self.assertEqual(tracer.phases, [{
+            'name': 'render_html', 'current': 1048576, 'peak': 2097152,
+            'top': [('asana_mailer.py:1', 2048)]}])
+        self.assertEqual(tracer.report().splitlines(), [
+            'render_html      current      1.0 MB   peak      2.0 MB',
+            '          +2.0 KB  asana_mailer.py:1'])
+
+    @mock.patch('asana_mailer.init_logging')
+    @mock.patch('asana_mailer.MemoryTracer')
+    def test_main_stops_tracer_on_error(self, mock_tracer, mock_init):
+        with self.assertRaises(IOError):
+            asana_mailer.main([
+                '123', 'pat', '--trace-memory', '--from-snapshot',
+                'AsanaMailer_missing.snapshot'])
+        mock_tracer.return_value.start.assert_called_once_with()
+        mock_tracer.return_value.stop.assert_called_once_with()
+
+
+class LoggingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.handlers = asana_mailer.log.handlers[:]
+        self.level = asana_mailer.log.level
+        asana_mailer.log.handlers = []
+
+    def tearDown(self):
+        asana_mailer.log.handlers = self.handlers
+        asana_mailer.log.setLevel(self.level)
+        shutil.rmtree(self.tempdir)
+
+    def test_init_logging(self):
+        log_file = os.path.join(self.tempdir, 'mailer.log')
+        listener = asana_mailer.init_logging(log_file, 'json', sample=2)
+        self.assertIsNone(asana_mailer.init_logging(log_file))
+        for task_id in range(5):
+            asana_mailer.log.debug('Getting task %s', task_id)
+        with asana_mailer.span('fetch', tasks=5) as fields:
+            fields['fetched'] = 3
+        with self.assertRaises(ValueError):
+            with asana_mailer.span('send'):
+                raise ValueError
+        listener.stop()
+
+        with open(log_file) as log_fobj:
+            entries = [json.loads(line) for line in log_fobj]
+        self.assertEqual(
+            [entry['message'] for entry in entries[:3]],
+            ['Getting task 0', 'Getting task 2', 'Getting task 4'])
+        self.assertEqual(entries[0]['level'], 'DEBUG')
+        fetch, send = entries[3:]
+        self.assertEqual(fetch['span'], 'fetch')
+        self.assertEqual((fetch['tasks'], fetch['fetched']), (5, 3))
+        self.assertGreaterEqual(fetch['duration_ms'], 0)
+        self.assertNotIn('failed', fetch)
+        self.assertEqual(send['span'], 'send')
+        self.assertTrue(send['failed'])
+
+    def test_init_logging_text(self):
+        log_file = os.path.join(self.tempdir, 'mailer.log')
+        listener = asana_mailer.init_logging(log_file)
+        asana_mailer.log.debug('Getting task %s', 1)
+        asana_mailer.log.info('Starting %s', 'run')
+        listener.stop()
+
+        with open(log_file) as log_fobj:
+            lines = log_fobj.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('INFO [asana_mailer]: Starting run', lines[0])
+
+
+class CronScheduleTestCase(unittest.TestCase):
+
+    def test_parse_field(self):
+        parse_field = asana_mailer.CronSchedule.parse_field
+        self.assertEqual(parse_field('*', 0, 3), frozenset((0, 1, 2, 3)))
+        self.assertEqual(
+            parse_field('*/15', 0, 59), frozenset((0, 15, 30, 45)))
+        self.assertEqual(parse_field('1-3,5', 0, 6), frozenset((1, 2, 3, 5)))
+        self.assertEqual(parse_field('0-10/5', 0, 59), frozenset((0, 5, 10)))
+        for field in ('60', '5-1', '*/0', 'a'):
+            with self.assertRaises(ValueError):
+                parse_field(field, 0, 59)
+
+    def test_matches(self):
+        # 2013-06-03 was a Monday
+        monday = datetime.datetime(2013, 6, 3, 13, 30)
+        weekdays = asana_mailer.CronSchedule('30 13 * * 1-5')
+        self.assertTrue(weekdays.matches(monday))
+        self.assertFalse(weekdays.matches(monday.replace(minute=31)))
+        self.assertFalse(weekdays.matches(monday.replace(day=2)))
+        # Sunday is both 0 and 7
+        sunday = monday.replace(day=2)
+        for expression in (
+                '30 13 * * 7', '30 13 * * 0', '30 13 * * 0-6',
+                '30 13 * * 0,6', '30 13 * * 5-7'):
+            self.assertTrue(
+                asana_mailer.CronSchedule(expression).matches(sunday),
+                expression)
+        self.assertFalse(
+            asana_mailer.CronSchedule('30 13 * * 0').matches(monday))
+        self.assertFalse(
+            asana_mailer.CronSchedule('30 13 * * 1-6').matches(sunday))
+        # Day of month or day of week
+        either = asana_mailer.CronSchedule('30 13 15 * 1')
+        self.assertTrue(either.matches(monday))
+        self.assertTrue(either.matches(monday.replace(day=15)))
+        self.assertFalse(either.matches(monday.replace(day=4)))
+        with self.assertRaises(ValueError):
+            asana_mailer.CronSchedule('30 13 * *')
+
+
+class MailerDaemonTestCase(unittest.TestCase):
+
+    def test_parse_schedule(self):
+        jobs = asana_mailer.ScheduledJob.parse_schedule([
+            '# A comment', '',
+            "30 13 * * 1-5 123 pat -s 'Bugs 1.1.0' --html-template "
+            "All_Comments.html"])
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0].schedule.expression, '30 13 * * 1-5')
+        self.assertEqual(jobs[0].args.project_id, '123')
+        self.assertEqual(jobs[0].args.section_filters, ['Bugs 1.1.0'])
+        with self.assertRaises(ValueError):
+            asana_mailer.ScheduledJob.parse_schedule(['* * * 123 pat'])
+        with mock.patch('sys.stderr'):
+            with self.assertRaises(ValueError):
+                asana_mailer.ScheduledJob.parse_schedule(
+                    ['* * * * * 123 pat --no-such-option'])
+            with self.assertRaises(ValueError):
+                asana_mailer.ScheduledJob.parse_schedule(
+                    ['* * * * * 123 pat --record a --replay b'])
+
+    @mock.patch('multiprocessing.pool.ThreadPool')
+    @mock.patch('asana_mailer.connect_smtp')
+    @mock.patch('asana_mailer.create_template_environments')
+    @mock.patch('asana_mailer.run_mailer')
+    @mock.patch('asana.Client')
+    def test_run_jobs(
+            self, mock_asana, mock_run_mailer, mock_create_env,
+            mock_connect_smtp, mock_thread_pool):
+        daemon = asana_mailer.MailerDaemon('schedule')
+        daemon.jobs = asana_mailer.ScheduledJob.parse_schedule([
+            '30 13 * * * 123 pat',
+            '0 * * * * 456 pat --to-addresses a@example.com '
+            '--from-address b@example.com'])
+        when = datetime.datetime(2013, 6, 3, 13, 30)
+        daemon.run_due_jobs(when)
+        mock_pool = mock_thread_pool.return_value
+        mock_pool.apply_async.assert_called_once_with(
+            daemon.run_job, (daemon.jobs[0],))
+        # Still running
+        daemon.run_due_jobs(when)
+        self.assertEqual(mock_pool.apply_async.call_count, 1)
+
+        daemon.run_job(daemon.jobs[0])
+        self.assertEqual(daemon.running, set())
+        mock_run_mailer.assert_called_once_with(
+            daemon.jobs[0].args,
+            asana_client=mock_asana.access_token.return_value,
+            story_cache=daemon.story_cache,
+            template_envs=mock_create_env.return_value, pool=None,
+            subtask_cache=daemon.subtask_cache, get_smtp_conn=None)
+
+        # Clients, environments and connections are reused, and connections
+        # are only made or checked once the email is ready to send
+        def get_smtp_conn(args, **kwargs):
+            return kwargs['get_smtp_conn']()
+        mock_run_mailer.side_effect = get_smtp_conn
+        daemon.run_job(daemon.jobs[1])
+        daemon.run_job(daemon.jobs[1])
+        mock_asana.access_token.assert_called_once_with('pat')
+        self.assertEqual(mock_create_env.call_count, 1)
+        mock_connect_smtp.assert_called_once_with('localhost', None, None)
+        mock_smtp_conn = mock_connect_smtp.return_value
+        mock_smtp_conn.noop.assert_called_once_with()
+        mock_smtp_conn.noop.side_effect = smtplib.SMTPServerDisconnected
+        daemon.run_job(daemon.jobs[1])
+        self.assertEqual(mock_connect_smtp.call_count, 2)
+        mock_smtp_conn.noop.side_effect = socket.error
+        daemon.run_job(daemon.jobs[1])
+        self.assertEqual(mock_connect_smtp.call_count, 3)
+        mock_run_mailer.side_effect = Exception
+        daemon.run_job(daemon.jobs[1])
+        self.assertEqual(daemon.running, set())
+
+
+class WebhookTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+        self.store = asana_mailer.ProjectStore(self.store_dir)
+        self.now = datetime.datetime.now(dateutil.tz.tzutc())
+        completed_at = (
+            self.now - datetime.timedelta(hours=2)).isoformat()
+        self.tasks_json = [
+            {u'id': 1, u'name': u'Section:', u'completed': False,
+             u'tags': [], u'modified_at': u'm1'},
+            {u'id': 2, u'name': u'Open', u'completed': False,
+             u'assignee': None, u'notes': u'', u'due_on': None,
+             u'tags': [], u'modified_at': u'm1'},
+            {u'id': 3, u'name': u'Done', u'completed': True,
+             u'completed_at': completed_at, u'assignee': None,
+             u'notes': u'', u'due_on': None, u'tags': [],
+             u'modified_at': u'm1'}]
+        self.fetched = []
+
+        def stories(task_id):
+            self.fetched.append(task_id)
+            return [{u'text': task_id, u'type': u'comment'},
+                    {u'text': u'system', u'type': u'system'}]
+        self.mock_asana = mock.MagicMock()
+        self.mock_asana.projects.find_by_id.return_value = {
+            u'name': u'Project', u'notes': u''}
+        self.mock_asana.projects.tasks.side_effect = (
+            lambda *args, **kwargs: [dict(task) for task in self.tasks_json])
+        self.mock_asana.tasks.stories.side_effect = stories
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def test_project_store(self):
+        self.assertIsNone(self.store.load(u'10'))
+        self.store.sync_project(self.mock_asana, u'10', self.now, 24)
+        self.assertEqual(sorted(self.fetched), [u'1', u'2', u'3'])
+        state = self.store.load(u'10')
+        self.assertEqual(
+            state[u'comments'][u'2'],
+            [u'm1', [{u'text': u'2', u'type': u'comment'}]])
+
+        # Only modified or stale tasks have their comments fetched again
+        self.fetched[:] = []
+        self.tasks_json[1][u'modified_at'] = u'm2'
+        self.store.sync_project(self.mock_asana, u'10', self.now, 24)
+        self.assertEqual(self.fetched, [u'2'])
+        self.fetched[:] = []
+        self.store.sync_project(
+            self.mock_asana, u'10', self.now, 24, stale_task_ids={u'3'})
+        self.assertEqual(self.fetched, [u'3'])
+
+        # Mail runs read the project from the store
+        self.mock_asana.reset_mock()
+        store_client = asana_mailer.StoreAsanaClient(self.store)
+        project = asana_mailer.Project.create_project(
+            store_client, u'10', self.now, completed_lookback_hours=24)
+        self.assertEqual(project.name, u'Project')
+        self.assertEqual(
+            [(task.name, task.comments) for task in project.sections[0].tasks],
+            [(u'Open', [{u'text': u'2', u'type': u'comment'}]),
+             (u'Done', [{u'text': u'3', u'type': u'comment'}])])
+        project = asana_mailer.Project.create_project(
+            store_client, u'10', self.now)
+        self.assertEqual(
+            [task.name for task in project.sections[0].tasks], [u'Open'])
+        self.assertFalse(self.mock_asana.method_calls)
+        with self.assertRaises(LookupError):
+            asana_mailer.Project.create_project(store_client, u'20', self.now)
+        # Other calls fall back to the Asana client
+        store_client = asana_mailer.StoreAsanaClient(
+            self.store, self.mock_asana)
+        store_client.tasks.subtasks(u'2', expand='.')
+        self.mock_asana.tasks.subtasks.assert_called_once_with(
+            u'2', expand='.')
+
+    def test_webhook_receiver(self):
+        import hmac
+        import urllib2
+
+        receiver = asana_mailer.WebhookReceiver(
+            self.store, self.mock_asana, [u'10'], 24)
+        server = receiver.create_server('127.0.0.1', 0)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+
+        def post(path, body='', headers=None):
+            request = urllib2.Request(
+                'http://127.0.0.1:{0}/{1}'.format(
+                    server.server_address[1], path), body, headers or {})
+            try:
+                response = urllib2.urlopen(request)
+            except urllib2.HTTPError as e:
+                return e.code, e.headers
+            return response.getcode(), response.info()
+
+        # Recorded payloads, in the old and current formats
+        payload = json.dumps({u'events': [
+            {u'resource': 2, u'user': 5, u'type': u'task',
+             u'action': u'changed', u'parent': None,
+             u'created_at': u'2013-06-03T12:00:00.000Z'},
+            {u'resource': {u'gid': u'7', u'resource_type': u'story'},
+             u'action': u'added', u'parent': {
+                 u'gid': u'3', u'resource_type': u'task'},
+             u'created_at': u'2013-06-03T12:00:00.000Z'}]})
+        try:
+            # Events are rejected before the handshake, and handshakes after
+            self.assertEqual(post('10', payload)[0], 401)
+            status, headers = post('10', '', {'X-Hook-Secret': 'secret'})
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['X-Hook-Secret'], 'secret')
+            self.assertEqual(
+                post('10', '', {'X-Hook-Secret': 'forged'})[0], 403)
+            self.assertEqual(receiver.secret(u'10'), 'secret')
+            self.assertEqual(post('20', payload)[0], 404)
+            self.assertEqual(post('10', payload, {
+                'X-Hook-Signature': 'forged'})[0], 401)
+            self.assertEqual(receiver.process_events(block=False), [])
+            signature = hmac.new(
+                'secret', payload, hashlib.sha256).hexdigest()
+            self.assertEqual(post('10', payload, {
+                'X-Hook-Signature': signature})[0], 200)
+            self.assertEqual(post('10', 'not json', {
+                'X-Hook-Signature': hmac.new(
+                    'secret', 'not json', hashlib.sha256).hexdigest()})[0],
+                400)
+        finally:
+            server.shutdown()
+            server.server_close()
+            server_thread.join()
+
+        self.assertEqual(receiver.process_events(block=False), [u'10'])
+        self.assertEqual(sorted(self.fetched), [u'1', u'2', u'3'])
+        # Only the tasks named by the events are fetched again, and stories
+        # for the tasks they were added to
+        self.fetched[:] = []
+        self.mock_asana.projects.tasks.reset_mock()
+        tasks_json = dict(
+            (unicode(task[u'id']), task) for task in self.tasks_json)
+        self.tasks_json[1][u'name'] = u'Renamed'
+
+        def find_by_id(task_id):
+            if task_id not in tasks_json:
+                raise asana.error.NotFoundError(mock.MagicMock())
+            return dict(tasks_json[task_id])
+        self.mock_asana.tasks.find_by_id.side_effect = find_by_id
+        receiver.events.put((u'10', json.loads(payload)[u'events']))
+        self.assertEqual(receiver.process_events(block=False), [u'10'])
+        self.assertEqual(self.fetched, [u'3'])
+        self.assertEqual(
+            sorted(call[0][0] for call in
+                   self.mock_asana.tasks.find_by_id.call_args_list),
+            [u'2', u'3'])
+        self.assertFalse(self.mock_asana.projects.tasks.called)
+        self.assertEqual(
+            [task[u'name'] for task in self.store.load(u'10')[u'tasks']],
+            [u'Section:', u'Renamed', u'Done'])
+
+        # Deleted tasks are dropped from the store
+        del tasks_json[u'3']
+        receiver.events.put((u'10', [
+            {u'resource': 3, u'type': u'task', u'action': u'deleted'}]))
+        receiver.process_events(block=False)
+        self.assertEqual(
+            [task[u'id'] for task in self.store.load(u'10')[u'tasks']],
+            [1, 2])
+        self.assertFalse(self.mock_asana.projects.tasks.called)
+
+        # Tasks added to the project change its task list
+        receiver.events.put((u'10', [
+            {u'resource': 4, u'type': u'task', u'action': u'added',
+             u'parent': 10}]))
+        receiver.process_events(block=False)
+        self.assertTrue(self.mock_asana.projects.tasks.called)
+
+        receiver.register('https://example.com/hooks/')
+        self.mock_asana.webhooks.create.assert_called_once_with({
+            'resource': u'10', 'target': u'https://example.com/hooks/10'})
+
+
 class AsanaMailerTestCase(unittest.TestCase):
 
     @classmethod
@@ -485,8 +1686,8 @@ class AsanaMailerTestCase(unittest.TestCase):
                 os.remove(fname)
 
     @mock.patch('premailer.transform')
-    @mock.patch('asana_mailer.FileSystemLoader')
-    @mock.patch('asana_mailer.Environment')
+    @mock.patch('jinja2.FileSystemLoader')
+    @mock.patch('jinja2.Environment')
     def test_generate_templates(
             self, mock_jinja_env, mock_fs_loader, mock_transform):
         mock_fs_instance = mock_fs_loader.return_value
@@ -500,37 +1701,319 @@ class AsanaMailerTestCase(unittest.TestCase):
         return_vals = asana_mailer.generate_templates(
             project, 'html_template', 'text_template', type(self).current_date,
             type(self).current_time_utc)
-        mock_jinja_env.assert_called_once_with(
-            loader=mock_fs_instance, trim_blocks=True, lstrip_blocks=True,
-            autoescape=True)
+        mock_jinja_env.assert_has_calls([
+            mock.call(
+                loader=mock_fs_instance, trim_blocks=True,
+                lstrip_blocks=True, autoescape=True),
+            mock.call(
+                loader=mock_fs_instance, trim_blocks=True,
+                lstrip_blocks=True, autoescape=False)], any_order=True)
+        self.assertEqual(mock_jinja_env.call_count, 2)
 
         mock_env_instance.get_template.assert_has_calls(
             [mock.call('html_template'), mock.call('text_template')],
             any_order=True)
-        mock_fs_loader.assert_called_once_with('templates')
-        self.assertFalse(mock_env_instance.autoescape)
+        mock_fs_loader.assert_called_with('templates')
+        mock_transform.assert_called_once_with('template render')
 
         self.assertEquals(
             ('premailer transform', 'template render'), return_vals)
 
+        # Reusing environments and inlining CSS in a pool
+        mock_jinja_env.reset_mock()
+        mock_transform.reset_mock()
+        mock_pool = mock.MagicMock()
+        mock_pool.apply_async.return_value.get.return_value = 'pool inline'
+        envs = {'html': mock_env_instance, 'text': mock_env_instance}
+        return_vals = asana_mailer.generate_templates(
+            project, 'html_template', 'text_template', type(self).current_date,
+            type(self).current_time_utc, envs=envs, pool=mock_pool)
+        self.assertFalse(mock_jinja_env.called)
+        self.assertFalse(mock_transform.called)
+        mock_pool.apply_async.assert_called_once_with(
+            asana_mailer.inline_css, ('template render',))
+        self.assertEquals(('pool inline', 'template render'), return_vals)
+
+        # Skipping inlining
+        mock_pool.reset_mock()
+        return_vals = asana_mailer.generate_templates(
+            project, 'html_template', 'text_template', type(self).current_date,
+            type(self).current_time_utc, True, envs=envs, pool=mock_pool)
+        self.assertFalse(mock_pool.apply_async.called)
+        self.assertEquals(('template render', 'template render'), return_vals)
+
+    def test_generate_templates_sharded(self):
+        project = asana_mailer.Project(u'123', u'Project', None, [
+            asana_mailer.Section(u'Section {0}:'.format(i), [
+                asana_mailer.Task(
+                    u'Task {0}'.format(j), None, j % 2 == 0,
+                    type(self).current_time_utc, u'<Description>', None,
+                    [u'tag'], [{
+                        u'text': u'blah', u'type': u'comment',
+                        u'created_by': {u'name': u'user'}}],
+                    id=unicode(j))
+                for j in range(i)])
+            for i in range(1, 6)])
+        self.assertEqual(
+            [len(shard) for shard in asana_mailer.shard_sections(
+                project.sections, 3)],
+            [2, 1, 1, 1])
+        pool = multiprocessing.pool.ThreadPool(2)
+        self.addCleanup(pool.join)
+        self.addCleanup(pool.close)
+        # Including templates with blocks using the whole project's stats
+        for name in ('Default', 'Summary'):
+            templates = ('{0}.html'.format(name), '{0}.markdown'.format(name))
+            rendered = asana_mailer.generate_templates(
+                project, templates[0], templates[1],
+                type(self).current_date, type(self).current_time_utc, True)
+            sharded_rendered = asana_mailer.generate_templates(
+                project, templates[0], templates[1],
+                type(self).current_date, type(self).current_time_utc, True,
+                pool=pool, shard_size=3)
+            self.assertEqual(sharded_rendered, rendered)
+            self.assertIn(u'&lt;Description&gt;', sharded_rendered[0])
+            self.assertNotIn(
+                asana_mailer.TASKS_BLOCK_MARKER, sharded_rendered[0])
+
+    def test_template_pack(self):
+        project = asana_mailer.Project(u'123', u'Project', None, [
+            asana_mailer.Section(u'Section:', [
+                asana_mailer.Task(
+                    u'Task', None, False, type(self).current_time_utc,
+                    u'<Description>', None, [u'tag'], [{
+                        u'text': u'blah', u'type': u'comment',
+                        u'created_by': {u'name': u'user'}}],
+                    id=u'456')])])
+        rendered = asana_mailer.generate_templates(
+            project, 'Default.html', 'Default.markdown',
+            type(self).current_date, type(self).current_time_utc, True)
+
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        pack_dir = os.path.join(tempdir, 'pack')
+        pack = asana_mailer.build_template_pack(
+            pack_dir, names=['Default.html', 'Default.markdown'])
+        self.assertEqual(asana_mailer.load_template_pack(pack_dir), pack)
+        self.assertEqual(sorted(pack[u'templates']), [
+            u'Default.html', u'Default.markdown'])
+        default_html = pack[u'templates'][u'Default.html']
+        self.assertEqual(default_html[u'depends'], [
+            u'Project_Styled.html', u'Project.html'])
+        self.assertIn(u'due_date', default_html[u'fields'])
+        self.assertIn(u'last_comment', default_html[u'filters'])
+        self.assertEqual(default_html[u'comment_window'], u'last')
+        self.assertTrue(default_html[u'complete'])
+        self.assertIn(u'project', default_html[u'names'])
+        self.assertEqual(asana_mailer.template_comment_window(
+            ['Default.html', 'Default.markdown'], pack=pack), u'last')
+        self.assertFalse(asana_mailer.templates_use_time(
+            ['Default.html', 'Default.markdown'], pack=pack))
+        # Packs built before variables were recorded may use the time
+        names = default_html.pop(u'names')
+        self.assertTrue(asana_mailer.templates_use_time(
+            ['Default.html', 'Default.markdown'], pack=pack))
+        default_html[u'names'] = names
+
+        # Packs load from wherever the mailer runs, rendering the same
+        cwd = os.getcwd()
+        os.chdir(tempdir)
+        self.addCleanup(os.chdir, cwd)
+        self.assertEqual(asana_mailer.generate_templates(
+            project, 'Default.html', 'Default.markdown',
+            type(self).current_date, type(self).current_time_utc, True,
+            template_pack='pack'), rendered)
+        pool = multiprocessing.pool.ThreadPool(2)
+        try:
+            self.assertEqual(asana_mailer.generate_templates(
+                project, 'Default.html', 'Default.markdown',
+                type(self).current_date, type(self).current_time_utc, True,
+                pool=pool, shard_size=1, template_pack='pack'), rendered)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertTrue(asana_mailer.templates_use_comments(
+            pack, ['Default.html', 'Default.markdown']))
+        no_comments = {u'depends': [], u'fields': [u'name'], u'filters': [],
+                       u'comment_window': None, u'complete': True}
+        pack[u'templates'] = {u'Names.html': no_comments}
+        self.assertFalse(asana_mailer.templates_use_comments(
+            pack, ['Names.html']))
+        pack[u'templates'][u'Names.html'] = dict(no_comments, complete=False)
+        self.assertTrue(asana_mailer.templates_use_comments(
+            pack, ['Names.html']))
+
+    def test_generate_templates_omitted_tasks(self):
+        project = asana_mailer.Project(u'123', u'Project', None, [
+            asana_mailer.Section(u'Section:', [
+                asana_mailer.Task(
+                    u'Task', None, False, None, None, None, [], None,
+                    id=u'456')], omitted_tasks=2)])
+        rendered_html, rendered_text = asana_mailer.generate_templates(
+            project, 'Default.html', 'Default.markdown',
+            type(self).current_date, type(self).current_time_utc, True)
+        self.assertIn(u'2 more tasks in Asana', rendered_html)
+        self.assertIn(
+            u'2 more tasks in Asana: https://app.asana.com/0/123/123',
+            rendered_text)
+
+        # The sections of a rollup link to the project they're from
+        project.sections[0].project_id = u'789'
+        rendered_html, rendered_text = asana_mailer.generate_templates(
+            project, 'Default.html', 'Default.markdown',
+            type(self).current_date, type(self).current_time_utc, True)
+        self.assertIn(u'https://app.asana.com/0/789/789', rendered_html)
+        self.assertIn(
+            u'2 more tasks in Asana: https://app.asana.com/0/789/789',
+            rendered_text)
+        self.assertIn(
+            u'https://app.asana.com/0/789/789',
+            asana_mailer.render_slack_blocks(
+                project, type(self).current_date,
+                type(self).current_time_utc))
+        section = asana_mailer.Section.from_dict(
+            project.sections[0].to_dict())
+        self.assertEqual(section.project_id, u'789')
+
+    def test_generate_templates_subtasks(self):
+        task = asana_mailer.Task(
+            u'Task', None, False, None, None, None, [], None, id=u'1')
+        subtask = asana_mailer.Task(
+            u'Subtask', u'user', True, None, None, None, [], None, id=u'2')
+        subtask.subtasks = [asana_mailer.Task(
+            u'Nested', None, False, None, None, None, [], None, id=u'3')]
+        task.subtasks = [subtask]
+        project = asana_mailer.Project(u'123', u'Project', None, [
+            asana_mailer.Section(u'Section:', [task])])
+        self.assertEqual(
+            asana_mailer.Project.from_dict(project.to_dict()).to_dict(),
+            project.to_dict())
+        rendered_html, rendered_text = asana_mailer.generate_templates(
+            project, 'Default.html', 'Default.markdown',
+            type(self).current_date, type(self).current_time_utc, True)
+        self.assertIn(
+            u'Subtask - <span class="user">user</span>', rendered_html)
+        self.assertIn(u'Nested - ', rendered_html)
+        self.assertIn(
+            u'  * Subtasks:\n    * [DONE]: Subtask - user\n'
+            u'      * Nested - Unassigned\n', rendered_text)
+
+    def test_generate_templates_summary(self):
+        project = asana_mailer.Project(u'123', u'Project', None, [
+            asana_mailer.Section(u'Section:', [
+                asana_mailer.Task(
+                    u'Done', u'user', True, type(self).current_time_utc, None,
+                    None, [], None, id=u'1'),
+                asana_mailer.Task(
+                    u'Late', u'user', False, None, None, u'2013-06-01', [],
+                    None, id=u'2')])])
+        rendered_html, rendered_text = asana_mailer.generate_templates(
+            project, 'Summary.html', 'Summary.markdown',
+            type(self).current_date, type(self).current_time_utc, True)
+        self.assertIn(u'Completed:</span> 1 of 2 tasks', rendered_html)
+        self.assertIn(u'<span class="user">user</span>: 1', rendered_html)
+        self.assertIn(u'Section: 1/2 (50%)', rendered_html)
+        self.assertIn(u'* Completed: 1 of 2 tasks\n', rendered_text)
+        self.assertIn(u'* Overdue:\n  * user: 1\n', rendered_text)
+        self.assertIn(u'* Open tasks over the past day: 2 -> ', rendered_text)
+        self.assertIn(u'* Late - user', rendered_text)
+
+    def test_create_template_environments(self):
+        envs = asana_mailer.create_template_environments()
+        self.assertTrue(envs['html'].autoescape)
+        self.assertFalse(envs['text'].autoescape)
+        self.assertIn('last_comment', envs['text'].filters)
+
+    def test_render_extra_formats(self):
+        project = asana_mailer.Project(u'123', u'Project', None, [
+            asana_mailer.Section(u'Section:', [
+                asana_mailer.Task(
+                    u'Done', u'user', True, type(self).current_time_utc, None,
+                    u'2013-06-03', [], None, id=u'1'),
+                asana_mailer.Task(
+                    u'Not Done', None, False, None, None, None, [], None,
+                    id=u'2')])])
+        rendered = asana_mailer.render_extra_formats(
+            project, ['json', 'slack'], u'2013-06-03',
+            type(self).current_time_utc)
+        digest = json.loads(rendered['json'])
+        self.assertEqual(digest[u'date'], u'2013-06-03')
+        self.assertEqual(digest[u'project'], project.to_dict())
+
+        blocks = json.loads(rendered['slack'])[u'blocks']
+        self.assertEqual(blocks[0][u'type'], u'header')
+        self.assertEqual(
+            blocks[0][u'text'][u'text'], u'Project Daily Actions 2013-06-03')
+        self.assertEqual(
+            blocks[1][u'text'][u'text'],
+            u'*Section:*\n\u2022 ~Done~ - user (due 2013-06-03)\n'
+            u'\u2022 Not Done - Unassigned')
+
+        # Long sections are split over multiple blocks
+        project.sections[0].tasks *= 100
+        blocks = json.loads(asana_mailer.render_slack_blocks(
+            project, u'2013-06-03', type(self).current_time_utc))[u'blocks']
+        self.assertGreater(len(blocks), 2)
+        for block in blocks[1:]:
+            self.assertLessEqual(len(block[u'text'][u'text']), 3000)
+
+    def test_write_extra_formats(self):
+        today = type(self).current_date.isoformat()
+        asana_mailer.write_extra_formats(
+            {'json': u'{}', 'slack': u'{"blocks": []}'}, today)
+        for fname, contents in (
+                ('AsanaMailer_{0}.json'.format(today), u'{}'),
+                ('AsanaMailer_{0}.slack.json'.format(today),
+                 u'{"blocks": []}')):
+            with codecs.open(fname, 'r', 'utf-8') as fobj:
+                self.assertEqual(fobj.read(), contents)
+
+    def test_lazy_imports(self):
+        # Importing the module must not pull in the heavy dependencies or
+        # start logging to a file
+        script = (
+            'import sys, asana_mailer; '
+            'print(",".join(sorted(name for name in ('
+            '"asana", "dateutil", "jinja2", "lxml", "premailer", "smtplib") '
+            'if name in sys.modules)))')
+        cwd = os.path.dirname(os.path.abspath(asana_mailer.__file__))
+        before = os.path.exists(os.path.join(cwd, 'asana_mailer.log'))
+        output = subprocess.check_output(
+            [sys.executable, '-c', script], cwd=cwd)
+        self.assertEqual(output.strip(), '')
+        self.assertEqual(
+            os.path.exists(os.path.join(cwd, 'asana_mailer.log')), before)
+
+    @mock.patch('asana_mailer.serve_main')
+    @mock.patch('asana_mailer.run_mailer')
+    def test_main_commands(self, mock_run_mailer, mock_serve_main):
+        with mock.patch.dict(
+                asana_mailer.COMMANDS, {'serve': mock_serve_main}):
+            asana_mailer.main(['serve', 'schedule'])
+        mock_serve_main.assert_called_once_with(['schedule'])
+        self.assertFalse(mock_run_mailer.called)
+
+    @mock.patch('asana_mailer.init_logging')
     @mock.patch('datetime.date')
     @mock.patch('datetime.datetime')
     @mock.patch('asana_mailer.write_rendered_files')
     @mock.patch('asana_mailer.send_email')
     @mock.patch('asana_mailer.generate_templates')
     @mock.patch('asana_mailer.Project.create_project')
-    @mock.patch('asana_mailer.asana')
+    @mock.patch('asana.Client')
     @mock.patch('asana_mailer.create_cli_parser')
     def test_main(
             self, mock_cli_parser, mock_asana_client, mock_create_project,
             mock_generate_templates, mock_send_email,
-            mock_write_rendered_files, mock_datetime, mock_date):
+            mock_write_rendered_files, mock_datetime, mock_date,
+            mock_init_logging):
 
         mock_cli_instance = mock_cli_parser.return_value
         mock_cli_instance.error.side_effect = SystemExit(2)
         mock_create_project.return_value = 'Project'
         mock_asana_instance = (
-            mock_asana_client.Client.access_token.return_value)
+            mock_asana_client.access_token.return_value)
         mock_datetime_now_instance = mock_datetime.now.return_value
         mock_date.today.return_value = 'Mock Date'
         mock_generate_templates.return_value = (
@@ -557,24 +2040,65 @@ class AsanaMailerTestCase(unittest.TestCase):
             to_addresses=['example2@example.com'],
             skip_inline_css=False,
             username=None,
-            password=None
+            password=None,
+            dump_snapshot=None,
+            from_snapshot=None,
+            extra_formats=[],
+            processes=0,
+            changes_only=False,
+            fingerprint_file=None,
+            fetch_workers=1,
+            spool_dir=None,
+            retries=3,
+            max_recipients=None,
+            send_workers=1,
+            max_tasks_per_section=None,
+            max_description_length=None,
+            max_comments_per_task=None,
+            max_bytes=None,
+            subtask_depth=0,
+            trace_memory=0,
+            record=None,
+            replay=None,
+            replay_latency_scale=1.0,
+            shard_size=None,
+            render_cache=None,
+            render_cache_size=50,
+            rollup=[],
+            rollup_name=None,
+            comment_window=None,
+            template_pack=None,
+            from_store=None,
+            deadline=None,
+            shared_cache=None,
+            shared_cache_ttl=900,
+            log_file='asana_mailer.log',
+            log_format='text',
+            log_sample=None
         )
         mock_cli_instance.parse_args.return_value = namespace
         asana_mailer.main()
-        mock_asana_client.Client.access_token.assert_called_once_with(
+        mock_init_logging.assert_called_once_with(
+            'asana_mailer.log', 'text', None)
+        mock_asana_client.access_token.assert_called_once_with(
             'pat')
         mock_create_project.assert_called_once_with(
             mock_asana_instance, 'project_id', mock_datetime_now_instance,
             task_filters=frozenset((u'tag_filter',)),
             section_filters=frozenset((u'section_filter:',)),
-            completed_lookback_hours=None)
+            completed_lookback_hours=None, story_cache=None,
+            fetch_workers=1, pool=None, shard_size=None, limits=mock.ANY,
+            subtask_depth=0, subtask_cache=None, tracer=None,
+            comment_window=None, deadline=None, with_comments=True)
         mock_generate_templates.assert_called_once_with(
             'Project', 'Mock.html', 'Mock.markdown', 'Mock Date',
-            mock_datetime_now_instance, False)
+            mock_datetime_now_instance, False, envs=None, pool=None,
+            shard_size=None, tracer=None, template_pack=None)
         mock_send_email.assert_called_once_with(
             'Project', 'mockhost', 'example@example.com',
             ['example2@example.com'], None, 'rendered_html', 'rendered_text',
-            'Mock Date', None, None)
+            'Mock Date', None, None, smtp_conn=None, max_recipients=None,
+            workers=1, timeout=300, get_smtp_conn=None)
 
         # With Cc Addresses
         namespace.cc_addresses = [
@@ -587,7 +2111,8 @@ class AsanaMailerTestCase(unittest.TestCase):
             'Project', 'mockhost', 'example@example.com',
             ['example2@example.com'],
             ['example3@example.com', 'example4@example.com'], 'rendered_html',
-            'rendered_text', 'Mock Date', None, None)
+            'rendered_text', 'Mock Date', None, None, smtp_conn=None,
+            max_recipients=None, workers=1, timeout=300, get_smtp_conn=None)
 
         # With No Addresses
         namespace.to_addresses = None
@@ -599,6 +2124,26 @@ class AsanaMailerTestCase(unittest.TestCase):
         mock_write_rendered_files.assert_called_once_with(
             'rendered_html', 'rendered_text', 'Mock Date')
 
+        # With extra formats and a process pool
+        namespace.extra_formats = ['json']
+        namespace.processes = 2
+        mock_generate_templates.reset_mock()
+        with mock.patch('multiprocessing.Pool') as mock_pool, mock.patch(
+                'asana_mailer.render_extra_formats') as mock_render_extra, \
+                mock.patch('asana_mailer.write_extra_formats') as mock_write:
+            asana_mailer.main()
+        mock_pool.assert_called_once_with(2)
+        mock_generate_templates.assert_called_once_with(
+            'Project', 'Mock.html', 'Mock.markdown', 'Mock Date',
+            mock_datetime_now_instance, False, envs=None,
+            pool=mock_pool.return_value, shard_size=None, tracer=None,
+            template_pack=None)
+        mock_pool.return_value.close.assert_called_once_with()
+        mock_render_extra.assert_called_once_with(
+            'Project', ['json'], 'Mock Date', mock_datetime_now_instance)
+        mock_write.assert_called_once_with(
+            mock_render_extra.return_value, 'Mock Date')
+
     @mock.patch('asana_mailer.MIMEText')
     @mock.patch('asana_mailer.MIMEMultipart')
     @mock.patch('smtplib.SMTP')
@@ -672,6 +2217,32 @@ class AsanaMailerTestCase(unittest.TestCase):
         )
         smtp_mock_instance.quit.assert_called_once_with()
 
+        # Reusing a connection
+        reused_conn = mock.MagicMock()
+        mock_smtp.reset_mock()
+        asana_mailer.send_email(
+            project, 'localhost', from_address, to_addresses[:], None,
+            'test_html', 'test_text', type(self).current_date,
+            smtp_conn=reused_conn)
+        self.assertFalse(mock_smtp.called)
+        reused_conn.sendmail.assert_called_once_with(
+            from_address, to_addresses, 'test message')
+        self.assertFalse(reused_conn.quit.called)
+
+        # A reused connection that was dropped while idle is replaced
+        reused_conn.sendmail.side_effect = smtplib.SMTPServerDisconnected
+        smtp_mock_instance.sendmail.reset_mock()
+        smtp_mock_instance.quit.reset_mock()
+        self.assertTrue(asana_mailer.send_email(
+            project, 'localhost', from_address, to_addresses[:], None,
+            'test_html', 'test_text', type(self).current_date,
+            get_smtp_conn=lambda: reused_conn))
+        self.assertEqual(reused_conn.sendmail.call_count, 2)
+        smtp_mock_instance.sendmail.assert_called_once_with(
+            from_address, to_addresses, 'test message')
+        smtp_mock_instance.quit.assert_called_once_with()
+        self.assertFalse(reused_conn.quit.called)
+
         smtp_mock_instance.sendmail.side_effect = smtplib.SMTPException
         try:
             asana_mailer.send_email(
@@ -680,6 +2251,432 @@ class AsanaMailerTestCase(unittest.TestCase):
         except smtplib.SMTPException:
             self.fail('asana_mailer.send_email threw an SMTPException!')
 
+    def test_plan_deliveries(self):
+        recipients = [
+            'a@one.com', 'b@two.com', 'c@ONE.com', 'd@one.com', 'e@two.com']
+        self.assertEqual(
+            asana_mailer.plan_deliveries(recipients), [[recipients]])
+        self.assertEqual(asana_mailer.plan_deliveries(recipients, 2), [
+            [['a@one.com', 'c@ONE.com'], ['d@one.com']],
+            [['b@two.com', 'e@two.com']]])
+
+    @mock.patch('asana_mailer.connect_smtp')
+    def test_send_email_batches(self, mock_connect_smtp):
+        project = asana_mailer.Project(u'123', u'Project', None)
+        to_addresses = ['a@one.com', 'b@two.com', 'c@one.com']
+        # Mocks aren't thread safe, so each worker gets its own connection
+        connections = []
+
+        def connect_smtp(*args, **kwargs):
+            connections.append(mock.MagicMock())
+            return connections[-1]
+
+        mock_connect_smtp.side_effect = connect_smtp
+        self.assertTrue(asana_mailer.send_email(
+            project, 'localhost', 'from@example.com', to_addresses,
+            ['d@one.com'], u'html', u'text', type(self).current_date,
+            max_recipients=2, workers=2))
+        self.assertEqual(len(connections), 2)
+        sendmail_calls = []
+        for conn in connections:
+            conn.quit.assert_called_once_with()
+            sendmail_calls.extend(conn.sendmail.call_args_list)
+        self.assertEqual(sorted(call[0][1] for call in sendmail_calls), [
+            ['a@one.com', 'c@one.com'], ['b@two.com'], ['d@one.com']])
+        # The message is serialized once and reused for every batch
+        self.assertEqual(len(set(call[0][2] for call in sendmail_calls)), 1)
+
+        mock_connect_smtp.side_effect = None
+        mock_connect_smtp.return_value.sendmail.side_effect = (
+            smtplib.SMTPException)
+        self.assertFalse(asana_mailer.send_email(
+            project, 'localhost', 'from@example.com', to_addresses, None,
+            u'html', u'text', type(self).current_date, max_recipients=2))
+
+    @mock.patch('asana_mailer.init_logging')
+    @mock.patch('asana_mailer.Project.filter_tasks')
+    @mock.patch('asana_mailer.generate_templates')
+    def test_main_from_snapshot(
+            self, mock_generate_templates, mock_filter_tasks,
+            mock_init_logging):
+        project = asana_mailer.Project(u'123', u'Project', None, [
+            asana_mailer.Section(u'Section:', [
+                asana_mailer.Task(
+                    u'Task', None, True, type(self).current_time_utc, None,
+                    None, [u'tag'], None, id=u'456')])])
+        fname = 'AsanaMailer_test.snapshot'
+        asana_mailer.dump_snapshot(project, fname)
+        mock_generate_templates.return_value = ('html', 'text')
+        with mock.patch('asana_mailer.write_rendered_files'):
+            with mock.patch('asana.Client') as mock_asana:
+                asana_mailer.main(['123', 'pat', '--from-snapshot', fname])
+        self.assertFalse(mock_asana.access_token.called)
+        rendered_project = mock_generate_templates.call_args[0][0]
+        self.assertEqual(rendered_project.to_dict(), project.to_dict())
+        mock_filter_tasks.assert_called_once_with(
+            mock.ANY, section_filters=frozenset(), task_filters=frozenset())
+        os.remove(fname)
+
+    @mock.patch('asana_mailer.init_logging')
+    @mock.patch('asana_mailer.generate_templates')
+    def test_main_comment_window_after_fingerprints(
+            self, mock_generate_templates, mock_init_logging):
+        def create_project(num_comments):
+            return asana_mailer.Project(u'123', u'Project', None, [
+                asana_mailer.Section(u'Section:', [
+                    asana_mailer.Task(
+                        u'Task', None, False, None, None, None, [], [
+                            {u'text': unicode(i), u'type': u'comment'}
+                            for i in range(num_comments)],
+                        id=u'456')])])
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        snapshot = os.path.join(tempdir, 'project.snapshot')
+        dumped = os.path.join(tempdir, 'dumped.snapshot')
+        fingerprint_file = os.path.join(tempdir, 'fingerprints')
+        asana_mailer.dump_snapshot(create_project(2), snapshot)
+        asana_mailer.save_fingerprints(
+            fingerprint_file, create_project(1).fingerprints())
+        mock_generate_templates.return_value = ('html', 'text')
+        with mock.patch('asana_mailer.write_rendered_files'):
+            asana_mailer.main([
+                '123', 'pat', '--from-snapshot', snapshot, '--changes-only',
+                '--fingerprint-file', fingerprint_file, '--dump-snapshot',
+                dumped])
+        # The default templates' last comment window only applies to the
+        # rendered project, after fingerprinting and dumping every comment
+        rendered_task = (
+            mock_generate_templates.call_args[0][0].sections[0].tasks[0])
+        self.assertEqual(rendered_task.change, u'commented')
+        self.assertEqual(
+            rendered_task.comments, [{u'text': u'1', u'type': u'comment'}])
+        dumped_task = asana_mailer.load_snapshot(dumped).sections[0].tasks[0]
+        self.assertEqual(len(dumped_task.comments), 2)
+        self.assertEqual(
+            asana_mailer.load_fingerprints(fingerprint_file),
+            create_project(2).fingerprints())
+
+    def test_render_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            render_cache = asana_mailer.RenderCache(cache_dir, 1024)
+            self.assertIsNone(render_cache.get('a'))
+            render_cache.set('a', u'html a', u'text a')
+            self.assertEqual(render_cache.get('a'), (u'html a', u'text a'))
+
+            # Least recently used entries are evicted beyond max_bytes
+            render_cache.max_bytes = os.path.getsize(render_cache.path('a'))
+            os.utime(render_cache.path('a'), (0, 0))
+            render_cache.set('b', u'html a', u'text a')
+            self.assertIsNone(render_cache.get('a'))
+            self.assertEqual(render_cache.get('b'), (u'html a', u'text a'))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_render_cache_key(self):
+        project = asana_mailer.Project(u'123', u'Project', None, [
+            asana_mailer.Section(u'Section:', [
+                asana_mailer.Task(
+                    u'Task', None, False, None, None, None, [], [],
+                    id=u'456')])])
+        key = asana_mailer.render_cache_key(
+            project, 'Project.html', 'Project.markdown', '2013-06-03', None,
+            False)
+        self.assertEqual(key, asana_mailer.render_cache_key(
+            project, 'Project.html', 'Project.markdown', '2013-06-03', None,
+            False))
+        self.assertNotEqual(key, asana_mailer.render_cache_key(
+            project, 'Project.html', 'Project.markdown', '2013-06-04', None,
+            False))
+        project.sections[0].tasks[0].change = u'new'
+        self.assertNotEqual(key, asana_mailer.render_cache_key(
+            project, 'Project.html', 'Project.markdown', '2013-06-03', None,
+            False))
+
+        # Templates that use the time are cached for the hour
+        self.assertFalse(asana_mailer.templates_use_time(
+            ['Default.html', 'Default.markdown']))
+        self.assertTrue(asana_mailer.templates_use_time(
+            ['Summary.html', 'Summary.markdown']))
+        self.assertTrue(asana_mailer.templates_use_time(
+            ['Default.html', 'Last_Weeks_Comments.markdown']))
+
+        def time_key(hour, minute):
+            return asana_mailer.render_cache_key(
+                project, 'Summary.html', 'Summary.markdown', '2013-06-03',
+                None, False, current_time_utc=datetime.datetime(
+                    2013, 6, 3, hour, minute, tzinfo=dateutil.tz.tzutc()))
+        self.assertEqual(time_key(12, 5), time_key(12, 55))
+        self.assertNotEqual(time_key(12, 55), time_key(13, 5))
+
+    @mock.patch('asana_mailer.init_logging')
+    @mock.patch('asana_mailer.generate_templates')
+    def test_main_render_cache(self, mock_generate_templates, mock_init):
+        project = asana_mailer.Project(u'123', u'Project', None, [])
+        snapshot = 'AsanaMailer_test.snapshot'
+        cache_dir = tempfile.mkdtemp()
+        asana_mailer.dump_snapshot(project, snapshot)
+        mock_generate_templates.return_value = (u'html', u'text')
+        argv = [
+            '123', 'pat', '--from-snapshot', snapshot, '--render-cache',
+            cache_dir]
+        try:
+            with mock.patch('asana_mailer.write_rendered_files') as mock_write:
+                asana_mailer.main(argv)
+                asana_mailer.main(argv)
+            self.assertEqual(mock_generate_templates.call_count, 1)
+            self.assertEqual(mock_write.call_args_list, [
+                mock.call(u'html', u'text', mock.ANY)] * 2)
+        finally:
+            os.remove(snapshot)
+            shutil.rmtree(cache_dir)
+
+    def test_load_save_fingerprints(self):
+        fname = 'AsanaMailer_test.fingerprints'
+        self.assertEqual(asana_mailer.load_fingerprints(fname), {})
+        fingerprints = {u'123': [u'abcdef', False, 2]}
+        asana_mailer.save_fingerprints(fname, fingerprints)
+        self.assertEqual(asana_mailer.load_fingerprints(fname), fingerprints)
+        self.assertFalse(os.path.exists(fname + '.tmp'))
+        os.remove(fname)
+
+    @mock.patch('asana_mailer.init_logging')
+    @mock.patch('asana_mailer.generate_templates')
+    def test_main_changes_only(self, mock_generate_templates, mock_init):
+        tasks = [
+            asana_mailer.Task(
+                u'Task {0}'.format(i), None, False, None, None, None, [], [],
+                id=unicode(i))
+            for i in range(3)]
+        project = asana_mailer.Project(
+            u'123', u'Project', None, [asana_mailer.Section(u'One:', tasks)])
+        snapshot = 'AsanaMailer_test.snapshot'
+        fingerprint_file = 'AsanaMailer_test.fingerprints'
+        asana_mailer.dump_snapshot(project, snapshot)
+        mock_generate_templates.return_value = ('html', 'text')
+        argv = [
+            '123', 'pat', '--from-snapshot', snapshot, '--changes-only',
+            '--fingerprint-file', fingerprint_file]
+
+        def rendered_task_ids():
+            rendered_project = mock_generate_templates.call_args[0][0]
+            return [
+                task.id for section in rendered_project.sections
+                for task in section.tasks]
+
+        with mock.patch('asana_mailer.write_rendered_files'):
+            asana_mailer.main(argv)
+            self.assertEqual(rendered_task_ids(), [u'0', u'1', u'2'])
+            tasks[1].name = u'Renamed'
+            asana_mailer.dump_snapshot(project, snapshot)
+            asana_mailer.main(argv)
+            self.assertEqual(rendered_task_ids(), [u'1'])
+
+            # Tasks left out by the limits keep their fingerprints
+            section = project.sections[0]
+            section.tasks.remove(tasks[0])
+            section.omitted_tasks = 1
+            section.omitted_task_ids = [u'0']
+            asana_mailer.dump_snapshot(project, snapshot)
+            asana_mailer.main(argv)
+            self.assertEqual(rendered_task_ids(), [])
+            section.tasks.insert(0, tasks[0])
+            section.omitted_tasks = 0
+            section.omitted_task_ids = []
+            asana_mailer.dump_snapshot(project, snapshot)
+            asana_mailer.main(argv)
+            self.assertEqual(rendered_task_ids(), [])
+
+        # Fingerprints aren't saved when the email isn't sent
+        tasks[2].name = u'Renamed'
+        asana_mailer.dump_snapshot(project, snapshot)
+        with mock.patch('asana_mailer.send_email') as mock_send_email:
+            mock_send_email.return_value = False
+            for i in range(2):
+                asana_mailer.main(argv + [
+                    '--to-addresses', 'a@example.com', '--from-address',
+                    'b@example.com'])
+                self.assertEqual(rendered_task_ids(), [u'2'])
+
+        # Nor from a snapshot missing some comments
+        project.partial_comments = True
+        asana_mailer.dump_snapshot(project, snapshot)
+        with mock.patch('asana_mailer.write_rendered_files'):
+            for i in range(2):
+                asana_mailer.main(argv)
+                self.assertEqual(rendered_task_ids(), [u'2'])
+        os.remove(snapshot)
+        os.remove(fingerprint_file)
+
+    def test_dump_load_snapshot(self):
+        project = asana_mailer.Project(u'123', u'Project', u'Notes', [
+            asana_mailer.Section(u'Section:', [
+                asana_mailer.Task(
+                    u'Task', u'user', True, type(self).current_time_utc,
+                    u'description', u'2013-01-01', [u'tag'],
+                    [{u'text': u'blah', u'type': u'comment'}], id=u'456'),
+                asana_mailer.Task(
+                    u'Other Task', None, False, None, None, None, [], None,
+                    id=u'789')])])
+        fname = 'AsanaMailer_test.snapshot'
+        asana_mailer.dump_snapshot(project, fname)
+        loaded_project = asana_mailer.load_snapshot(fname)
+        self.assertEqual(loaded_project.to_dict(), project.to_dict())
+        first_task = loaded_project.sections[0].tasks[0]
+        self.assertEqual(first_task.id, u'456')
+        self.assertEqual(
+            first_task.completion_time, type(self).current_time_utc)
+
+        with open(fname, 'wb') as snapshot_file:
+            snapshot_file.write(zlib.compress(json.dumps({u'version': 0})))
+        with self.assertRaises(ValueError):
+            asana_mailer.load_snapshot(fname)
+        os.remove(fname)
+
+    def test_spool_message(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            message = email.mime.text.MIMEText('body')
+            name = asana_mailer.spool_message(spool_dir, message)
+            self.assertEqual(os.listdir(os.path.join(spool_dir, 'tmp')), [])
+            self.assertEqual(
+                os.listdir(os.path.join(spool_dir, 'new')), [name])
+            with open(os.path.join(spool_dir, 'new', name), 'rb') as fobj:
+                self.assertEqual(fobj.read(), message.as_string())
+            self.assertNotEqual(
+                asana_mailer.spool_message(spool_dir, message), name)
+        finally:
+            shutil.rmtree(spool_dir)
+
+    @mock.patch('time.sleep')
+    @mock.patch('asana_mailer.connect_smtp')
+    def test_flush_spool(self, mock_connect_smtp, mock_sleep):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual(asana_mailer.flush_spool(spool_dir, 'host'), [])
+            names = []
+            for i in range(3):
+                message = email.mime.text.MIMEText('body {0}'.format(i))
+                message['From'] = 'Sender <from@example.com>'
+                message['To'] = 'One <one@example.com>, two@example.com'
+                message['Cc'] = 'three@example.com'
+                names.append(asana_mailer.spool_message(spool_dir, message))
+
+            mock_smtp_conn = mock_connect_smtp.return_value
+            delivered = asana_mailer.flush_spool(
+                spool_dir, 'host', 'user', 'password', 25)
+            self.assertEqual(delivered, names)
+            mock_connect_smtp.assert_called_once_with(
+                'host', 'user', 'password', 25, timeout=300)
+            self.assertEqual(mock_smtp_conn.sendmail.call_count, 3)
+            from_address, recipients, message_str = (
+                mock_smtp_conn.sendmail.call_args[0])
+            self.assertEqual(from_address, 'Sender <from@example.com>')
+            self.assertEqual(recipients, [
+                'one@example.com', 'two@example.com', 'three@example.com'])
+            self.assertIn('body 2', message_str)
+            mock_smtp_conn.quit.assert_called_once_with()
+            for subdir in ('new', 'cur'):
+                self.assertEqual(
+                    os.listdir(os.path.join(spool_dir, subdir)), [])
+
+            # Failed deliveries are retried, then left in the spool
+            name = asana_mailer.spool_message(spool_dir, message)
+            mock_connect_smtp.reset_mock()
+            mock_smtp_conn.sendmail.side_effect = smtplib.SMTPException
+            self.assertEqual(asana_mailer.flush_spool(
+                spool_dir, 'host', retries=2), [])
+            self.assertEqual(mock_smtp_conn.sendmail.call_count, 3)
+            self.assertEqual(mock_connect_smtp.call_count, 3)
+            mock_sleep.assert_has_calls([mock.call(1.0), mock.call(2.0)])
+            self.assertEqual(
+                os.listdir(os.path.join(spool_dir, 'new')), [name])
+
+            # And delivered by a later flush
+            mock_smtp_conn.sendmail.side_effect = None
+            self.assertEqual(
+                asana_mailer.flush_spool(spool_dir, 'host', workers=2),
+                [name])
+
+            # Messages claimed by a crashed flush are recovered once their
+            # claim times out
+            name = asana_mailer.spool_message(spool_dir, message)
+            os.rename(
+                os.path.join(spool_dir, 'new', name),
+                os.path.join(spool_dir, 'cur', name))
+            self.assertEqual(asana_mailer.flush_spool(spool_dir, 'host'), [])
+            claimed_at = time.time() - 120
+            os.utime(
+                os.path.join(spool_dir, 'cur', name),
+                (claimed_at, claimed_at))
+            self.assertEqual(asana_mailer.flush_spool(
+                spool_dir, 'host', names=[], claim_timeout=60), [])
+            self.assertEqual(asana_mailer.flush_spool(
+                spool_dir, 'host', claim_timeout=60), [name])
+            for subdir in ('new', 'cur'):
+                self.assertEqual(
+                    os.listdir(os.path.join(spool_dir, subdir)), [])
+        finally:
+            shutil.rmtree(spool_dir)
+
+    @mock.patch('time.sleep')
+    @mock.patch('asana_mailer.connect_smtp')
+    def test_flush_spool_batches(self, mock_connect_smtp, mock_sleep):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            message = email.mime.text.MIMEText('body')
+            message['From'] = 'from@example.com'
+            message['To'] = 'a@one.com, b@one.com, c@one.com'
+            name = asana_mailer.spool_message(spool_dir, message)
+
+            # The first batch is delivered, the second isn't
+            mock_smtp_conn = mock_connect_smtp.return_value
+            mock_smtp_conn.sendmail.side_effect = [
+                {}, smtplib.SMTPException]
+            self.assertEqual(asana_mailer.flush_spool(
+                spool_dir, 'host', retries=0, max_recipients=2), [])
+            self.assertEqual(
+                os.listdir(os.path.join(spool_dir, 'new')), [name])
+
+            # Only the recipients left are sent to by the next flush
+            mock_smtp_conn.sendmail.reset_mock()
+            mock_smtp_conn.sendmail.side_effect = None
+            self.assertEqual(asana_mailer.flush_spool(
+                spool_dir, 'host', max_recipients=2), [name])
+            mock_smtp_conn.sendmail.assert_called_once_with(
+                'from@example.com', ['c@one.com'], mock.ANY)
+            message_str = mock_smtp_conn.sendmail.call_args[0][2]
+            self.assertNotIn(
+                asana_mailer.SPOOL_RECIPIENTS_HEADER, message_str)
+            self.assertIn('To: a@one.com, b@one.com, c@one.com', message_str)
+        finally:
+            shutil.rmtree(spool_dir)
+
+    @mock.patch('asana_mailer.init_logging')
+    @mock.patch('asana_mailer.flush_spool')
+    @mock.patch('asana_mailer.generate_templates')
+    def test_main_spool(
+            self, mock_generate_templates, mock_flush_spool, mock_init):
+        spool_dir = tempfile.mkdtemp()
+        snapshot = os.path.join(spool_dir, 'project.snapshot')
+        try:
+            asana_mailer.dump_snapshot(
+                asana_mailer.Project(u'123', u'Project', None), snapshot)
+            mock_generate_templates.return_value = (u'html', u'text')
+            mock_flush_spool.return_value = []
+            asana_mailer.main([
+                '123', 'pat', '--from-snapshot', snapshot, '--spool-dir',
+                spool_dir, '--to-addresses', 'a@example.com',
+                '--from-address', 'b@example.com', '--retries', '1'])
+            spooled = os.listdir(os.path.join(spool_dir, 'new'))
+            self.assertEqual(len(spooled), 1)
+            # Only the email spooled by this run is sent
+            mock_flush_spool.assert_called_once_with(
+                spool_dir, 'localhost', None, None, retries=1, workers=1,
+                max_recipients=None, timeout=300, names=spooled)
+        finally:
+            shutil.rmtree(spool_dir)
+
     def test_write_rendered_files(self):
         today = type(self).current_date.isoformat()
         filenames = (